@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+"""An asyncio event loop that runs every watcher without a thread per location."""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, TypeVar
+
+import metrics
+import zip_store
+from coalesce import Coalescer
+from inotify_watcher import InotifyFolderWatcher
+from locations import Location
+from logger import log_err, log_info
+from poll_schedule import PollSchedule, PollSettings
+from snapshot import Snapshot
+
+DEFAULT_CONCURRENCY = 16
+IDLE_SECONDS = 1.0
+
+T = TypeVar("T")
+
+
+class LocationHooks(NamedTuple):
+    """The operations the engine needs from the synchronization code.
+
+    Attributes:
+        publish: Handles the changes between two snapshots of a location;
+            called as ``publish(path, prev, curr, signature, queue, watcher_id)``
+            and expected to ``put`` events on ``queue``.
+        handle_batch: Applies a batch of events.
+        scan: Returns a snapshot of a location.
+    """
+
+    publish: Callable[..., None]
+    handle_batch: Callable[[List[Dict[str, Any]]], None]
+    scan: Callable[[Location], Snapshot]
+
+
+class _LoopQueue:
+    """A ``put``-only view of an asyncio queue that is safe to call from threads."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, target: asyncio.Queue) -> None:
+        """Wrap ``target``, which belongs to ``loop``."""
+        self._loop = loop
+        self._target = target
+
+    def put(self, item: Any) -> None:
+        """Enqueue ``item`` on the event loop."""
+        self._loop.call_soon_threadsafe(self._target.put_nowait, item)
+
+
+class AsyncEngine:
+    """Watches every location from one event loop.
+
+    Waiting (poll intervals, inotify readiness, the event queue) costs no
+    thread. Blocking work such as scans and FTP listings runs on a small
+    executor, with at most ``concurrency`` operations in flight across all
+    locations, so hundreds of endpoints share a fixed number of threads.
+    """
+
+    def __init__(
+        self,
+        paths: List[Location],
+        snapshots: List[Snapshot],
+        hooks: LocationHooks,
+        poll_settings: Dict[str, PollSettings],
+        coalescer: Coalescer,
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ) -> None:
+        """Create the engine.
+
+        Args:
+            paths: The parsed locations.
+            snapshots: The snapshot of every location after the initial sync.
+            hooks: The synchronization operations.
+            poll_settings: Polling bounds per location type.
+            coalescer: Holds events back until their file is quiet.
+            concurrency: Maximum blocking operations running at once.
+        """
+        self.paths = paths
+        self.snapshots = snapshots
+        self.hooks = hooks
+        self.poll_settings = poll_settings
+        self.coalescer = coalescer
+        self.concurrency = max(1, concurrency)
+
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._limit: Optional[asyncio.Semaphore] = None
+
+    def run(self) -> None:
+        """Run until interrupted."""
+        asyncio.run(self._main())
+
+    async def _main(self) -> None:
+        """Start one task per location plus the batch consumer."""
+        loop = asyncio.get_running_loop()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="async-io"
+        )
+        self._limit = asyncio.Semaphore(self.concurrency)
+        events: asyncio.Queue = asyncio.Queue()
+        sink = _LoopQueue(loop, events)
+
+        tasks = [asyncio.create_task(self._consume(events))]
+        for watcher_id, (path, snapshot) in enumerate(
+            zip(self.paths, self.snapshots), start=1
+        ):
+            watcher = self._watch(path, snapshot, sink, watcher_id)
+            tasks.append(asyncio.create_task(watcher))
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._executor.shutdown(wait=False)
+
+    async def _io(self, fn: Callable[..., T], *args: Any) -> T:
+        """Run a blocking call on the executor within the concurrency limit."""
+        assert self._limit is not None
+        async with self._limit:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(fn, *args)
+            )
+
+    async def _consume(self, events: asyncio.Queue) -> None:
+        """Apply queued events in batches once their files are quiet."""
+        loop = asyncio.get_running_loop()
+        while True:
+            due = self.coalescer.next_due()
+            timeout = IDLE_SECONDS if due is None else max(0.0, due - loop.time())
+            try:
+                self.coalescer.add(await asyncio.wait_for(events.get(), timeout))
+                while not events.empty():
+                    self.coalescer.add(events.get_nowait())
+            except asyncio.TimeoutError:
+                if due is None:
+                    await loop.run_in_executor(self._executor, zip_store.compact_idle)
+
+            batch = self.coalescer.pop_due()
+            metrics.QUEUE_DEPTH.set(events.qsize() + len(self.coalescer))
+            if batch:
+                # Batches are applied one at a time; their own fan-out is
+                # bounded by the write worker pool.
+                await loop.run_in_executor(None, self.hooks.handle_batch, batch)
+
+    async def _watch(
+        self,
+        path: Location,
+        prev: Snapshot,
+        sink: _LoopQueue,
+        watcher_id: int,
+    ) -> None:
+        """Watch one location: inotify readiness for folders, else polling."""
+        notifier = path.create_notifier()
+        if notifier is not None:
+            prev = await self._io(self.hooks.scan, path)
+        log_info(f"Starting async watcher at {path.path}")
+
+        try:
+            if notifier is not None:
+                prev = await self._watch_inotify(path, prev, sink, watcher_id, notifier)
+                notifier.close()
+            await self._watch_polling(path, prev, sink, watcher_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            log_err(f"Watcher for {path.path} stopped: {exc}")
+
+    async def _watch_inotify(
+        self,
+        path: Location,
+        prev: Snapshot,
+        sink: _LoopQueue,
+        watcher_id: int,
+        notifier: InotifyFolderWatcher,
+    ) -> Snapshot:
+        """Process inotify events whenever the descriptor becomes readable.
+
+        Returns:
+            The last snapshot, once inotify fails and polling must take over.
+        """
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        loop.add_reader(notifier.fileno(), ready.set)
+        try:
+            while True:
+                await ready.wait()
+                ready.clear()
+                try:
+                    curr = await self._io(notifier.wait, prev, 0)
+                except OSError as exc:
+                    log_err(
+                        f"inotify failed at {path.path} ({exc}), "
+                        "falling back to polling"
+                    )
+                    return prev
+                if curr is not prev:
+                    await self._io(
+                        self.hooks.publish, path, prev, curr, None, sink, watcher_id
+                    )
+                prev = curr
+        finally:
+            loop.remove_reader(notifier.fileno())
+
+    async def _watch_polling(
+        self,
+        path: Location,
+        prev: Snapshot,
+        sink: _LoopQueue,
+        watcher_id: int,
+    ) -> None:
+        """Poll a location on its adaptive schedule."""
+        schedule = PollSchedule(self.poll_settings[path.type_name])
+        last_signature: Optional[str] = None
+
+        while True:
+            await asyncio.sleep(schedule.interval)
+            signature = await self._io(path.signature)
+            if signature is not None and signature == last_signature:
+                curr = prev
+            else:
+                try:
+                    curr = await self._io(self.hooks.scan, path)
+                except Exception as exc:
+                    # Keep polling; the next poll scans again.
+                    log_err(f"Could not scan {path.path}: {exc}")
+                    curr, signature = prev, None
+                if curr == prev:
+                    curr = prev
+            schedule.record(curr is not prev)
+            last_signature = signature
+
+            if curr is not prev:
+                await self._io(
+                    self.hooks.publish, path, prev, curr, signature, sink, watcher_id
+                )
+            prev = curr
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+"""Per-location batches applying a set of writes and deletes in one pass."""
+
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Set, TypeVar
+
+from transfer import Payload
+
+MAX_PENDING_BYTES = 256 * 1024 * 1024
+
+T = TypeVar("T")
+
+
+class Batch:
+    """Collects the changes of one location and applies them together.
+
+    Applying a batch is all or nothing: if any change fails, the location is
+    left as it was and the error is raised. A batch holds every queued
+    payload until it is applied, so callers keep the temporary storage
+    bounded by splitting large sets of changes with :func:`split` and
+    applying one batch per part. Batches may be fed from several threads.
+
+    Subclasses implement :meth:`_commit`.
+
+    Attributes:
+        writes: Names mapped to the payloads queued for them.
+        mtimes: Names mapped to the modification time to give them.
+        deletes: Names queued for removal.
+        applied_bytes: Payload bytes of every write applied so far.
+    """
+
+    def __init__(self) -> None:
+        """Create an empty batch."""
+        self.writes: Dict[str, Payload] = {}
+        self.mtimes: Dict[str, float] = {}
+        self.deletes: Set[str] = set()
+        self.applied_bytes = 0
+        self._pending_bytes = 0
+        self._lock = threading.RLock()
+
+    def write(self, name: str, payload: Payload, mtime: Optional[float] = None) -> None:
+        """Queue ``payload`` to be stored as ``name``, modified at ``mtime``."""
+        with self._lock:
+            self.deletes.discard(name)
+            self.mtimes.pop(name, None)
+            if mtime is not None:
+                self.mtimes[name] = mtime
+            previous: Optional[Payload] = self.writes.get(name)
+            if previous is not None:
+                self._pending_bytes -= previous.size
+            self.writes[name] = payload
+            self._pending_bytes += payload.size
+
+    def delete(self, name: str) -> None:
+        """Queue ``name`` for removal."""
+        with self._lock:
+            previous = self.writes.pop(name, None)
+            if previous is not None:
+                self._pending_bytes -= previous.size
+            self.mtimes.pop(name, None)
+            self.deletes.add(name)
+
+    def apply(self) -> None:
+        """Apply every queued change in one pass and reset the batch."""
+        with self._lock:
+            try:
+                if self.writes or self.deletes:
+                    self._commit(self.writes, self.deletes)
+                    self.applied_bytes += self._pending_bytes
+            finally:
+                self.writes = {}
+                self.mtimes = {}
+                self.deletes = set()
+                self._pending_bytes = 0
+
+    def _commit(self, writes: Dict[str, Payload], deletes: Set[str]) -> None:
+        """Apply every change, or none of them (lock held)."""
+        raise NotImplementedError
+
+
+def split(
+    items: Sequence[T], size_of: Callable[[T], int], limit: int = MAX_PENDING_BYTES
+) -> List[List[T]]:
+    """Split changes into parts whose payloads add up to at most ``limit`` bytes.
+
+    Args:
+        items: The changes, kept in order.
+        size_of: Returns the payload bytes a change queues.
+        limit: The most bytes in one part; a larger change gets a part of
+            its own.
+
+    Returns:
+        The parts, none of them empty.
+    """
+    parts: List[List[T]] = []
+    total = 0
+    for item in items:
+        size = max(0, size_of(item))
+        if not parts or total + size > limit:
+            parts.append([])
+            total = 0
+        parts[-1].append(item)
+        total += size
+    return parts
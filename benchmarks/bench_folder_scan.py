@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+"""Folder scan time: os.walk + getmtime versus the os.scandir scanner.
+
+Builds a tree of empty files and times:
+
+- ``os.walk``: ``os.walk`` + ``os.path.join`` + ``os.path.getmtime`` +
+  ``os.path.relpath`` per file, which is how folders were listed before
+  :mod:`folder_scanner`;
+- ``scandir (cold)``: a first :class:`folder_scanner.FolderScanner` scan,
+  reusing each ``DirEntry``'s stat;
+- ``scandir (warm)``: a later scan, which stats the cached names of
+  unchanged directories without listing them again.
+
+Usage::
+
+    python benchmarks/bench_folder_scan.py [--files 100000] [--dirs 1000]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, Dict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from folder_scanner import FolderScanner  # noqa: E402
+
+
+def build(root: str, files: int, dirs: int) -> None:
+    """Create ``files`` empty files spread over nested directories."""
+    for index in range(files):
+        folder = os.path.join(root, f"a{index % 10}", f"b{index % dirs:05d}")
+        os.makedirs(folder, exist_ok=True)
+        open(os.path.join(folder, f"f{index:07d}.txt"), "wb").close()
+
+    # Listings are only cached for directories older than the racy window.
+    past = time.time() - 3600
+    for folder, _, _ in os.walk(root):
+        os.utime(folder, (past, past))
+
+
+def walk_ls(root: str) -> Dict[str, float]:
+    """List a folder the way it was done before the scandir scanner."""
+    listing: Dict[str, float] = {}
+    for folder, _, names in os.walk(root):
+        for name in names:
+            full_path = os.path.join(folder, name)
+            modified = os.path.getmtime(full_path)
+            listing[os.path.relpath(full_path, root)] = modified
+    return listing
+
+
+def timed(scan: Callable[[], Dict]) -> float:
+    """Run one scan and return its duration."""
+    started = time.perf_counter()
+    scan()
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    """Run the benchmark and print one line per scan."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=100_000)
+    parser.add_argument("--dirs", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        build(root, args.files, args.dirs)
+        assert len(walk_ls(root)) == len(FolderScanner(root).scan()) == args.files
+
+        results = {"os.walk": [], "scandir (cold)": [], "scandir (warm)": []}
+        for _ in range(args.rounds):
+            results["os.walk"].append(timed(lambda: walk_ls(root)))
+            scanner = FolderScanner(root)
+            results["scandir (cold)"].append(timed(scanner.scan))
+            results["scandir (warm)"].append(timed(scanner.scan))
+
+    print(f"{args.files} files, best of {args.rounds}")
+    print(f"{'scan':<16}{'seconds':>10}")
+    for name, durations in results.items():
+        print(f"{name:<16}{min(durations):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+"""Round trips and time per FTP tree listing, before and after MLSD.
+
+Serves a generated tree with pyftpdlib on the loopback interface and lists
+it three ways:
+
+- ``LIST + MDTM``: one ``LIST`` per directory and one ``MDTM`` per file on
+  every poll, which is what listings cost before MLSD support;
+- ``LIST (cached)``: the ``LIST`` fallback on a later poll, sending ``MDTM``
+  only for files whose listing line changed;
+- ``MLSD``: one response per directory carrying every fact.
+
+Usage::
+
+    python benchmarks/bench_ftp_listing.py [--files 20000] [--dirs 200]
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from ftplib import FTP
+from typing import Iterable, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ftp_listing import FtpTreeLister  # noqa: E402
+
+USER = "user"
+PASSWORD = "secret"
+
+
+class CountingFTP(FTP):
+    """An FTP client that counts the commands it sends."""
+
+    commands = 0
+
+    def putcmd(self, line: str) -> None:
+        """Send a command line, counting it."""
+        self.commands += 1
+        super().putcmd(line)
+
+
+def make_tree(root: str, files: int, dirs: int) -> None:
+    """Create ``files`` small files spread over ``dirs`` directories."""
+    for index in range(files):
+        folder = os.path.join(root, f"d{index % dirs:04d}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"f{index:06d}.txt"), "wb") as file_obj:
+            file_obj.write(b"x" * (index % 100))
+
+
+def serve(root: str, disabled: Iterable[str] = ()) -> int:
+    """Serve ``root`` on a daemon thread and return the port."""
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.ioloop import IOLoop
+    from pyftpdlib.servers import FTPServer
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(USER, PASSWORD, root, perm="elr")
+    rejected = set(disabled)
+    handler = type(
+        "Handler",
+        (FTPHandler,),
+        {
+            "authorizer": authorizer,
+            "proto_cmds": {
+                cmd: info
+                for cmd, info in FTPHandler.proto_cmds.items()
+                if cmd not in rejected
+            },
+        },
+    )
+    server = FTPServer(("127.0.0.1", 0), handler, ioloop=IOLoop())
+    threading.Thread(
+        target=server.serve_forever,
+        kwargs={"timeout": 0.05, "handle_exit": False},
+        daemon=True,
+    ).start()
+    return server.address[1]
+
+
+def measure(lister: FtpTreeLister, port: int) -> Tuple[int, float, int]:
+    """List the tree once; return (commands, seconds, files)."""
+    ftp = CountingFTP()
+    ftp.connect("127.0.0.1", port, timeout=60)
+    ftp.login(USER, PASSWORD)
+    ftp.commands = 0
+    started = time.perf_counter()
+    try:
+        snapshot = lister.list_tree(ftp)
+    finally:
+        ftp.close()
+    return ftp.commands, time.perf_counter() - started, len(snapshot)
+
+
+def main() -> None:
+    """Run the benchmark and print one line per strategy."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--dirs", type=int, default=20)
+    args = parser.parse_args()
+    # Keep pyftpdlib from logging every session.
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, args.files, args.dirs)
+        mlsd_port = serve(root)
+        list_port = serve(root, disabled=("MLST", "MLSD"))
+
+        results = []
+        lister = FtpTreeLister("/")
+        measure(lister, list_port)
+        lister._list_cache.clear()
+        results.append(("LIST + MDTM", measure(lister, list_port)))
+        results.append(("LIST (cached)", measure(lister, list_port)))
+
+        lister = FtpTreeLister("/")
+        measure(lister, mlsd_port)
+        results.append(("MLSD", measure(lister, mlsd_port)))
+
+    print(f"{args.files} files in {args.dirs} directories")
+    print(f"{'strategy':<16}{'commands':>10}{'seconds':>10}")
+    for name, (commands, seconds, listed) in results:
+        assert listed == args.files, (name, listed)
+        print(f"{name:<16}{commands:>10}{seconds:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+"""Time to rewrite a ZIP archive: re-deflating members versus raw copies.
+
+Builds an archive of partly compressible members, then rewrites it twice:
+
+- ``recompress``: ``zin.read`` + ``zout.writestr`` per member, which is how
+  archives were rewritten before raw member copies;
+- ``raw copy``: :func:`zip_store.copy_member_raw`, streaming the compressed
+  bytes verbatim, as :func:`zip_store.compact` does.
+
+The defaults build about 1 GiB; use ``--members 4000 --member-kb 1024`` for a
+4 GiB archive with thousands of members.
+
+Usage::
+
+    python benchmarks/bench_zip_compact.py [--members N] [--member-kb N] [--dir D]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import zip_store  # noqa: E402
+
+
+def build(path: str, members: int, member_size: int) -> None:
+    """Write ``members`` members of ``member_size`` bytes, half compressible."""
+    text = b"the quick brown fox jumps over the lazy dog\n"
+    filler = (text * (member_size // 2 // len(text) + 1))[: member_size // 2]
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for index in range(members):
+            data = os.urandom(member_size - len(filler)) + filler
+            zf.writestr(f"dir{index % 50:02d}/member{index:06d}.bin", data)
+
+
+def recompress(src_path: str, dest_path: str) -> None:
+    """Rewrite by inflating and re-deflating every member."""
+    with zipfile.ZipFile(src_path) as zin, zipfile.ZipFile(
+        dest_path, "w", zipfile.ZIP_DEFLATED
+    ) as zout:
+        for item in zin.infolist():
+            zout.writestr(item, zin.read(item.filename))
+
+
+def raw_copy(src_path: str, dest_path: str) -> None:
+    """Rewrite by copying every member's compressed bytes verbatim."""
+    with open(src_path, "rb") as src, zipfile.ZipFile(src_path) as zin, zipfile.ZipFile(
+        dest_path, "w", zipfile.ZIP_DEFLATED
+    ) as zout:
+        for item in zin.infolist():
+            zip_store.copy_member_raw(src, zout, item)
+
+
+def main() -> None:
+    """Run the benchmark and print one line per rewrite strategy."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--member-kb", type=int, default=512)
+    parser.add_argument("--dir", default=None, help="where to put the archives")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        src = os.path.join(tmp, "source.zip")
+        build(src, args.members, args.member_kb * 1024)
+        size = os.path.getsize(src)
+        print(f"{args.members} members, {size / 2**30:.2f} GiB compressed")
+        print(f"{'strategy':<12}{'seconds':>10}{'MiB/s':>10}")
+
+        for name, rewrite in (("recompress", recompress), ("raw copy", raw_copy)):
+            dest = os.path.join(tmp, "dest.zip")
+            started = time.perf_counter()
+            rewrite(src, dest)
+            seconds = time.perf_counter() - started
+            with zipfile.ZipFile(dest) as zf:
+                assert len(zf.infolist()) == args.members
+            os.remove(dest)
+            print(f"{name:<12}{seconds:>10.2f}{size / 2**20 / seconds:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
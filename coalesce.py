@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+"""Debouncing of watcher events, so a burst of saves causes one transfer."""
+
+import time
+from typing import Any, Dict, List, Optional
+
+DEFAULT_WINDOW = 0.5
+DEFAULT_MAX_LATENCY = 5.0
+
+
+class _PendingFile:
+    """The events held back for one relative path.
+
+    Attributes:
+        first_seen: Monotonic time of the first held event.
+        last_seen: Monotonic time of the latest held event.
+        events: The latest event of every location, by location key.
+    """
+
+    __slots__ = ("first_seen", "last_seen", "events")
+
+    def __init__(self, now: float) -> None:
+        """Create an empty record first seen at ``now``."""
+        self.first_seen = now
+        self.last_seen = now
+        self.events: Dict[str, Dict[str, Any]] = {}
+
+
+class Coalescer:
+    """Holds events back until their file has been quiet for a while.
+
+    Events are merged per relative path, keeping only the latest event of
+    each location, so a create → update → delete chain collapses into its
+    final state. A file is released once no event arrived for ``window``
+    seconds, or ``max_latency`` seconds after its first held event, so a
+    file rewritten continuously is still synced regularly.
+
+    The coalescer is used by the single thread that dispatches batches and
+    is not thread-safe.
+
+    Attributes:
+        window: Quiet time in seconds after which a file is released.
+        max_latency: Longest time in seconds a file is held back.
+    """
+
+    def __init__(
+        self, window: float = DEFAULT_WINDOW, max_latency: float = DEFAULT_MAX_LATENCY
+    ) -> None:
+        """Create an empty coalescer."""
+        self.window = max(0.0, window)
+        self.max_latency = max(self.window, max_latency)
+        self._pending: Dict[str, _PendingFile] = {}
+
+    def __len__(self) -> int:
+        """Return the number of files held back."""
+        return len(self._pending)
+
+    def add(self, event: Dict[str, Any], now: Optional[float] = None) -> None:
+        """Hold back an event, merging it with the pending ones of its file."""
+        now = time.monotonic() if now is None else now
+        pending = self._pending.get(event["rel_path"])
+        if pending is None:
+            pending = self._pending[event["rel_path"]] = _PendingFile(now)
+        pending.last_seen = now
+        pending.events[event["location"].key] = event
+
+    def _due(self, pending: _PendingFile) -> float:
+        """Return when a file must be released."""
+        return min(
+            pending.last_seen + self.window, pending.first_seen + self.max_latency
+        )
+
+    def next_due(self) -> Optional[float]:
+        """Return the monotonic time the next file is released, if any."""
+        if not self._pending:
+            return None
+        return min(self._due(pending) for pending in self._pending.values())
+
+    def pop_due(self, now: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Release the events of every file that is due.
+
+        Returns:
+            The merged events, one per file and location.
+        """
+        now = time.monotonic() if now is None else now
+        events: List[Dict[str, Any]] = []
+        for rel_path in [
+            rel_path
+            for rel_path, pending in self._pending.items()
+            if self._due(pending) <= now
+        ]:
+            events.extend(self._pending.pop(rel_path).events.values())
+        return events
@@ -0,0 +1,309 @@
+from __future__ import annotations
+
+"""Rsync-style delta transfer: block signatures, rolling matches and deltas."""
+
+import hashlib
+import mmap
+import threading
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from snapshot import FileStat
+from transfer import Payload
+
+BLOCK_SIZE = 64 * 1024
+MIN_DELTA_SIZE = 1024 * 1024
+STRONG_SIZE = 16
+SIGNATURE_CACHE_SIZE = 1024
+
+# After this many unmatched blocks in a row the matcher rolls byte by byte
+# again, so long inserted regions do not hide the data that follows them.
+RESYNC_BLOCKS = 64
+
+_MOD = 65521
+
+Buffer = Union[bytes, mmap.mmap]
+
+
+def _strong(block: Buffer) -> bytes:
+    """Return the strong checksum of a block."""
+    return hashlib.blake2b(block, digest_size=STRONG_SIZE).digest()
+
+
+class Signature:
+    """Checksums of the fixed-size blocks of one version of a file.
+
+    Attributes:
+        block_size: The block size in bytes; the last block may be shorter.
+        size: The file size in bytes.
+        weak: The Adler-32 checksum of every block.
+        strong: The BLAKE2 digest of every block.
+    """
+
+    __slots__ = ("block_size", "size", "weak", "strong", "_lookup")
+
+    def __init__(
+        self, block_size: int, size: int, weak: List[int], strong: List[bytes]
+    ) -> None:
+        """Create a signature from its block checksums."""
+        self.block_size = block_size
+        self.size = size
+        self.weak = weak
+        self.strong = strong
+        self._lookup: Optional[Dict[int, List[int]]] = None
+
+    def lookup(self) -> Dict[int, List[int]]:
+        """Return the indexes of the full blocks, by weak checksum."""
+        if self._lookup is None:
+            table: Dict[int, List[int]] = {}
+            for index in range(self.size // self.block_size):
+                table.setdefault(self.weak[index], []).append(index)
+            self._lookup = table
+        return self._lookup
+
+    @property
+    def tail(self) -> int:
+        """The length of the last, partial block (0 if there is none)."""
+        return self.size % self.block_size
+
+
+class Segment(NamedTuple):
+    """A run of bytes of the new version of a file.
+
+    Attributes:
+        offset: Where the run starts in the new version.
+        length: The run length in bytes.
+        base: Where the same bytes start in the old version, or -1 when they
+            must be sent.
+    """
+
+    offset: int
+    length: int
+    base: int = -1
+
+
+class Delta:
+    """The difference between the old and the new version of a file.
+
+    Attributes:
+        size: The size of the new version.
+        base_size: The size of the old version.
+        segments: Runs covering the new version in order.
+    """
+
+    __slots__ = ("size", "base_size", "segments")
+
+    def __init__(self, size: int, base_size: int, segments: List[Segment]) -> None:
+        """Create a delta."""
+        self.size = size
+        self.base_size = base_size
+        self.segments = segments
+
+    @property
+    def literal_bytes(self) -> int:
+        """The number of bytes that are not in the old version."""
+        return sum(seg.length for seg in self.segments if seg.base < 0)
+
+    @property
+    def in_place(self) -> bool:
+        """Whether every unchanged run sits at the same offset in both versions.
+
+        Such a delta can be applied by overwriting only the literal runs.
+        """
+        return all(seg.base in (-1, seg.offset) for seg in self.segments)
+
+    @property
+    def is_append(self) -> bool:
+        """Whether the new version is the old one with bytes added at the end."""
+        if self.size < self.base_size or not self.in_place:
+            return False
+        return all(
+            seg.base >= 0 for seg in self.segments if seg.offset < self.base_size
+        )
+
+
+@contextmanager
+def open_buffer(payload: Payload) -> Iterator[Buffer]:
+    """Map a payload into memory (read-only) for random access.
+
+    Local payloads are memory-mapped; the others are small in-memory
+    buffers and are read as a whole.
+    """
+    if payload.local_path is None or payload.size == 0:
+        with payload.open() as file_obj:
+            yield file_obj.read()
+        return
+
+    with open(payload.local_path, "rb") as file_obj:
+        buffer = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield buffer
+        finally:
+            buffer.close()
+
+
+def signature_of(payload: Payload, block_size: int = BLOCK_SIZE) -> Signature:
+    """Return the block signature of a payload."""
+    weak: List[int] = []
+    strong: List[bytes] = []
+    with open_buffer(payload) as data:
+        size = len(data)
+        for start in range(0, size, block_size):
+            block = data[start : start + block_size]
+            weak.append(zlib.adler32(block))
+            strong.append(_strong(block))
+    return Signature(block_size, size, weak, strong)
+
+
+def _match(base: Signature, data: Buffer, pos: int, weak: int) -> int:
+    """Return the index of the full base block at ``pos`` (matching ``weak``)."""
+    candidates = base.lookup().get(weak)
+    if not candidates:
+        return -1
+    strong = _strong(data[pos : pos + base.block_size])
+    for index in candidates:
+        if base.strong[index] == strong:
+            return index
+    return -1
+
+
+def _roll(base: Signature, data: Buffer, pos: int, limit: int) -> Tuple[int, int]:
+    """Slide a block-sized window from ``pos`` looking for a base block.
+
+    The Adler-32 sums are updated one byte at a time rather than recomputed.
+
+    Returns:
+        (position, block index) of the first match starting before ``limit``,
+        or (-1, -1).
+    """
+    size = base.block_size
+    lookup = base.lookup()
+    checksum = zlib.adler32(data[pos : pos + size])
+    a, b = checksum & 0xFFFF, checksum >> 16
+    last = min(limit, len(data) - size)
+
+    while pos < last:
+        out_byte, in_byte = data[pos], data[pos + size]
+        a = (a - out_byte + in_byte) % _MOD
+        b = (b - size * out_byte + a - 1) % _MOD
+        pos += 1
+        if (b << 16 | a) in lookup:
+            index = _match(base, data, pos, b << 16 | a)
+            if index >= 0:
+                return pos, index
+    return -1, -1
+
+
+def compute(base: Signature, payload: Payload) -> Delta:
+    """Compute the delta turning the version described by ``base`` into ``payload``.
+
+    Blocks are first looked up where they would be if nothing moved. When
+    that fails right after a match, a window rolls byte by byte for up to
+    two blocks, which finds the old data again after insertions and
+    deletions shorter than a block; otherwise matching resumes at the next
+    block.
+    """
+    size = base.block_size
+    segments: List[Segment] = []
+
+    def add(offset: int, length: int, base_offset: int = -1) -> None:
+        if length <= 0:
+            return
+        if segments:
+            last = segments[-1]
+            contiguous = last.offset + last.length == offset
+            if contiguous and base_offset < 0 and last.base < 0:
+                segments[-1] = last._replace(length=last.length + length)
+                return
+            if (
+                contiguous
+                and base_offset >= 0
+                and last.base >= 0
+                and last.base + last.length == base_offset
+            ):
+                segments[-1] = last._replace(length=last.length + length)
+                return
+        segments.append(Segment(offset, length, base_offset))
+
+    with open_buffer(payload) as data:
+        total = len(data)
+        pos = 0
+        literal = 0
+        misses = 0
+        tail_start = base.size - base.tail
+
+        while pos < total:
+            if pos + size <= total:
+                index = _match(base, data, pos, zlib.adler32(data[pos : pos + size]))
+            else:
+                index = -1
+
+            if index < 0 and base.tail and pos + base.tail <= total:
+                if _strong(data[pos : pos + base.tail]) == base.strong[-1]:
+                    add(literal, pos - literal)
+                    add(pos, base.tail, tail_start)
+                    pos += base.tail
+                    literal = pos
+                    misses = 0
+                    continue
+
+            if index >= 0:
+                add(literal, pos - literal)
+                add(pos, size, index * size)
+                pos += size
+                literal = pos
+                misses = 0
+                continue
+
+            if misses % RESYNC_BLOCKS == 0 and pos + size < total:
+                found, index = _roll(base, data, pos, pos + 2 * size)
+                if found >= 0:
+                    add(literal, found - literal)
+                    add(found, size, index * size)
+                    pos = found + size
+                    literal = pos
+                    misses = 0
+                    continue
+            pos = min(pos + size, total)
+            misses += 1
+
+        add(literal, total - literal)
+
+    return Delta(total, base.size, segments)
+
+
+class SignatureCache:
+    """Recently seen block signatures, by location and file.
+
+    A signature is only returned while the file still has the metadata it
+    was recorded with, so stale entries are never used.
+    """
+
+    def __init__(self, max_entries: int = SIGNATURE_CACHE_SIZE) -> None:
+        """Create an empty cache holding up to ``max_entries`` signatures."""
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[FileStat, Signature]]" = (
+            OrderedDict()
+        )
+
+    def get(self, location: str, rel_path: str, stat: FileStat) -> Optional[Signature]:
+        """Return the signature of a file if it was recorded at ``stat``."""
+        with self._lock:
+            entry = self._entries.get((location, rel_path))
+            if entry is None or entry[0] != stat:
+                return None
+            self._entries.move_to_end((location, rel_path))
+            return entry[1]
+
+    def put(
+        self, location: str, rel_path: str, stat: FileStat, signature: Signature
+    ) -> None:
+        """Record the signature of a file with its current metadata."""
+        with self._lock:
+            self._entries[(location, rel_path)] = (stat, signature)
+            self._entries.move_to_end((location, rel_path))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
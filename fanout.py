@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+"""A shared worker pool that caps how many tasks run per location."""
+
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Tuple
+
+DEFAULT_WORKERS = 8
+DEFAULT_PER_LOCATION = 2
+
+
+class LocationExecutor:
+    """Runs tasks concurrently, with at most ``per_location`` per location.
+
+    Tasks over a location's limit wait in a per-location queue instead of
+    occupying a worker, so a slow destination never holds up the workers
+    that fast destinations could use.
+    """
+
+    def __init__(
+        self,
+        workers: int = DEFAULT_WORKERS,
+        per_location: int = DEFAULT_PER_LOCATION,
+    ) -> None:
+        """Create the executor.
+
+        Args:
+            workers: Total number of worker threads.
+            per_location: Maximum concurrent tasks for one location.
+        """
+        self.per_location = max(1, per_location)
+        self._pool = ThreadPoolExecutor(
+            max_workers=max(1, workers), thread_name_prefix="fanout"
+        )
+        self._lock = threading.Lock()
+        self._running: Dict[str, int] = defaultdict(int)
+        self._waiting: Dict[str, Deque[Tuple[Callable[[], Any], Future]]] = (
+            defaultdict(deque)
+        )
+
+    def submit(self, location: str, fn: Callable[[], Any]) -> "Future[Any]":
+        """Schedule ``fn`` for ``location``.
+
+        Args:
+            location: The key of the location the task works on.
+            fn: The task.
+
+        Returns:
+            A future resolved with the task's result or exception.
+        """
+        future: "Future[Any]" = Future()
+        with self._lock:
+            if self._running[location] < self.per_location:
+                self._running[location] += 1
+                self._pool.submit(self._run, location, fn, future)
+            else:
+                self._waiting[location].append((fn, future))
+        return future
+
+    def _run(
+        self, location: str, fn: Callable[[], Any], future: "Future[Any]"
+    ) -> None:
+        """Run one task, then start the next one waiting for its location."""
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn())
+                except BaseException as exc:
+                    future.set_exception(exc)
+        finally:
+            with self._lock:
+                waiting = self._waiting[location]
+                if waiting:
+                    next_fn, next_future = waiting.popleft()
+                    self._pool.submit(self._run, location, next_fn, next_future)
+                else:
+                    self._running[location] -= 1
+
+    def shutdown(self) -> None:
+        """Stop accepting work and wait for running tasks."""
+        self._pool.shutdown(wait=True)
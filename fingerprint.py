@@ -0,0 +1,28 @@
+from __future__ import annotations
+
+"""Content fingerprints used to detect files that are already identical."""
+
+import hashlib
+from typing import BinaryIO
+
+HASH_CHUNK_SIZE = 1024 * 1024
+DIGEST_SIZE = 16
+
+
+def digest_stream(file_obj: BinaryIO, chunk_size: int = HASH_CHUNK_SIZE) -> str:
+    """Return the fingerprint of a binary stream, read in chunks.
+
+    Args:
+        file_obj: The stream to hash, positioned at its start.
+        chunk_size: Number of bytes read at a time.
+
+    Returns:
+        The hex BLAKE2b digest of the content.
+    """
+    hasher = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    while True:
+        chunk = file_obj.read(chunk_size)
+        if not chunk:
+            break
+        hasher.update(chunk)
+    return hasher.hexdigest()
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+"""Fast recursive folder scans built on os.scandir."""
+
+import os
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Tuple, Union
+
+from path_utilities import is_staging_name
+from snapshot import FileStat, Snapshot
+
+# A directory listing is only reused when the directory's mtime is older than
+# this, so that changes made within the filesystem's timestamp granularity
+# right after a scan are never missed.
+RACY_SECONDS = 2.0
+
+# Stat'ing names relative to an open directory avoids resolving the full path
+# for every file.
+_STAT_DIR_FD = os.stat in os.supports_dir_fd
+_O_DIRECTORY = getattr(os, "O_DIRECTORY", 0)
+
+
+class _DirListing(NamedTuple):
+    """Cached names found in one directory."""
+
+    mtime_ns: int
+    files: Tuple[str, ...]
+    dirs: Tuple[str, ...]
+
+
+class FolderScanner:
+    """Scans a folder tree, remembering directory listings between scans.
+
+    A directory's mtime only changes when entries are added, removed or
+    renamed, so an unchanged directory is not read again: its cached file
+    names are stat'ed directly. File stats are always refreshed, because
+    in-place writes do not touch the directory mtime.
+    """
+
+    def __init__(self, root: Any) -> None:
+        """Create a scanner for the folder at ``root``."""
+        self.root = os.fspath(root)
+        self._listings: Dict[str, _DirListing] = {}
+
+    def scan(self) -> Snapshot:
+        """Return a snapshot of every file below the root."""
+        entries: Snapshot = {}
+        listings: Dict[str, _DirListing] = {}
+        racy_ns = time.time_ns() - int(RACY_SECONDS * 1e9)
+
+        self._scan_dir("", self.root, entries, listings, racy_ns)
+        self._listings = listings
+        return entries
+
+    def _scan_dir(
+        self,
+        rel_dir: str,
+        full_dir: str,
+        entries: Snapshot,
+        listings: Dict[str, _DirListing],
+        racy_ns: int,
+    ) -> None:
+        """Add the files of one directory, then recurse into subdirectories."""
+        try:
+            dir_mtime_ns = os.stat(full_dir).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            return
+
+        prefix = rel_dir + os.sep if rel_dir else ""
+        cached = self._listings.get(rel_dir)
+
+        if cached is not None and cached.mtime_ns == dir_mtime_ns:
+            files, dirs = cached.files, cached.dirs
+            self._stat_names(full_dir, prefix, files, entries)
+        else:
+            file_names: List[str] = []
+            dir_names: List[str] = []
+            try:
+                with os.scandir(full_dir) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir():
+                                # Like os.walk, symlinked directories are
+                                # not followed.
+                                if not entry.is_symlink():
+                                    dir_names.append(entry.name)
+                                continue
+                            st = entry.stat()
+                        except (FileNotFoundError, NotADirectoryError):
+                            continue
+                        if is_staging_name(entry.name):
+                            continue
+                        file_names.append(entry.name)
+                        entries[prefix + entry.name] = FileStat(
+                            st.st_mtime, st.st_size
+                        )
+            except (FileNotFoundError, NotADirectoryError):
+                return
+            files, dirs = tuple(file_names), tuple(dir_names)
+
+        if dir_mtime_ns < racy_ns:
+            listings[rel_dir] = _DirListing(dir_mtime_ns, files, dirs)
+
+        for name in dirs:
+            self._scan_dir(
+                prefix + name, os.path.join(full_dir, name), entries, listings, racy_ns
+            )
+
+    @staticmethod
+    def _stat_names(
+        full_dir: str, prefix: str, names: Tuple[str, ...], entries: Snapshot
+    ) -> None:
+        """Stat known file names of one directory without listing it."""
+        dir_fd = -1
+        if _STAT_DIR_FD:
+            try:
+                dir_fd = os.open(full_dir, os.O_RDONLY | _O_DIRECTORY)
+            except OSError:
+                dir_fd = -1
+
+        try:
+            for name in names:
+                try:
+                    if dir_fd >= 0:
+                        st = os.stat(name, dir_fd=dir_fd)
+                    else:
+                        st = os.stat(os.path.join(full_dir, name))
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                entries[prefix + name] = FileStat(st.st_mtime, st.st_size)
+        finally:
+            if dir_fd >= 0:
+                os.close(dir_fd)
+
+
+_scanners: Dict[str, FolderScanner] = {}
+_scanners_lock = threading.Lock()
+
+
+def get_scanner(root: Union[str, "os.PathLike[str]"]) -> FolderScanner:
+    """Return the scanner for a folder location, creating it on first use.
+
+    Args:
+        root: The folder of the location.
+
+    Returns:
+        The scanner holding that location's cached directory listings.
+    """
+    key = os.fspath(root)
+    with _scanners_lock:
+        scanner = _scanners.get(key)
+        if scanner is None:
+            scanner = FolderScanner(root)
+            _scanners[key] = scanner
+    return scanner
@@ -0,0 +1,310 @@
+from __future__ import annotations
+
+"""Atomic, durable writes into local folders.
+
+Every file is written to a hidden staging file in its target's directory
+and renamed over the target, so readers (including the folder's own
+watcher) only ever see complete files. How much is flushed to disk is set
+with :func:`configure`.
+"""
+
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import delta
+import transfer
+from batch import Batch
+from logger import log_err
+from path_utilities import STAGING_SUFFIX
+from transfer import Payload
+
+FSYNC_MODES = ("file", "batch", "none")
+DEFAULT_FSYNC = "batch"
+
+_settings: Dict[str, str] = {"fsync": DEFAULT_FSYNC}
+
+# mkstemp creates private files; new copies get the usual umask-based mode.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def configure(fsync: str = DEFAULT_FSYNC) -> None:
+    """Set how writes are flushed to disk.
+
+    Args:
+        fsync: ``file`` to fsync every file and its directory as it is
+            renamed into place, ``batch`` to fsync every file but each
+            changed directory only once per batch, or ``none`` to leave
+            flushing to the operating system.
+
+    Raises:
+        ValueError: If ``fsync`` is not one of :data:`FSYNC_MODES`.
+    """
+    if fsync not in FSYNC_MODES:
+        raise ValueError(f"Unknown fsync mode: {fsync}")
+    _settings["fsync"] = fsync
+
+
+def stage(dest: str, payload: Payload, mtime: Optional[float] = None) -> str:
+    """Write a payload to a new staging file next to ``dest``.
+
+    Args:
+        dest: The file the payload is meant for; its folders are created.
+        payload: The contents.
+        mtime: The modification time to give the file, if any.
+
+    Returns:
+        The path of the staging file, to be passed to :func:`commit`.
+    """
+    with _staging_file(dest) as (staged, file_obj):
+        transfer.copy_payload_to_file(payload, file_obj)
+        _finish(file_obj, mtime)
+    return staged
+
+
+def stage_patch(
+    dest: str, payload: Payload, change: delta.Delta, mtime: Optional[float] = None
+) -> str:
+    """Stage a copy of ``dest`` with the literal runs of an in-place delta.
+
+    The current file is cloned in the kernel (a reflink on filesystems that
+    support it) and only the changed runs are written over the clone.
+
+    Args:
+        dest: The current version, which ``change`` was computed against.
+        payload: The new version, read for the literal runs.
+        change: A delta whose matched blocks did not move.
+        mtime: The modification time to give the file, if any.
+
+    Returns:
+        The path of the staging file, to be passed to :func:`commit`.
+    """
+    with _staging_file(dest) as (staged, file_obj):
+        transfer.copy_payload_to_file(Payload.from_file(dest), file_obj)
+        with payload.open() as src:
+            for seg in change.segments:
+                if seg.base >= 0:
+                    continue
+                src.seek(seg.offset)
+                file_obj.seek(seg.offset)
+                remaining = seg.length
+                while remaining > 0:
+                    chunk = src.read(min(transfer.CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    file_obj.write(chunk)
+                    remaining -= len(chunk)
+        file_obj.truncate(change.size)
+        _finish(file_obj, mtime)
+    return staged
+
+
+@contextmanager
+def _staging_file(dest: str) -> Iterator[Tuple[str, BinaryIO]]:
+    """Create a staging file next to ``dest``, removed again on failure.
+
+    Yields:
+        The staging file's path and the file, open for reading and writing.
+    """
+    folder = os.path.dirname(dest)
+    os.makedirs(folder, exist_ok=True)
+    fd, staged = tempfile.mkstemp(
+        prefix=f".{os.path.basename(dest)}.", suffix=STAGING_SUFFIX, dir=folder
+    )
+    try:
+        try:
+            mode = os.stat(dest).st_mode & 0o7777
+        except OSError:
+            mode = 0o666 & ~_UMASK
+        if hasattr(os, "fchmod"):
+            os.fchmod(fd, mode)
+        with os.fdopen(fd, "r+b") as file_obj:
+            yield staged, file_obj
+    except BaseException:
+        remove_quietly(staged)
+        raise
+
+
+def _finish(file_obj: BinaryIO, mtime: Optional[float]) -> None:
+    """Flush a staging file and give it its modification time."""
+    file_obj.flush()
+    if mtime is not None:
+        if os.utime in os.supports_fd:
+            os.utime(file_obj.fileno(), (mtime, mtime))
+        else:
+            os.utime(file_obj.name, (mtime, mtime))
+    if _settings["fsync"] != "none":
+        os.fsync(file_obj.fileno())
+
+
+def commit(staged: str, dest: str) -> None:
+    """Rename a staging file over ``dest``."""
+    os.replace(staged, dest)
+    if _settings["fsync"] == "file":
+        fsync_dir(os.path.dirname(dest))
+
+
+def sync_dirs(folders: Iterable[str]) -> None:
+    """Flush the entries of the directories a batch changed, once each."""
+    if _settings["fsync"] == "none":
+        return
+    for folder in folders:
+        fsync_dir(folder)
+
+
+def write(dest: str, payload: Payload, mtime: Optional[float] = None) -> None:
+    """Replace ``dest`` with a payload atomically."""
+    staged = stage(dest, payload, mtime)
+    try:
+        commit(staged, dest)
+    except BaseException:
+        remove_quietly(staged)
+        raise
+    sync_dirs([os.path.dirname(dest)])
+
+
+def remove_quietly(path: str) -> None:
+    """Remove a file, ignoring errors."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def fsync_dir(path: str) -> None:
+    """Flush a directory's entries to disk, where the platform allows it."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class FolderBatch(Batch):
+    """Stages folder writes next to their targets and renames them into place.
+
+    A write is copied into a staging file as soon as it is queued, so copies
+    still run concurrently and no payload is held until the batch is
+    applied. Applying the batch renames the staged files over their
+    targets and removes the deleted files. Every target is first linked to a
+    hidden backup name (deleted files are moved there), so if any change
+    fails the backups are put back in reverse order, the new files are
+    removed and the folder is left as it was.
+
+    Attributes:
+        root: The folder written to.
+    """
+
+    def __init__(self, root: str) -> None:
+        """Create an empty batch for ``root``."""
+        super().__init__()
+        self.root = root
+        self._staged: Dict[str, Tuple[str, int]] = {}
+
+    def write(self, name: str, payload: Payload, mtime: Optional[float] = None) -> None:
+        """Copy ``payload`` into a staging file for ``name``."""
+        staged = stage(os.path.join(self.root, name), payload, mtime)
+        with self._lock:
+            self.deletes.discard(name)
+            previous = self._staged.get(name)
+            self._staged[name] = (staged, payload.size)
+        if previous is not None:
+            remove_quietly(previous[0])
+
+    def delete(self, name: str) -> None:
+        """Queue ``name`` for removal, dropping any staged write of it."""
+        with self._lock:
+            previous = self._staged.pop(name, None)
+            self.deletes.add(name)
+        if previous is not None:
+            remove_quietly(previous[0])
+
+    def apply(self) -> None:
+        """Rename the staged files into place and remove the deleted ones."""
+        with self._lock:
+            staged, self._staged = self._staged, {}
+            deletes, self.deletes = self.deletes, set()
+
+        folders: Set[str] = set()
+        # Every target changed so far, with its backup (None if it is new).
+        changed: List[Tuple[str, Optional[str]]] = []
+        try:
+            for name, (staged_path, _) in staged.items():
+                dest = os.path.join(self.root, name)
+                changed.append((dest, _backup(dest, keep=True)))
+                commit(staged_path, dest)
+                folders.add(os.path.dirname(dest))
+            for name in deletes:
+                full_path = os.path.join(self.root, name)
+                backup = _backup(full_path, keep=False)
+                if backup is not None:
+                    changed.append((full_path, backup))
+                    folders.add(os.path.dirname(full_path))
+        except BaseException:
+            _restore(changed)
+            for staged_path, _ in staged.values():
+                remove_quietly(staged_path)
+            raise
+
+        for _, backup in changed:
+            if backup is not None:
+                remove_quietly(backup)
+        self.applied_bytes += sum(size for _, size in staged.values())
+        sync_dirs(folders)
+
+
+def _backup(path: str, keep: bool) -> Optional[str]:
+    """Save a file under a hidden name next to it, so a batch can restore it.
+
+    Args:
+        path: The file.
+        keep: Whether ``path`` stays in place (it is hard-linked, or copied
+            where links are not supported) rather than moved.
+
+    Returns:
+        The backup's path, or None if ``path`` does not exist.
+    """
+    if not os.path.lexists(path):
+        return None
+    fd, backup = tempfile.mkstemp(
+        prefix=f".{os.path.basename(path)}.",
+        suffix=STAGING_SUFFIX,
+        dir=os.path.dirname(path),
+    )
+    os.close(fd)
+    try:
+        if not keep:
+            os.replace(path, backup)
+            return backup
+        os.remove(backup)
+        try:
+            os.link(path, backup)
+        except OSError:
+            shutil.copy2(path, backup)
+    except BaseException:
+        remove_quietly(backup)
+        raise
+    return backup
+
+
+def _restore(changed: List[Tuple[str, Optional[str]]]) -> None:
+    """Undo the changes of a failed batch, latest first, logging failures."""
+    for path, backup in reversed(changed):
+        try:
+            if backup is None:
+                remove_quietly(path)
+            elif os.path.lexists(path) and os.path.samefile(backup, path):
+                # Never replaced; renaming a hard link onto itself is a no-op.
+                remove_quietly(backup)
+            else:
+                os.replace(backup, path)
+        except OSError as exc:
+            log_err(f"Could not restore {path} after a failed batch: {exc}")
@@ -0,0 +1,344 @@
+from __future__ import annotations
+
+"""Recursive FTP tree listing with as few round trips as the server allows."""
+
+import calendar
+import datetime
+import threading
+from ftplib import FTP, error_perm, error_reply
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from logger import log_info
+from path_utilities import is_staging_name
+from snapshot import FileStat, Snapshot
+
+STRATEGY_MLSD = "mlsd"
+STRATEGY_LIST = "list"
+
+_MONTHS = {name: index for index, name in enumerate(calendar.month_abbr) if name}
+
+# host -> the command setting mtimes there ("MFMT", "SITE UTIME", or "" if none)
+_mtime_commands: Dict[str, str] = {}
+_mtime_commands_lock = threading.Lock()
+
+
+def parse_mdtm_to_unix(ts: str) -> float:
+    """Parse an FTP MDTM/MLSD timestamp string into a Unix timestamp."""
+    if "." in ts:
+        dt = datetime.datetime.strptime(ts, "%Y%m%d%H%M%S.%f")
+    else:
+        dt = datetime.datetime.strptime(ts, "%Y%m%d%H%M%S")
+    dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+
+def format_mdtm(mtime: float) -> str:
+    """Format a Unix timestamp as an FTP timestamp (UTC, whole seconds)."""
+    dt = datetime.datetime.fromtimestamp(int(mtime), datetime.timezone.utc)
+    return dt.strftime("%Y%m%d%H%M%S")
+
+
+def parse_list_line(line: str) -> Optional[Tuple[str, str, int, str]]:
+    """Parse one Unix-style ``LIST`` line.
+
+    Args:
+        line: A line such as ``-rw-r--r-- 1 u g 12 Jan 01 12:34 name``.
+
+    Returns:
+        A tuple of (kind, name, size, timestamp text) where kind is the
+        first permission character, or None if the line is not understood.
+    """
+    parts = line.split(maxsplit=8)
+    if len(parts) != 9 or parts[5] not in _MONTHS:
+        return None
+
+    try:
+        size = int(parts[4])
+    except ValueError:
+        return None
+
+    return parts[0][:1], parts[8], size, " ".join(parts[5:8])
+
+
+def parse_list_timestamp(text: str, now: Optional[datetime.datetime] = None) -> float:
+    """Convert a ``LIST`` timestamp (``Jan 01 12:34`` or ``Jan 01 2023``).
+
+    Listings only carry minute (or day) precision and omit the year for
+    recent files, so the year is inferred the same way ``ls`` does it.
+
+    Args:
+        text: The month, day and time-or-year columns joined by spaces.
+        now: The reference time used to infer a missing year.
+
+    Returns:
+        The timestamp, interpreted as UTC.
+    """
+    month_name, day, time_or_year = text.split()
+    month = _MONTHS[month_name]
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+
+    if ":" in time_or_year:
+        hour, minute = (int(x) for x in time_or_year.split(":"))
+        dt = datetime.datetime(
+            now.year, month, int(day), hour, minute, tzinfo=datetime.timezone.utc
+        )
+        if dt > now + datetime.timedelta(days=1):
+            dt = dt.replace(year=now.year - 1)
+    else:
+        dt = datetime.datetime(
+            int(time_or_year), month, int(day), tzinfo=datetime.timezone.utc
+        )
+    return dt.timestamp()
+
+
+def server_feature_params(ftp: FTP) -> Dict[str, str]:
+    """Return the features advertised by ``FEAT`` with their parameters.
+
+    Returns:
+        The upper-cased feature names mapped to the rest of their line, e.g.
+        ``{"HASH": "SHA-256*;MD5", "MDTM": ""}``.
+    """
+    try:
+        resp = ftp.sendcmd("FEAT")
+    except (error_perm, error_reply):
+        return {}
+
+    features: Dict[str, str] = {}
+    for line in resp.splitlines()[1:-1]:
+        name, _, params = line.strip().partition(" ")
+        if name:
+            features[name.upper()] = params.strip()
+    return features
+
+
+def server_features(ftp: FTP) -> Set[str]:
+    """Return the upper-cased feature names advertised by ``FEAT``."""
+    return set(server_feature_params(ftp))
+
+
+def set_remote_mtime(ftp: FTP, host: str, remote_full: str, mtime: float) -> bool:
+    """Set the modification time of a remote file.
+
+    ``MFMT`` is used when the server advertises it, ``SITE UTIME`` otherwise.
+    The outcome is remembered per host, so a server supporting neither is
+    only asked once.
+
+    Args:
+        ftp: A logged-in session.
+        host: The server, used to remember its capability.
+        remote_full: The absolute remote path of the file.
+        mtime: The Unix timestamp to set.
+
+    Returns:
+        True if the server accepted the new time.
+    """
+    with _mtime_commands_lock:
+        command = _mtime_commands.get(host)
+    if command is None:
+        command = "MFMT" if "MFMT" in server_features(ftp) else "SITE UTIME"
+    if not command:
+        return False
+
+    try:
+        ftp.sendcmd(f"{command} {format_mdtm(mtime)} {remote_full}")
+    except (error_perm, error_reply) as exc:
+        if str(exc).startswith(("500", "501", "502", "504")):
+            log_info(f"{host} cannot set modification times ({exc})")
+            with _mtime_commands_lock:
+                _mtime_commands[host] = ""
+        return False
+
+    with _mtime_commands_lock:
+        _mtime_commands[host] = command
+    return True
+
+
+class FtpTreeLister:
+    """Lists a remote tree, returning names, sizes and mtimes.
+
+    ``MLSD`` is used when the server supports it, giving every fact in one
+    response per directory. Otherwise ``LIST`` is parsed and ``MDTM`` is only
+    sent for files whose listing line changed since the previous scan.
+
+    Attributes:
+        base_remote: The remote directory being listed.
+        strategy: The chosen strategy, or None until the first listing.
+    """
+
+    def __init__(self, base_remote: str) -> None:
+        """Create a lister for the tree rooted at ``base_remote``."""
+        self.base_remote = base_remote
+        self.strategy: Optional[str] = None
+        self.has_mdtm = False
+
+        # rel_path -> (size, LIST timestamp text, resolved mtime)
+        self._list_cache: Dict[str, Tuple[int, str, float]] = {}
+
+    def list_tree(self, ftp: FTP) -> Snapshot:
+        """List every file below the base directory.
+
+        Args:
+            ftp: A logged-in session.
+
+        Returns:
+            A snapshot keyed by path relative to the base directory.
+        """
+        if self.strategy is None:
+            self._detect(ftp)
+
+        entries: Snapshot = {}
+        if self.strategy == STRATEGY_MLSD:
+            try:
+                self._walk_mlsd(ftp, self.base_remote, entries)
+                return entries
+            except error_perm as exc:
+                if not str(exc).startswith(("500", "502")):
+                    raise
+                log_info(f"Server rejected MLSD ({exc}), falling back to LIST")
+                self.strategy = STRATEGY_LIST
+                entries = {}
+
+        self._walk_list(ftp, self.base_remote, entries)
+        self._list_cache = {
+            rel_path: value
+            for rel_path, value in self._list_cache.items()
+            if rel_path in entries
+        }
+        return entries
+
+    def _detect(self, ftp: FTP) -> None:
+        """Pick a listing strategy from the server's ``FEAT`` reply."""
+        features = server_features(ftp)
+        self.has_mdtm = "MDTM" in features or not features
+        self.strategy = STRATEGY_MLSD if "MLST" in features else STRATEGY_LIST
+
+    def _rel(self, item_path: str) -> str:
+        """Return ``item_path`` relative to the base directory."""
+        return item_path[len(self.base_remote) :].lstrip("/")
+
+    def _walk_mlsd(self, ftp: FTP, current: str, entries: Snapshot) -> None:
+        """Collect files below ``current`` using ``MLSD``."""
+        listing: List[Tuple[str, Dict[str, Any]]] = list(ftp.mlsd(current))
+
+        for name, facts in listing:
+            kind = facts.get("type", "").lower()
+            item_path = current.rstrip("/") + "/" + name
+
+            if kind == "dir":
+                self._walk_mlsd(ftp, item_path, entries)
+            elif is_staging_name(name):
+                continue
+            elif kind == "file" and "modify" in facts:
+                size = int(facts.get("size", facts.get("sizd", -1)))
+                entries[self._rel(item_path)] = FileStat(
+                    parse_mdtm_to_unix(facts["modify"]), size
+                )
+
+    def _walk_list(self, ftp: FTP, current: str, entries: Snapshot) -> None:
+        """Collect files below ``current`` using ``LIST`` (+ ``MDTM``)."""
+        lines: List[str] = []
+        ftp.retrlines("LIST " + current, lines.append)
+
+        for line in lines:
+            parsed = parse_list_line(line)
+            if parsed is None:
+                continue
+
+            kind, name, size, stamp = parsed
+            item_path = current.rstrip("/") + "/" + name
+
+            if kind == "d":
+                if name not in (".", ".."):
+                    self._walk_list(ftp, item_path, entries)
+                continue
+            if kind != "-" or is_staging_name(name):
+                continue
+
+            rel_path = self._rel(item_path)
+            cached = self._list_cache.get(rel_path)
+            if cached is not None and cached[0] == size and cached[1] == stamp:
+                entries[rel_path] = FileStat(cached[2], size)
+                continue
+
+            mtime = self._mdtm(ftp, item_path) if self.has_mdtm else None
+            if mtime is None:
+                mtime = parse_list_timestamp(stamp)
+
+            self._list_cache[rel_path] = (size, stamp, mtime)
+            entries[rel_path] = FileStat(mtime, size)
+
+    def stat(self, ftp: FTP, rel_path: str) -> Optional[FileStat]:
+        """Return the metadata of a single remote file.
+
+        Uses one ``MLST`` when the server supports it, otherwise ``MDTM`` and
+        ``SIZE``.
+
+        Args:
+            ftp: A logged-in session.
+            rel_path: The file path relative to the base directory.
+
+        Returns:
+            The file's metadata, or None if it cannot be determined.
+        """
+        if self.strategy is None:
+            self._detect(ftp)
+
+        item_path = self.base_remote.rstrip("/") + "/" + rel_path.replace("\\", "/")
+        if self.strategy == STRATEGY_MLSD:
+            try:
+                resp = ftp.sendcmd("MLST " + item_path)
+            except (error_perm, error_reply):
+                return None
+            for line in resp.splitlines()[1:-1]:
+                facts_text = line.strip().split(" ", 1)[0]
+                facts = dict(
+                    fact.split("=", 1) for fact in facts_text.split(";") if "=" in fact
+                )
+                facts = {key.lower(): value for key, value in facts.items()}
+                if "modify" in facts:
+                    return FileStat(
+                        parse_mdtm_to_unix(facts["modify"]),
+                        int(facts.get("size", -1)),
+                    )
+            return None
+
+        mtime = self._mdtm(ftp, item_path)
+        if mtime is None:
+            return None
+        try:
+            size = ftp.size(item_path)
+        except (error_perm, error_reply):
+            size = None
+        return FileStat(mtime, size if size is not None else -1)
+
+    def _mdtm(self, ftp: FTP, item_path: str) -> Optional[float]:
+        """Return the precise mtime of a file, or None if unavailable."""
+        try:
+            resp = ftp.sendcmd("MDTM " + item_path)
+            return parse_mdtm_to_unix(resp.split()[1])
+        except (error_perm, error_reply, ValueError, IndexError):
+            return None
+
+
+_listers: Dict[Tuple[str, str, str], FtpTreeLister] = {}
+_listers_lock = threading.Lock()
+
+
+def get_lister(host: str, username: str, base_remote: str) -> FtpTreeLister:
+    """Return the lister for an FTP location, creating it on first use.
+
+    Args:
+        host: The server host name.
+        username: The login user.
+        base_remote: The remote directory of the location.
+
+    Returns:
+        The lister that remembers the strategy and cache of that location.
+    """
+    key = (host, username, base_remote)
+    with _listers_lock:
+        lister = _listers.get(key)
+        if lister is None:
+            lister = FtpTreeLister(base_remote)
+            _listers[key] = lister
+    return lister
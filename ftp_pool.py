@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+"""Pooled, persistent FTP sessions shared by the watcher and sync threads."""
+
+import threading
+import time
+from contextlib import contextmanager
+from ftplib import FTP, all_errors, error_temp
+from typing import Callable, Dict, Iterator, List, Tuple, TypeVar
+
+import metrics
+from logger import log_err, log_info
+
+T = TypeVar("T")
+
+DEFAULT_MAX_SIZE = 4
+DEFAULT_KEEPALIVE = 30.0
+DEFAULT_TIMEOUT = 30.0
+
+# Errors after which a session can no longer be trusted and must be dropped.
+CONNECTION_ERRORS = (OSError, EOFError, error_temp)
+
+
+class CountingFTP(FTP):
+    """An FTP session that counts the commands it sends, one per round trip."""
+
+    def putcmd(self, line: str) -> None:
+        """Send a command line, counting it against the server."""
+        metrics.FTP_COMMANDS.inc(host=self.host)
+        super().putcmd(line)
+
+
+class FtpPool:
+    """A bounded pool of logged-in FTP sessions for a single server account.
+
+    Sessions are handed out with :meth:`session` and returned to the pool
+    afterwards, so consecutive operations reuse the same TCP connection and
+    login instead of paying for a full handshake each time.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        username: str,
+        password: str,
+        max_size: int = DEFAULT_MAX_SIZE,
+        keepalive: float = DEFAULT_KEEPALIVE,
+        timeout: float = DEFAULT_TIMEOUT,
+    ) -> None:
+        """Create an empty pool.
+
+        Args:
+            host: The FTP server host name.
+            username: The login user name.
+            password: The login password.
+            max_size: Maximum number of sessions open at the same time.
+            keepalive: Idle seconds after which a session is probed with NOOP.
+            timeout: Socket timeout for new connections.
+        """
+        self.host = host
+        self.username = username
+        self.password = password
+        self.max_size = max(1, max_size)
+        self.keepalive = keepalive
+        self.timeout = timeout
+
+        self._idle: List[Tuple[FTP, float]] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_size)
+
+    def _connect(self) -> FTP:
+        """Open and log in a brand new session."""
+        ftp = CountingFTP(timeout=self.timeout)
+        ftp.connect(self.host)
+        ftp.login(self.username, self.password)
+        return ftp
+
+    def _checkout(self) -> FTP:
+        """Return a live session, reusing an idle one when possible."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                ftp, last_used = self._idle.pop()
+
+            if time.monotonic() - last_used < self.keepalive:
+                return ftp
+
+            try:
+                ftp.voidcmd("NOOP")
+                return ftp
+            except all_errors:
+                self._discard(ftp)
+
+        return self._connect()
+
+    def _checkin(self, ftp: FTP) -> None:
+        """Return a healthy session to the idle list."""
+        with self._lock:
+            self._idle.append((ftp, time.monotonic()))
+
+    @staticmethod
+    def _discard(ftp: FTP) -> None:
+        """Close a session without raising."""
+        try:
+            ftp.close()
+        except all_errors:
+            pass
+
+    @contextmanager
+    def session(self) -> Iterator[FTP]:
+        """Borrow a session for the duration of a ``with`` block.
+
+        Blocks while ``max_size`` sessions are already in use. Sessions that
+        fail with a connection error are dropped instead of being returned.
+
+        Yields:
+            A logged-in FTP session.
+        """
+        self._slots.acquire()
+        ftp: FTP | None = None
+        try:
+            ftp = self._checkout()
+            yield ftp
+        except CONNECTION_ERRORS:
+            if ftp is not None:
+                self._discard(ftp)
+                ftp = None
+            raise
+        except all_errors:
+            # Protocol-level replies (e.g. 550) leave the session usable.
+            raise
+        except BaseException:
+            # Unknown state (e.g. interrupted mid-transfer): do not reuse.
+            if ftp is not None:
+                self._discard(ftp)
+                ftp = None
+            raise
+        finally:
+            if ftp is not None:
+                self._checkin(ftp)
+            self._slots.release()
+
+    def call(self, fn: Callable[[FTP], T], retries: int = 1) -> T:
+        """Run ``fn`` with a pooled session, reconnecting on connection loss.
+
+        Args:
+            fn: The operation to run; receives a logged-in session.
+            retries: How many times to retry on a fresh connection.
+
+        Returns:
+            Whatever ``fn`` returns.
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.session() as ftp:
+                    return fn(ftp)
+            except CONNECTION_ERRORS as exc:
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                log_err(f"FTP connection to {self.host} lost ({exc}), reconnecting")
+
+    def ping_idle(self) -> None:
+        """Send NOOP on idle sessions so the server does not time them out."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        now = time.monotonic()
+        alive: List[Tuple[FTP, float]] = []
+        for ftp, last_used in idle:
+            if now - last_used < self.keepalive:
+                alive.append((ftp, last_used))
+                continue
+            try:
+                ftp.voidcmd("NOOP")
+                alive.append((ftp, now))
+            except all_errors:
+                self._discard(ftp)
+
+        with self._lock:
+            self._idle.extend(alive)
+
+    def close(self) -> None:
+        """Log out and close every idle session."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for ftp, _ in idle:
+            try:
+                ftp.quit()
+            except all_errors:
+                self._discard(ftp)
+
+
+_pools: Dict[Tuple[str, str, str], FtpPool] = {}
+_pools_lock = threading.Lock()
+_settings: Dict[str, float] = {
+    "max_size": DEFAULT_MAX_SIZE,
+    "keepalive": DEFAULT_KEEPALIVE,
+}
+_keepalive_thread: threading.Thread | None = None
+
+
+def configure(
+    max_size: int = DEFAULT_MAX_SIZE, keepalive: float = DEFAULT_KEEPALIVE
+) -> None:
+    """Set the parameters used for pools created from now on.
+
+    Args:
+        max_size: Maximum number of concurrent sessions per location.
+        keepalive: Idle seconds between NOOP keepalives.
+    """
+    _settings["max_size"] = max_size
+    _settings["keepalive"] = keepalive
+
+
+def get_pool(host: str, username: str, password: str) -> FtpPool:
+    """Return the shared pool for an FTP account, creating it on first use.
+
+    Args:
+        host: The server host name.
+        username: The login user.
+        password: The login password.
+
+    Returns:
+        The pool serving that server account.
+    """
+    global _keepalive_thread
+
+    key = (host, username, password)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = FtpPool(
+                host,
+                username,
+                password,
+                max_size=int(_settings["max_size"]),
+                keepalive=_settings["keepalive"],
+            )
+            _pools[key] = pool
+            log_info(f"Created FTP connection pool for {host}")
+
+        if _keepalive_thread is None:
+            _keepalive_thread = threading.Thread(target=_keepalive_loop, daemon=True)
+            _keepalive_thread.start()
+
+    return pool
+
+
+def close_all() -> None:
+    """Close the idle sessions of every pool."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
+
+
+def _keepalive_loop() -> None:
+    """Periodically ping idle sessions of every pool."""
+    while True:
+        time.sleep(max(1.0, _settings["keepalive"] / 2))
+        with _pools_lock:
+            pools = list(_pools.values())
+        for pool in pools:
+            pool.ping_idle()
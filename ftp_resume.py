@@ -0,0 +1,437 @@
+from __future__ import annotations
+
+"""Resumable FTP transfers: restart offsets, persistent partial state, checks.
+
+Large downloads are written to a partial file under ``<state dir>/partial``
+and continue from its size after a dropped connection, or after a restart
+when the remote file did not change; a verified download is moved to a
+file of its own, so the next version never overwrites it. Large uploads
+continue from the size the server reports, but only once the server
+accepted this very upload: the offset it confirmed is recorded in the state
+file, so bytes of an older file already at the destination are never taken
+for uploaded ones. A JSON state file next to the partial data names the
+exact version being transferred so a resume never mixes two versions.
+Finished transfers are checked by size and, when the server supports the
+``HASH`` command, by SHA-256.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from ftplib import FTP, error_perm, error_reply
+from typing import Any, BinaryIO, Callable, Dict, Optional
+
+import ftp_pool
+import transfer
+from ftp_listing import FtpTreeLister, server_feature_params
+from logger import log_err, log_info
+from manifest import DEFAULT_STATE_DIR
+from transfer import Payload
+
+RESUME_MIN_SIZE = 8 * 1024 * 1024
+DEFAULT_ATTEMPTS = 5
+RETRY_DELAY = 2.0
+PARTIAL_DIR = "partial"
+PARTIAL_TTL_SECONDS = 7 * 24 * 3600.0
+
+_settings: Dict[str, Any] = {
+    "state_dir": DEFAULT_STATE_DIR,
+    "attempts": DEFAULT_ATTEMPTS,
+}
+
+# host -> whether the server can hash files with SHA-256
+_hash_support: Dict[str, bool] = {}
+_hash_support_lock = threading.Lock()
+
+
+class VerificationError(Exception):
+    """A finished transfer does not match its source."""
+
+
+def configure(
+    state_dir: str = DEFAULT_STATE_DIR, attempts: int = DEFAULT_ATTEMPTS
+) -> None:
+    """Set where partial transfers are kept and how often they are retried.
+
+    Partial transfers untouched for ``PARTIAL_TTL_SECONDS`` are removed.
+
+    Args:
+        state_dir: The directory holding the ``partial`` folder.
+        attempts: Connections tried per transfer before giving up.
+    """
+    _settings["state_dir"] = state_dir
+    _settings["attempts"] = max(1, attempts)
+
+    folder = os.path.join(state_dir, PARTIAL_DIR)
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return
+    cutoff = time.time() - PARTIAL_TTL_SECONDS
+    for name in names:
+        full_path = os.path.join(folder, name)
+        try:
+            if os.path.getmtime(full_path) < cutoff:
+                os.remove(full_path)
+        except OSError:
+            pass
+
+
+class PartialTransfer:
+    """The on-disk state of one large transfer.
+
+    Attributes:
+        data_path: Where the bytes of a download are collected.
+        state_path: The JSON file describing the transfer.
+        version: What identifies the transferred version of the file.
+    """
+
+    def __init__(
+        self, direction: str, location: str, rel_path: str, version: Dict[str, Any]
+    ) -> None:
+        """Describe a transfer of ``rel_path`` in ``location``.
+
+        Args:
+            direction: ``"download"`` or ``"upload"``.
+            location: The key of the FTP location.
+            rel_path: The file being transferred.
+            version: Facts that change whenever the file does (size, mtime,
+                checksum).
+        """
+        name = hashlib.blake2b(
+            f"{direction}\0{location}\0{rel_path}".encode(), digest_size=16
+        ).hexdigest()
+        folder = os.path.join(_settings["state_dir"], PARTIAL_DIR)
+        self.data_path = os.path.join(folder, name + ".part")
+        self.state_path = os.path.join(folder, name + ".json")
+        self.version = dict(
+            version, direction=direction, location=location, rel_path=rel_path
+        )
+
+    def _load(self) -> Optional[Dict[str, Any]]:
+        """Return the recorded state if it is about this very version."""
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as file_obj:
+                state = json.load(file_obj)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(state, dict):
+            return None
+        recorded = {k: v for k, v in state.items() if k != "stored"}
+        return state if recorded == self.version else None
+
+    def _save(self, state: Dict[str, Any]) -> None:
+        """Replace the state file atomically."""
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file_obj:
+            json.dump(state, file_obj)
+        os.replace(tmp_path, self.state_path)
+
+    def resumable(self) -> bool:
+        """Return True if an earlier attempt left state for this very version."""
+        return self._load() is not None
+
+    def start(self) -> None:
+        """Record a new transfer, dropping the data of any earlier one."""
+        self._save(self.version)
+        self.truncate()
+
+    def stored(self) -> Optional[int]:
+        """Return the offset the server accepted this upload at, if recorded.
+
+        Once it is recorded, the remote file holds nothing but bytes of this
+        upload.
+        """
+        state = self._load()
+        if state is None or not isinstance(state.get("stored"), int):
+            return None
+        return state["stored"]
+
+    def confirm(self, offset: int) -> None:
+        """Record that the server accepted the upload starting at ``offset``."""
+        self._save(dict(self.version, stored=offset))
+
+    def truncate(self) -> None:
+        """Empty the partial data."""
+        with open(self.data_path, "wb"):
+            pass
+
+    def received(self) -> int:
+        """Return how many bytes of a download are on disk."""
+        try:
+            return os.path.getsize(self.data_path)
+        except OSError:
+            return 0
+
+    def finish(self) -> None:
+        """Forget the transfer and its data."""
+        _remove_quietly(self.state_path)
+        _remove_quietly(self.data_path)
+
+
+def download(
+    pool: ftp_pool.FtpPool,
+    lister: FtpTreeLister,
+    location: str,
+    rel_path: str,
+    remote_full: str,
+) -> Optional[Payload]:
+    """Download a large file so that failures only lose the current chunk.
+
+    Args:
+        pool: The session pool of the server.
+        lister: The lister of the location, used to stat the file.
+        location: The key of the location.
+        rel_path: The file, relative to the location.
+        remote_full: Its absolute remote path.
+
+    Returns:
+        The payload, backed by the completed download moved to a file of its
+        own; None if the file is too small (or its size unknown) to be worth
+        resuming.
+
+    Raises:
+        VerificationError: If the result does not match the remote file.
+    """
+    stat = pool.call(lambda ftp: lister.stat(ftp, rel_path))
+    if stat is None or stat.size < RESUME_MIN_SIZE:
+        return None
+
+    partial = PartialTransfer(
+        "download", location, rel_path, {"size": stat.size, "mtime": stat.mtime}
+    )
+    if partial.resumable() and 0 < partial.received() <= stat.size:
+        log_info(f"Resuming download of {remote_full} at {partial.received()} bytes")
+    else:
+        partial.start()
+
+    def retrieve(ftp: FTP) -> None:
+        offset = partial.received()
+        if offset >= stat.size:
+            return
+        with open(partial.data_path, "ab") as file_obj:
+            try:
+                ftp.retrbinary(
+                    "RETR " + remote_full,
+                    file_obj.write,
+                    blocksize=transfer.CHUNK_SIZE,
+                    rest=offset or None,
+                )
+                return
+            except (error_perm, error_reply):
+                if not offset:
+                    raise
+        # The server does not restart downloads (REST refused).
+        partial.truncate()
+        with open(partial.data_path, "ab") as file_obj:
+            ftp.retrbinary(
+                "RETR " + remote_full, file_obj.write, blocksize=transfer.CHUNK_SIZE
+            )
+
+    _with_attempts(pool, retrieve, f"Download of {remote_full}", partial.received)
+
+    def check(ftp: FTP) -> Optional[str]:
+        if lister.stat(ftp, rel_path) != stat:
+            return "the remote file changed during the download"
+        if partial.received() != stat.size:
+            return f"{partial.received()} of {stat.size} bytes received"
+        remote_digest = _remote_sha256(ftp, pool.host, remote_full)
+        if remote_digest is not None:
+            with open(partial.data_path, "rb") as file_obj:
+                if _sha256(file_obj) != remote_digest:
+                    return "SHA-256 mismatch"
+        return None
+
+    problem = pool.call(check)
+    if problem is not None:
+        partial.finish()
+        raise VerificationError(f"Download of {remote_full} failed: {problem}")
+
+    # The next version of the file reuses the partial name, so the payload
+    # gets a file of its own.
+    fd, data_path = tempfile.mkstemp(
+        suffix=".download", dir=os.path.dirname(partial.data_path)
+    )
+    os.close(fd)
+    os.replace(partial.data_path, data_path)
+    partial.finish()
+    return Payload(
+        lambda: open(data_path, "rb"),
+        stat.size,
+        local_path=data_path,
+        cleanup=lambda: _remove_quietly(data_path),
+    )
+
+
+def upload(
+    pool: ftp_pool.FtpPool,
+    location: str,
+    rel_path: str,
+    remote_full: str,
+    payload: Payload,
+    prepare: Callable[[FTP], None],
+) -> bool:
+    """Upload a large payload so that failures only lose the current chunk.
+
+    Args:
+        pool: The session pool of the server.
+        location: The key of the location.
+        rel_path: The file, relative to the location.
+        remote_full: Its absolute remote path.
+        payload: The contents to upload.
+        prepare: Called with the session before every attempt (e.g. to
+            create the remote folders).
+
+    Returns:
+        False if the payload is too small to be worth resuming and nothing
+        was uploaded.
+
+    Raises:
+        VerificationError: If the uploaded file does not match the payload.
+    """
+    if payload.size < RESUME_MIN_SIZE:
+        return False
+
+    with payload.open() as file_obj:
+        digest = _sha256(file_obj)
+    partial = PartialTransfer(
+        "upload", location, rel_path, {"size": payload.size, "sha256": digest}
+    )
+    if not partial.resumable():
+        partial.start()
+
+    def send(ftp: FTP, offset: int) -> None:
+        confirmed = False
+
+        def sent(_block: bytes) -> None:
+            nonlocal confirmed
+            # The server accepted the STOR, so it truncated the file at offset.
+            if not confirmed:
+                partial.confirm(offset)
+                confirmed = True
+
+        with payload.open() as src:
+            src.seek(offset)
+            ftp.storbinary(
+                "STOR " + remote_full,
+                src,
+                blocksize=transfer.CHUNK_SIZE,
+                callback=sent,
+                rest=offset or None,
+            )
+
+    def store(ftp: FTP) -> None:
+        prepare(ftp)
+        offset = 0
+        stored = partial.stored()
+        if stored is not None:
+            size = _remote_size(ftp, remote_full)
+            # Anything shorter than the confirmed offset is not our upload.
+            if size is not None and stored <= size <= payload.size:
+                offset = size
+        if not offset:
+            send(ftp, 0)
+            return
+
+        log_info(f"Resuming upload of {remote_full} at {offset} bytes")
+        try:
+            send(ftp, offset)
+        except (error_perm, error_reply):
+            # The server does not restart uploads (REST refused).
+            send(ftp, 0)
+
+    _with_attempts(pool, store, f"Upload of {remote_full}")
+
+    def check(ftp: FTP) -> Optional[str]:
+        size = _remote_size(ftp, remote_full)
+        if size not in (None, payload.size):
+            return f"{size} of {payload.size} bytes stored"
+        if _remote_sha256(ftp, pool.host, remote_full) not in (None, digest):
+            return "SHA-256 mismatch"
+        return None
+
+    problem = pool.call(check)
+    partial.finish()
+    if problem is not None:
+        raise VerificationError(f"Upload of {remote_full} failed: {problem}")
+    return True
+
+
+def _with_attempts(
+    pool: ftp_pool.FtpPool,
+    fn: Callable[[FTP], None],
+    what: str,
+    progress: Optional[Callable[[], int]] = None,
+) -> None:
+    """Run a transfer step on fresh sessions until it succeeds.
+
+    Every attempt starts where the previous one stopped, so only connection
+    errors are retried, with a growing delay.
+    """
+    attempts = int(_settings["attempts"])
+    for attempt in range(1, attempts + 1):
+        try:
+            pool.call(fn, retries=0)
+            return
+        except ftp_pool.CONNECTION_ERRORS as exc:
+            if attempt == attempts:
+                raise
+            done = f" at {progress()} bytes" if progress is not None else ""
+            log_err(f"{what} interrupted{done} ({exc}), retrying")
+            time.sleep(min(RETRY_DELAY * attempt, 30.0))
+
+
+def _remote_size(ftp: FTP, remote_full: str) -> Optional[int]:
+    """Return the size of a remote file, or None if the server cannot tell."""
+    try:
+        ftp.voidcmd("TYPE I")
+        return ftp.size(remote_full)
+    except (error_perm, error_reply, ValueError):
+        return None
+
+
+def _remote_sha256(ftp: FTP, host: str, remote_full: str) -> Optional[str]:
+    """Return the server-computed SHA-256 of a file, if the server offers it."""
+    with _hash_support_lock:
+        supported = _hash_support.get(host)
+    if supported is None:
+        params = server_feature_params(ftp).get("HASH")
+        supported = params is not None and "SHA-256" in params.upper()
+        with _hash_support_lock:
+            _hash_support[host] = supported
+    if not supported:
+        return None
+
+    try:
+        ftp.sendcmd("OPTS HASH SHA-256")
+        resp = ftp.sendcmd("HASH " + remote_full)
+    except (error_perm, error_reply):
+        return None
+    # 213 SHA-256 0-1048575 <hex digest> <path>
+    for token in resp.split()[1:]:
+        if len(token) == 64 and all(c in "0123456789abcdefABCDEF" for c in token):
+            return token.lower()
+    return None
+
+
+def _sha256(file_obj: BinaryIO) -> str:
+    """Return the SHA-256 of a binary stream, read in chunks."""
+    hasher = hashlib.sha256()
+    while True:
+        chunk = file_obj.read(transfer.CHUNK_SIZE)
+        if not chunk:
+            break
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _remove_quietly(path: str) -> None:
+    """Remove a file, ignoring a missing one."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
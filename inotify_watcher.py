@@ -0,0 +1,260 @@
+from __future__ import annotations
+
+"""Event-driven folder watching on Linux using inotify through ctypes."""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+from typing import Dict, Optional, Set, Union
+
+from logger import log_err, log_info
+from path_utilities import is_staging_name
+from snapshot import FileStat, Snapshot
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_ONLYDIR
+)
+
+_EVENT_HEADER = struct.Struct("iIII")
+_READ_SIZE = 64 * 1024
+
+_libc: Optional[ctypes.CDLL] = None
+
+
+def _load_libc() -> Optional[ctypes.CDLL]:
+    """Return libc if it exposes the inotify API, otherwise None."""
+    global _libc
+
+    if _libc is None:
+        name = ctypes.util.find_library("c")
+        if name is None:
+            return None
+        try:
+            libc = ctypes.CDLL(name, use_errno=True)
+        except OSError:
+            return None
+        if not hasattr(libc, "inotify_init1"):
+            return None
+        _libc = libc
+    return _libc
+
+
+def _raise_errno(what: str) -> None:
+    """Raise the OSError matching the current ctypes errno."""
+    err = ctypes.get_errno()
+    raise OSError(err, f"{what}: {os.strerror(err)}")
+
+
+class InotifyFolderWatcher:
+    """Keeps a folder snapshot up to date from inotify events.
+
+    Every directory of the tree gets its own watch. Only paths reported by the
+    kernel are re-stat'ed, and a full rescan is done when the kernel queue
+    overflows.
+    """
+
+    def __init__(self, root: Union[str, "os.PathLike[str]"]) -> None:
+        """Start watching ``root`` and all of its subdirectories.
+
+        Raises:
+            OSError: If inotify is unavailable or the watch limits are
+                exhausted (``ENOSPC``/``EMFILE``).
+        """
+        libc = _load_libc()
+        if libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self._libc = libc
+        self.root = os.path.abspath(root)
+        self._wd_to_dir: Dict[int, str] = {}
+        self._dir_to_wd: Dict[str, int] = {}
+
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            _raise_errno("inotify_init1")
+
+        try:
+            self._add_tree("")
+        except OSError:
+            self.close()
+            raise
+
+    def fileno(self) -> int:
+        """Return the inotify descriptor, readable whenever events are queued."""
+        return self._fd
+
+    def close(self) -> None:
+        """Release the inotify instance and all of its watches."""
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _full(self, rel_path: str) -> str:
+        """Return the absolute path of ``rel_path``."""
+        return os.path.join(self.root, rel_path) if rel_path else self.root
+
+    def _add_watch(self, rel_dir: str) -> None:
+        """Watch a single directory; silently skips vanished directories."""
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(self._full(rel_dir)), WATCH_MASK
+        )
+        if wd < 0:
+            if ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR):
+                return
+            _raise_errno(f"inotify_add_watch [{self._full(rel_dir)}]")
+
+        self._wd_to_dir[wd] = rel_dir
+        self._dir_to_wd[rel_dir] = wd
+
+    def _add_tree(self, rel_dir: str) -> None:
+        """Watch ``rel_dir`` and every directory below it."""
+        self._add_watch(rel_dir)
+        for root, dirs, _ in os.walk(self._full(rel_dir)):
+            for name in dirs:
+                self._add_watch(os.path.relpath(os.path.join(root, name), self.root))
+
+    def _scan_tree(self, rel_dir: str) -> Snapshot:
+        """Stat every file below ``rel_dir``."""
+        entries: Snapshot = {}
+        for root, _, files in os.walk(self._full(rel_dir)):
+            for name in files:
+                if is_staging_name(name):
+                    continue
+                full_path = os.path.join(root, name)
+                try:
+                    st = os.stat(full_path)
+                except FileNotFoundError:
+                    continue
+                rel_path = os.path.relpath(full_path, self.root)
+                entries[rel_path] = FileStat(st.st_mtime, st.st_size)
+        return entries
+
+    def _read(self) -> bytes:
+        """Drain every pending event from the inotify descriptor."""
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(self._fd, _READ_SIZE)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def rescan(self) -> Snapshot:
+        """Re-add watches for the whole tree and return a fresh snapshot."""
+        self._add_tree("")
+        return self._scan_tree("")
+
+    def wait(self, prev: Snapshot, timeout: float) -> Snapshot:
+        """Wait for changes and return the updated snapshot.
+
+        Args:
+            prev: The snapshot produced by the previous call.
+            timeout: Maximum seconds to wait for events.
+
+        Returns:
+            ``prev`` itself when nothing happened, otherwise a new snapshot.
+
+        Raises:
+            OSError: If a new directory cannot be watched (e.g. ``ENOSPC``).
+        """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return prev
+
+        data = self._read()
+        curr = dict(prev)
+        dirty: Set[str] = set()
+        overflow = False
+
+        pos = 0
+        while pos + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, pos)
+            pos += _EVENT_HEADER.size
+            name = os.fsdecode(data[pos : pos + length].rstrip(b"\0"))
+            pos += length
+
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+
+            if mask & IN_IGNORED:
+                rel_dir = self._wd_to_dir.pop(wd, None)
+                if rel_dir is not None and self._dir_to_wd.get(rel_dir) == wd:
+                    del self._dir_to_wd[rel_dir]
+                continue
+
+            rel_dir = self._wd_to_dir.get(wd)
+            if rel_dir is None or not name:
+                continue
+            rel_path = os.path.join(rel_dir, name) if rel_dir else name
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_tree(rel_path)
+                    curr.update(self._scan_tree(rel_path))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    prefix = rel_path + os.sep
+                    for key in [k for k in curr if k.startswith(prefix)]:
+                        del curr[key]
+                continue
+
+            if not is_staging_name(name):
+                dirty.add(rel_path)
+
+        if overflow:
+            log_info(f"inotify queue overflowed for {self.root}, rescanning")
+            return self.rescan()
+
+        for rel_path in dirty:
+            try:
+                st = os.stat(self._full(rel_path))
+            except (FileNotFoundError, NotADirectoryError):
+                curr.pop(rel_path, None)
+                continue
+            curr[rel_path] = FileStat(st.st_mtime, st.st_size)
+
+        return curr
+
+
+def create(root: Union[str, "os.PathLike[str]"]) -> Optional[InotifyFolderWatcher]:
+    """Return an inotify watcher for ``root``, or None to fall back to polling.
+
+    Args:
+        root: The folder to watch.
+
+    Returns:
+        The watcher, or None if inotify is unavailable or exhausted.
+    """
+    try:
+        return InotifyFolderWatcher(root)
+    except OSError as exc:
+        log_err(f"inotify unavailable for {root} ({exc}), falling back to polling")
+        return None
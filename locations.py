@@ -0,0 +1,647 @@
+from __future__ import annotations
+
+"""Location backends (folder, ZIP, FTP) behind one interface, and their registry.
+
+Each backend is a :class:`Location` subclass registered under the prefix used
+in path specifications (``folder:``, ``zip:``, ``ftp:``). The sync core only
+talks to this interface and branches on capability flags, never on the
+backend type.
+"""
+
+import os
+import zipfile
+from ftplib import FTP, error_perm, error_reply
+from functools import partial
+from typing import ClassVar, Dict, Optional, Set, Type
+
+import delta
+import folder_scanner
+import folder_store
+import ftp_listing
+import ftp_pool
+import ftp_resume
+import inotify_watcher
+import transfer
+import zip_index
+import zip_store
+from batch import Batch
+from logger import log_err
+from path_utilities import is_valid_file, is_valid_path, staging_name
+from result import Result
+from snapshot import FileStat, Snapshot
+from transfer import Payload
+
+
+class Location:
+    """A place whose files are kept in sync.
+
+    Attributes:
+        path: The folder, archive or remote directory of the location.
+        type_name: The specification prefix of the backend.
+        local: Whether file contents can be read without network round
+            trips (cheap enough to fingerprint on demand).
+        batched_writes: Whether changes should be collected in
+            :meth:`new_batch` and applied together.
+        delta_writes: Whether :meth:`write_delta` can apply some deltas.
+        mtime_resolution: The coarsest step, in seconds, of the modification
+            times the backend stores; times closer than that are equal.
+    """
+
+    __slots__ = ("path",)
+
+    type_name: ClassVar[str] = ""
+    local: ClassVar[bool] = True
+    batched_writes: ClassVar[bool] = False
+    delta_writes: ClassVar[bool] = False
+    mtime_resolution: ClassVar[float] = 0.0
+
+    def __init__(self, path: str) -> None:
+        """Create a location rooted at ``path``."""
+        self.path = path
+
+    @classmethod
+    def parse(cls, spec: str) -> Result:
+        """Parse the part of a specification after the type prefix.
+
+        Returns:
+            Result.Ok(Location) or Result.Err(str).
+        """
+        raise NotImplementedError
+
+    @property
+    def key(self) -> str:
+        """A stable identifier, e.g. ``folder:/abs/path``."""
+        return f"{self.type_name}:{os.path.abspath(self.path)}"
+
+    def signature(self) -> Optional[str]:
+        """Return a cheap value that changes whenever the location changes.
+
+        Returns:
+            The signature, or None if the location must be scanned to tell.
+        """
+        return None
+
+    def scan(self) -> Snapshot:
+        """Return a snapshot of every file in the location."""
+        raise NotImplementedError
+
+    def stat(self, rel_path: str) -> Optional[FileStat]:
+        """Return the current metadata of one file, or None if missing."""
+        return self.scan().get(rel_path)
+
+    def fetch(self, rel_path: str) -> Payload:
+        """Return the contents of a file as a bounded-memory payload.
+
+        The caller must ``release()`` the payload when done.
+        """
+        raise NotImplementedError
+
+    def write(
+        self, rel_path: str, payload: Payload, mtime: Optional[float] = None
+    ) -> None:
+        """Store a payload as ``rel_path``, creating folders as needed.
+
+        Args:
+            rel_path: The file.
+            payload: Its contents.
+            mtime: The modification time to give the file, if the backend
+                can preserve it.
+        """
+        raise NotImplementedError
+
+    def write_delta(
+        self,
+        rel_path: str,
+        payload: Payload,
+        change: delta.Delta,
+        mtime: Optional[float] = None,
+    ) -> bool:
+        """Bring the current copy of a file up to ``payload`` by applying a delta.
+
+        Args:
+            rel_path: The file, whose current version ``change`` was computed
+                against.
+            payload: The new version, read for the literal runs.
+            change: The delta.
+            mtime: The modification time to give the file, if the backend
+                can preserve it.
+
+        Returns:
+            False if this kind of delta cannot be applied here, in which case
+            nothing was changed and the payload must be written in full.
+        """
+        return False
+
+    def delete(self, rel_path: str) -> None:
+        """Delete a file; a missing file is not an error."""
+        raise NotImplementedError
+
+    def new_batch(self) -> Optional[Batch]:
+        """Return a batch collecting changes, or None to apply them directly."""
+        return None
+
+    def create_notifier(self) -> Optional[inotify_watcher.InotifyFolderWatcher]:
+        """Return an event-driven change notifier, or None to poll."""
+        return None
+
+    def __repr__(self) -> str:
+        """Return the location in specification form."""
+        return f"{self.type_name}:{self.path}"
+
+
+_registry: Dict[str, Type[Location]] = {}
+
+
+def register(cls: Type[Location]) -> Type[Location]:
+    """Class decorator adding a backend under its ``type_name`` prefix."""
+    _registry[cls.type_name] = cls
+    return cls
+
+
+def parse_location(spec: str) -> Result:
+    """Parse a location specification with the backend its prefix names.
+
+    Supported formats:
+        - folder:/path/to/folder
+        - zip:/path/to/archive.zip
+        - ftp:username:password@host/path
+
+    Returns:
+        Result.Ok(Location) or Result.Err(str).
+    """
+    spec = spec.strip()
+    if not spec:
+        return Result.Err("Empty path specification.")
+
+    type_name, sep, rest = spec.partition(":")
+    cls = _registry.get(type_name) if sep else None
+    if cls is None:
+        expected = "/".join(f"{name}:" for name in _registry)
+        return Result.Err(f"Unknown path type (expected {expected}). [{spec}]")
+    return cls.parse(rest)
+
+
+@register
+class FolderLocation(Location):
+    """A local directory tree."""
+
+    __slots__ = ()
+
+    type_name = "folder"
+    batched_writes = True
+    delta_writes = True
+
+    @classmethod
+    def parse(cls, spec: str) -> Result:
+        """Parse ``/path/to/folder``."""
+        try_dir = is_valid_path(spec)
+        if not try_dir.ok:
+            return Result.Err(try_dir.error)
+        return Result.Ok(cls(os.fspath(try_dir.value)))
+
+    def _full(self, rel_path: str) -> str:
+        """Return the absolute path of a file in the folder."""
+        return os.path.join(self.path, rel_path)
+
+    def scan(self) -> Snapshot:
+        """Return a snapshot of every file in the folder."""
+        return folder_scanner.get_scanner(self.path).scan()
+
+    def stat(self, rel_path: str) -> Optional[FileStat]:
+        """Return the current metadata of one file, or None if missing."""
+        try:
+            st = os.stat(self._full(rel_path))
+        except OSError:
+            return None
+        return FileStat(st.st_mtime, st.st_size)
+
+    def fetch(self, rel_path: str) -> Payload:
+        """Wrap the file in place, without copying it."""
+        return Payload.from_file(self._full(rel_path))
+
+    def write(
+        self, rel_path: str, payload: Payload, mtime: Optional[float] = None
+    ) -> None:
+        """Replace the file atomically through a staging file."""
+        folder_store.write(self._full(rel_path), payload, mtime)
+
+    def write_delta(
+        self,
+        rel_path: str,
+        payload: Payload,
+        change: delta.Delta,
+        mtime: Optional[float] = None,
+    ) -> bool:
+        """Patch a clone of the file with the changed runs and rename it in."""
+        if not change.in_place:
+            return False
+
+        dest = self._full(rel_path)
+        staged = folder_store.stage_patch(dest, payload, change, mtime)
+        try:
+            folder_store.commit(staged, dest)
+        except BaseException:
+            folder_store.remove_quietly(staged)
+            raise
+        folder_store.sync_dirs([os.path.dirname(dest)])
+        return True
+
+    def delete(self, rel_path: str) -> None:
+        """Delete a file; a missing file is not an error."""
+        full_path = self._full(rel_path)
+        if os.path.exists(full_path):
+            os.remove(full_path)
+
+    def new_batch(self) -> Optional[Batch]:
+        """Return a batch staging writes and renaming them in together."""
+        return folder_store.FolderBatch(self.path)
+
+    def create_notifier(self) -> Optional[inotify_watcher.InotifyFolderWatcher]:
+        """Return an inotify watcher for the folder, if available."""
+        return inotify_watcher.create(self.path)
+
+
+@register
+class ZipLocation(Location):
+    """A ZIP archive treated as a virtual folder."""
+
+    __slots__ = ()
+
+    type_name = "zip"
+    batched_writes = True
+    mtime_resolution = 2.0
+
+    @classmethod
+    def parse(cls, spec: str) -> Result:
+        """Parse ``/path/to/archive.zip``."""
+        try_file = is_valid_file(spec)
+        if not try_file.ok:
+            return Result.Err(try_file.error)
+
+        if not zipfile.is_zipfile(try_file.value):
+            return Result.Err(f"Path is not a valid ZIP archive. [{spec}]")
+
+        return Result.Ok(cls(os.fspath(try_file.value)))
+
+    def signature(self) -> Optional[str]:
+        """Return the size, mtime and inode of the archive file."""
+        return zip_index.stat_signature(self.path)
+
+    def scan(self) -> Snapshot:
+        """Return a snapshot of every member of the archive."""
+        return zip_index.get_index(self.path).snapshot()
+
+    def stat(self, rel_path: str) -> Optional[FileStat]:
+        """Return the metadata of one member from the archive index."""
+        return zip_index.get_index(self.path).stat(rel_path)
+
+    def fetch(self, rel_path: str) -> Payload:
+        """Stream a member into a spool."""
+        return zip_index.get_index(self.path).fetch(rel_path)
+
+    def write(
+        self, rel_path: str, payload: Payload, mtime: Optional[float] = None
+    ) -> None:
+        """Store a payload as a member, stamped with ``mtime`` if given."""
+        mtimes = {rel_path: mtime} if mtime is not None else None
+        zip_store.apply_changes(self.path, {rel_path: payload}, mtimes=mtimes)
+
+    def delete(self, rel_path: str) -> None:
+        """Delete a member; a missing member is not an error."""
+        if os.path.exists(self.path):
+            zip_store.apply_changes(self.path, {}, [rel_path])
+
+    def new_batch(self) -> Optional[Batch]:
+        """Return a batch applying every change to the archive in one pass."""
+        return zip_store.ZipBatch(self.path)
+
+
+@register
+class FtpLocation(Location):
+    """A directory on an FTP server, reached through pooled sessions."""
+
+    __slots__ = ("host", "username", "password")
+
+    type_name = "ftp"
+    local = False
+    batched_writes = True
+    delta_writes = True
+    mtime_resolution = 1.0
+
+    def __init__(self, host: str, username: str, password: str, path: str) -> None:
+        """Create a location for ``path`` on ``host``."""
+        super().__init__(path)
+        self.host = host
+        self.username = username
+        self.password = password
+
+    @classmethod
+    def parse(cls, spec: str) -> Result:
+        """Parse ``username:password@host/path``."""
+        try:
+            creds, rest = spec.split("@", 1)
+            username, password = creds.split(":", 1)
+        except ValueError:
+            return Result.Err(f"Invalid FTP specification. [ftp:{spec}]")
+
+        if "/" in rest:
+            host, remote_path = rest.split("/", 1)
+            remote_path = "/" + remote_path
+        else:
+            host = rest
+            remote_path = "/"
+
+        if not username or not password or not host:
+            return Result.Err(f"Invalid FTP specification. [ftp:{spec}]")
+
+        return Result.Ok(cls(host, username, password, remote_path))
+
+    @property
+    def key(self) -> str:
+        """A stable identifier, e.g. ``ftp:user@host/path``."""
+        return f"ftp:{self.username}@{self.host}{self.path}"
+
+    @property
+    def pool(self) -> ftp_pool.FtpPool:
+        """The session pool of the server account."""
+        return ftp_pool.get_pool(self.host, self.username, self.password)
+
+    @property
+    def lister(self) -> ftp_listing.FtpTreeLister:
+        """The tree lister remembering this location's listing strategy."""
+        return ftp_listing.get_lister(self.host, self.username, self.path)
+
+    def remote(self, rel_path: str) -> str:
+        """Return the absolute remote path of a file."""
+        return self.path.rstrip("/") + "/" + rel_path.replace("\\", "/")
+
+    def scan(self) -> Snapshot:
+        """List the remote tree."""
+        return self.pool.call(self.lister.list_tree)
+
+    def stat(self, rel_path: str) -> Optional[FileStat]:
+        """Return one file's metadata with ``MLST`` (or ``MDTM``/``SIZE``)."""
+        lister = self.lister
+        return self.pool.call(lambda ftp: lister.stat(ftp, rel_path))
+
+    def fetch(self, rel_path: str) -> Payload:
+        """Download a file into a spool (large files resumably)."""
+        remote_full = self.remote(rel_path)
+        payload = ftp_resume.download(
+            self.pool, self.lister, self.key, rel_path, remote_full
+        )
+        if payload is not None:
+            return payload
+
+        def download(ftp: FTP) -> Payload:
+            spool = transfer.Spool()
+            try:
+                ftp.retrbinary(
+                    "RETR " + remote_full, spool.write, blocksize=transfer.CHUNK_SIZE
+                )
+            except BaseException:
+                spool.discard()
+                raise
+            return spool.to_payload()
+
+        return self.pool.call(download)
+
+    def make_folders(
+        self, ftp: FTP, rel_path: str, made: Optional[Set[str]] = None
+    ) -> None:
+        """Create the remote folders above ``rel_path``.
+
+        Args:
+            ftp: The session to use.
+            rel_path: The file about to be stored.
+            made: Folders already created, skipped and extended in place.
+        """
+        base_remote = self.path.rstrip("/")
+        current = base_remote
+        for folder in rel_path.replace("\\", "/").split("/")[:-1]:
+            current = current + "/" + folder
+            if made is not None:
+                if current in made:
+                    continue
+                made.add(current)
+            try:
+                ftp.mkd(current)
+            except error_perm:
+                log_err(f"Problem when making dir in FTP {base_remote}")
+
+    def staging(self, rel_path: str) -> str:
+        """Return the remote path ``rel_path`` is uploaded to before a rename."""
+        folder, _, base = rel_path.replace("\\", "/").rpartition("/")
+        staged = staging_name(base)
+        return self.remote(f"{folder}/{staged}" if folder else staged)
+
+    def replace(self, ftp: FTP, staged: str, remote_full: str) -> None:
+        """Rename an uploaded staging file over its target."""
+        try:
+            ftp.rename(staged, remote_full)
+        except error_perm:
+            # Some servers refuse to rename over an existing file.
+            ftp.delete(remote_full)
+            ftp.rename(staged, remote_full)
+
+    def write(
+        self, rel_path: str, payload: Payload, mtime: Optional[float] = None
+    ) -> None:
+        """Upload a payload, creating remote folders.
+
+        Large payloads are uploaded resumably under the staging name, which
+        holds nothing but this upload, then renamed into place.
+        """
+        full_remote = self.remote(rel_path)
+
+        def make_folders(ftp: FTP) -> None:
+            self.make_folders(ftp, rel_path)
+
+        staged = self.staging(rel_path)
+        if ftp_resume.upload(
+            self.pool, self.key, rel_path, staged, payload, make_folders
+        ):
+
+            def commit(ftp: FTP) -> None:
+                self.replace(ftp, staged, full_remote)
+                self.stamp(ftp, full_remote, mtime)
+
+            self.pool.call(commit)
+            return
+
+        def upload(ftp: FTP) -> None:
+            make_folders(ftp)
+            with payload.open() as src:
+                ftp.storbinary(
+                    "STOR " + full_remote, src, blocksize=transfer.CHUNK_SIZE
+                )
+            self.stamp(ftp, full_remote, mtime)
+
+        self.pool.call(upload)
+
+    def stamp(self, ftp: FTP, remote_full: str, mtime: Optional[float]) -> None:
+        """Give a remote file its source's modification time, if the server can."""
+        if mtime is not None:
+            ftp_listing.set_remote_mtime(ftp, self.host, remote_full, mtime)
+
+    def write_delta(
+        self,
+        rel_path: str,
+        payload: Payload,
+        change: delta.Delta,
+        mtime: Optional[float] = None,
+    ) -> bool:
+        """Upload only the bytes appended to the file, restarting at its old size.
+
+        Other deltas would need the server to rearrange data, which FTP cannot
+        do, so they are refused.
+        """
+        if not change.is_append:
+            return False
+        remote_full = self.remote(rel_path)
+
+        def upload(ftp: FTP) -> bool:
+            with payload.open() as src:
+                src.seek(change.base_size)
+                try:
+                    ftp.storbinary(
+                        "STOR " + remote_full,
+                        src,
+                        blocksize=transfer.CHUNK_SIZE,
+                        rest=change.base_size,
+                    )
+                except (error_perm, error_reply):
+                    # The server does not restart uploads (REST refused).
+                    return False
+            self.stamp(ftp, remote_full, mtime)
+            return True
+
+        return self.pool.call(upload)
+
+    def delete(self, rel_path: str) -> None:
+        """Delete a remote file; a missing file is logged."""
+        base_remote = self.path.rstrip("/")
+        rel = rel_path.replace("\\", "/")
+        remote_full = base_remote + "/" + rel
+
+        def remove(ftp: FTP) -> None:
+            try:
+                ftp.delete(remote_full)
+            except error_perm:
+                log_err(f"File {rel} does not exist on ftp {base_remote}")
+
+        self.pool.call(remove)
+
+    def new_batch(self) -> Optional[Batch]:
+        """Return a batch uploading every change over one session."""
+        return FtpBatch(self)
+
+
+class FtpBatch(Batch):
+    """Uploads queued writes under staging names, then renames them into place.
+
+    Small files are stored back to back on one pooled session; large ones
+    keep their resumable, verified upload (to the staging name). The renames
+    and deletes then run on one session. If an upload fails, the targets
+    are left untouched and the staged files are removed, except large ones,
+    which stay hidden from scans so a later attempt can resume them. Once
+    the renames start, a failure leaves the earlier renames applied, since
+    FTP has no way to rename several files at once.
+
+    Attributes:
+        location: The remote directory written to.
+    """
+
+    def __init__(self, location: FtpLocation) -> None:
+        """Create an empty batch for ``location``."""
+        super().__init__()
+        self.location = location
+
+    def _staging(self, name: str) -> str:
+        """Return the remote path ``name`` is uploaded to before the rename."""
+        return self.location.staging(name)
+
+    def _commit(self, writes: Dict[str, Payload], deletes: Set[str]) -> None:
+        """Upload, then rename, stamp and delete, over as few sessions as possible."""
+        location = self.location
+        pool = location.pool
+        made: Set[str] = set()
+        # Names that may have a staging file, and those fully uploaded.
+        staged: Set[str] = set()
+        stored: Set[str] = set()
+        large = {
+            name
+            for name, payload in writes.items()
+            if payload.size >= ftp_resume.RESUME_MIN_SIZE
+        }
+
+        def store(ftp: FTP) -> None:
+            # A retry after a lost connection skips the finished uploads.
+            for name, payload in writes.items():
+                if name in stored or name in large:
+                    continue
+                location.make_folders(ftp, name, made)
+                staged.add(name)
+                with payload.open() as src:
+                    ftp.storbinary(
+                        "STOR " + self._staging(name),
+                        src,
+                        blocksize=transfer.CHUNK_SIZE,
+                    )
+                stored.add(name)
+
+        try:
+            if len(large) < len(writes):
+                pool.call(store)
+            for name in large:
+                staged.add(name)
+                ftp_resume.upload(
+                    pool,
+                    location.key,
+                    name,
+                    self._staging(name),
+                    writes[name],
+                    partial(location.make_folders, rel_path=name, made=made),
+                )
+        except BaseException:
+            # Large staged uploads are kept (hidden) so a retry can resume them.
+            self._discard(staged - large)
+            raise
+
+        done: Set[str] = set()
+
+        def commit(ftp: FTP) -> None:
+            for name in writes:
+                if name in done:
+                    continue
+                remote_full = location.remote(name)
+                location.replace(ftp, self._staging(name), remote_full)
+                done.add(name)
+                location.stamp(ftp, remote_full, self.mtimes.get(name))
+            for name in deletes:
+                if name in done:
+                    continue
+                try:
+                    ftp.delete(location.remote(name))
+                except error_perm:
+                    pass
+                done.add(name)
+
+        pool.call(commit)
+
+    def _discard(self, staged: Set[str]) -> None:
+        """Remove staged uploads after a failed batch, ignoring errors."""
+        if not staged:
+            return
+
+        def remove(ftp: FTP) -> None:
+            for name in staged:
+                try:
+                    ftp.delete(self._staging(name))
+                except error_perm:
+                    pass
+
+        try:
+            self.location.pool.call(remove)
+        except ftp_pool.CONNECTION_ERRORS as exc:
+            log_err(f"Could not remove staged uploads on {self.location.key}: {exc}")
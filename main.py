@@ -1,163 +1,180 @@
 from __future__ import annotations
 
 import argparse
-import datetime
+import functools
 import os
 import queue
-import tempfile
 import threading
 import time
-import zipfile
-from collections import defaultdict
-from io import BytesIO
-from typing import Any, Callable, Dict, List, Optional, Tuple
-
-from ftplib import FTP
-
+from collections import Counter, defaultdict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import delta
+import fingerprint
+import folder_store
+import ftp_pool
+import ftp_resume
+import metrics
+import zip_index
+import zip_store
+from async_engine import DEFAULT_CONCURRENCY, AsyncEngine, LocationHooks
+from batch import Batch
+from batch import split as split_batches
+from coalesce import DEFAULT_MAX_LATENCY, DEFAULT_WINDOW, Coalescer
+from fanout import DEFAULT_PER_LOCATION, DEFAULT_WORKERS, LocationExecutor
+from locations import Location, parse_location
 from logger import log, log_err, log_info, log_important
-from path_utilities import is_valid_file, is_valid_path, read_file_safely
-from result import Result
+from manifest import DEFAULT_STATE_DIR, MANIFEST_NAME, Manifest
+from manifest import diff as diff_snapshots
+from path_utilities import is_valid_file, read_file_safely
+from payload_cache import DEFAULT_DISK_LIMIT, DEFAULT_MEMORY_LIMIT, PayloadCache
+from poll_schedule import (
+    DEFAULT_POLL_SETTINGS,
+    PollSchedule,
+    PollSettings,
+    is_setting_line,
+    parse_setting,
+)
+from progress import TransferProgress
+from snapshot import FileStat, Snapshot
+from transfer import Payload
+from write_journal import WriteJournal
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--file", action="store_true")
+parser.add_argument("--ftp-pool-size", type=int, default=ftp_pool.DEFAULT_MAX_SIZE)
+parser.add_argument("--ftp-keepalive", type=float, default=ftp_pool.DEFAULT_KEEPALIVE)
+parser.add_argument("--ftp-attempts", type=int, default=ftp_resume.DEFAULT_ATTEMPTS)
+parser.add_argument("--state-dir", default=DEFAULT_STATE_DIR)
+parser.add_argument("--hash", action="store_true")
+parser.add_argument("--delta", action="store_true")
+parser.add_argument(
+    "--fsync", choices=folder_store.FSYNC_MODES, default=folder_store.DEFAULT_FSYNC
+)
+parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+parser.add_argument(
+    "--per-location-workers", type=int, default=DEFAULT_PER_LOCATION
+)
+parser.add_argument(
+    "--cache-memory-mb", type=int, default=DEFAULT_MEMORY_LIMIT // 2**20
+)
+parser.add_argument("--cache-disk-mb", type=int, default=DEFAULT_DISK_LIMIT // 2**20)
+parser.add_argument("--coalesce-window", type=float, default=DEFAULT_WINDOW)
+parser.add_argument(
+    "--coalesce-max-latency", type=float, default=DEFAULT_MAX_LATENCY
+)
+parser.add_argument("--engine", choices=("threads", "asyncio"), default="threads")
+parser.add_argument("--async-concurrency", type=int, default=DEFAULT_CONCURRENCY)
+parser.add_argument("--metrics-port", type=int, default=0)
+parser.add_argument("--metrics-json")
+parser.add_argument(
+    "--metrics-interval", type=float, default=metrics.DEFAULT_JSON_INTERVAL
+)
 args = parser.parse_args()
 
-paths: List[Dict[str, Any]] = []
+paths: List[Location] = []
 event_queue: "queue.Queue[Dict[str, Any]]" = queue.Queue()
-last_events: Dict[str, Dict[str, Any]] = {}
-num_watchers: int = 0
+manifest: Optional[Manifest] = None
+executor: Optional[LocationExecutor] = None
 
-start_barrier: Optional[threading.Barrier] = None
-end_barrier: Optional[threading.Barrier] = None
+journal = WriteJournal()
+signatures = delta.SignatureCache()
+payload_cache = PayloadCache()
+poll_settings: Dict[str, PollSettings] = dict(DEFAULT_POLL_SETTINGS)
+
+INOTIFY_WAIT_SECONDS = 0.5
 
 
 def main() -> None:
     """Main entry point for the synchronization program."""
-    global num_watchers, start_barrier, end_barrier
+    global manifest
+
+    ftp_pool.configure(max_size=args.ftp_pool_size, keepalive=args.ftp_keepalive)
+    ftp_resume.configure(state_dir=args.state_dir, attempts=args.ftp_attempts)
+    folder_store.configure(fsync=args.fsync)
+    payload_cache.memory_limit = args.cache_memory_mb * 2**20
+    payload_cache.disk_limit = args.cache_disk_mb * 2**20
+    manifest = Manifest(os.path.join(args.state_dir, MANIFEST_NAME))
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if args.metrics_json:
+        metrics.start_json_dump(args.metrics_json, args.metrics_interval)
 
     get_paths()
     if paths is None or len(paths) == 0:
         return
 
-    num_watchers = len(paths)
-    start_barrier = threading.Barrier(num_watchers + 1)
-    end_barrier = threading.Barrier(num_watchers + 1)
-    init_sync()
+    # Idle locations are polled rarely; their echoes must still be known.
+    journal.ttl = max(
+        journal.ttl, 2 * max(settings.poll_max for settings in poll_settings.values())
+    )
 
-    for watcher_id, path in enumerate(paths, start=1):
+    snapshots = init_sync()
+    coalescer = Coalescer(args.coalesce_window, args.coalesce_max_latency)
+
+    if args.engine == "asyncio":
+        hooks = LocationHooks(publish_changes, handle_batch, scan_location)
+        try:
+            AsyncEngine(
+                paths,
+                snapshots,
+                hooks,
+                poll_settings,
+                coalescer,
+                args.async_concurrency,
+            ).run()
+        except KeyboardInterrupt:
+            log_info("Program stopped")
+        finally:
+            get_executor().shutdown()
+            ftp_pool.close_all()
+            payload_cache.clear()
+            zip_index.close_all()
+            manifest.close()
+        return
+
+    # Watchers run at their own pace; the loop below collects their events
+    # and handles each file once it has been quiet for the coalescing window.
+    for watcher_id, (path, snapshot) in enumerate(zip(paths, snapshots), start=1):
         threading.Thread(
             target=watch_file,
-            args=(path, event_queue, last_events, watcher_id),
+            args=(path, event_queue, watcher_id, snapshot),
             daemon=True,
         ).start()
 
     try:
         while True:
-            # Wait for all watcher threads to reach the barrier
-            if start_barrier is not None:
-                start_barrier.wait()
-
-            batch: List[Dict[str, Any]] = []
-            last_events.clear()
+            due = coalescer.next_due()
+            timeout = 1.0 if due is None else max(0.0, due - time.monotonic())
 
             try:
-                event = event_queue.get(timeout=1)
-                batch.append(event)
+                coalescer.add(event_queue.get(timeout=timeout))
+                while True:
+                    coalescer.add(event_queue.get_nowait())
             except queue.Empty:
-                batch = []
-
-            while True:
-                try:
-                    event = event_queue.get_nowait()
-                    batch.append(event)
-                except queue.Empty:
-                    break
+                if due is None:
+                    zip_store.compact_idle()
 
+            batch = coalescer.pop_due()
+            metrics.QUEUE_DEPTH.set(event_queue.qsize() + len(coalescer))
             if batch:
                 handle_batch(batch)
 
-            if end_barrier is not None:
-                end_barrier.wait()
-
     except KeyboardInterrupt:
         log_info("Program stopped, stopping all watcher threads")
+        get_executor().shutdown()
+        ftp_pool.close_all()
+        payload_cache.clear()
+        zip_index.close_all()
+        manifest.close()
 
 
-def parse_location(spec: str) -> Result:
-    """Parse a location specification into a structured dictionary.
+def get_paths() -> Optional[List[Location]]:
+    """Populate the global paths list either from a file or interactive input.
 
-    Supported formats:
-        - folder:/path/to/folder
-        - zip:/path/to/archive.zip
-        - ftp:username:password@host/path
+    A paths file may also tune polling per location type with lines such as
+    ``ftp.poll_min=5``, ``ftp.poll_max=300`` or ``zip.poll_backoff=1.5``.
     """
-    spec = spec.strip()
-    if not spec:
-        return Result.Err("Empty path specification.")
-
-    # FOLDER
-    if spec.startswith("folder:"):
-        folder_path = spec[len("folder:") :]
-        try_dir = is_valid_path(folder_path)
-        if not try_dir.ok:
-            return Result.Err(try_dir.error)
-        return Result.Ok(
-            {
-                "type": "folder",
-                "path": try_dir.value,
-            }
-        )
-
-    # ZIP
-    if spec.startswith("zip:"):
-        zip_path = spec[len("zip:") :]
-        try_file = is_valid_file(zip_path)
-        if not try_file.ok:
-            return Result.Err(try_file.error)
-
-        if not zipfile.is_zipfile(try_file.value):
-            return Result.Err(f"Path is not a valid ZIP archive. [{zip_path}]")
-
-        return Result.Ok(
-            {
-                "type": "zip",
-                "path": try_file.value,
-            }
-        )
-
-    # FTP
-    if spec.startswith("ftp:"):
-        ftp_spec = spec[len("ftp:") :]
-        try:
-            creds, rest = ftp_spec.split("@", 1)
-            username, password = creds.split(":", 1)
-            if "/" in rest:
-                host, remote_path = rest.split("/", 1)
-                remote_path = "/" + remote_path
-            else:
-                host = rest
-                remote_path = "/"
-
-            if not username or not password or not host:
-                return Result.Err(f"Invalid FTP specification. [{spec}]")
-
-            return Result.Ok(
-                {
-                    "type": "ftp",
-                    "username": username,
-                    "password": password,
-                    "host": host,
-                    "path": remote_path,
-                }
-            )
-        except ValueError:
-            return Result.Err(f"Invalid FTP specification. [{spec}]")
-
-    return Result.Err(f"Unknown path type (expected folder:/zip:/ftp:). [{spec}]")
-
-
-def get_paths() -> Optional[List[Dict[str, Any]]]:
-    """Populate the global paths list either from a file or interactive input."""
     if args.file:
         line = input("Enter path for paths file: ")
         try_paths_file = is_valid_file(line)
@@ -176,6 +193,12 @@ def get_paths() -> Optional[List[Dict[str, Any]]]:
             if not ln:
                 continue
 
+            if is_setting_line(ln):
+                setting = parse_setting(ln, poll_settings)
+                if not setting.ok:
+                    log_err(setting.error)
+                continue
+
             parsed = parse_location(ln)
             if not parsed.ok:
                 log_err(parsed.error)
@@ -199,426 +222,904 @@ def get_paths() -> Optional[List[Dict[str, Any]]]:
     return paths
 
 
-def init_sync() -> None:
-    """Perform an initial synchronization between all locations."""
+def init_sync() -> List[Snapshot]:
+    """Perform an initial synchronization between all locations.
+
+    Every location is scanned once, all of them concurrently; the snapshots
+    are reused to plan the sync and are handed to the watchers afterwards.
+
+    Returns:
+        The snapshot of every location after the sync, in ``paths`` order.
+    """
     log_info("Finding latest files for initial sync.")
-    latest_files = get_latest_files()
+    started = time.monotonic()
+    snapshots = scan_all(load_snapshot)
+    log_info(
+        f"Scanned {len(paths)} locations in {time.monotonic() - started:.2f}s"
+    )
+    latest_files = get_latest_files(snapshots)
 
     log_info(
         "Syncing all to latest files:\n"
         + "\n".join(
-            f"    [{rel_path}] from [{location['path']}] version "
+            f"    [{rel_path}] from [{location.path}] version "
             f"[{time.ctime(mtime)}]"
             for rel_path, (location, mtime) in latest_files.items()
         )
     )
-    sync_to_latest(latest_files)
+    written = sync_to_latest(latest_files, snapshots)
+
+    # Only locations that received files need to be looked at again.
+    def rescan(path: Location) -> Snapshot:
+        index = paths.index(path)
+        if not written[index]:
+            return snapshots[index]
+        signature = path.signature()
+        snapshot = scan_location(path)
+        record_snapshot(path, snapshots[index], snapshot, signature)
+        return snapshot
+
+    return scan_all(rescan)
+
+
+def scan_location(path: Location) -> Snapshot:
+    """Return a snapshot of a location, recording how long the scan took."""
+    with metrics.SCAN_SECONDS.time(location=path.key, backend=path.type_name):
+        return path.scan()
 
 
-def get_latest_files() -> Dict[str, Tuple[Dict[str, Any], float]]:
+def scan_all(scan: Callable[[Location], Snapshot]) -> List[Snapshot]:
+    """Run ``scan`` for every location on the worker pool.
+
+    Returns:
+        The snapshots in ``paths`` order.
+    """
+    pool = get_executor()
+    futures = [pool.submit(path.key, functools.partial(scan, path)) for path in paths]
+    return [future.result() for future in futures]
+
+
+def load_snapshot(path: Location) -> Snapshot:
+    """Scan a location, reconciling the result with its stored manifest.
+
+    A ZIP archive whose signature matches the manifest is not opened at all.
+    """
+    if manifest is None:
+        return scan_location(path)
+
+    key = path.key
+    signature = path.signature()
+    if signature is not None and signature == manifest.signature(key):
+        log_info(f"[{path.path}] unchanged since last run, using manifest")
+        return manifest.load(key)
+
+    started = time.monotonic()
+    snapshot = scan_location(path)
+    changed, removed = diff_snapshots(manifest.load(key), snapshot)
+    log_info(
+        f"[{path.path}] {len(changed)} changed, {len(removed)} removed "
+        f"since last run (scanned in {time.monotonic() - started:.2f}s)"
+    )
+    manifest.update(key, changed, removed, signature)
+    return snapshot
+
+
+def record_snapshot(
+    path: Location,
+    prev: Snapshot,
+    curr: Snapshot,
+    signature: Optional[str],
+) -> None:
+    """Persist the difference between two snapshots of a location."""
+    if manifest is None:
+        return
+
+    changed, removed = diff_snapshots(prev, curr)
+    if changed or removed:
+        manifest.update(path.key, changed, removed, signature)
+
+
+def get_latest_files(
+    snapshots: List[Snapshot],
+) -> Dict[str, Tuple[Location, float]]:
     """Get the latest version of each file across all locations."""
-    latest_files: Dict[str, Tuple[Dict[str, Any], float]] = {}
-    for path in paths:
-        files_in_path = ls(path)
-        for rel_path, (loc_path, mtime) in files_in_path.items():
+    latest_files: Dict[str, Tuple[Location, float]] = {}
+    for path, snapshot in zip(paths, snapshots):
+        for rel_path, stat in snapshot.items():
             if rel_path in latest_files:
                 _, existing_mtime = latest_files[rel_path]
-                if mtime > existing_mtime:
-                    latest_files[rel_path] = (loc_path, mtime)
+                if stat.mtime > existing_mtime:
+                    latest_files[rel_path] = (path, stat.mtime)
             else:
-                latest_files[rel_path] = (loc_path, mtime)
+                latest_files[rel_path] = (path, stat.mtime)
     return latest_files
 
 
-def sync_to_latest(latest_files: Dict[str, Tuple[Dict[str, Any], float]]) -> None:
-    """Ensure each location has the latest version of every file."""
-    for path in paths:
-        files_in_path = ls(path)
+def is_newer(
+    mtime: float, location: Location, other_mtime: float, other: Location
+) -> bool:
+    """Return True if ``mtime`` is later than ``other_mtime`` beyond rounding.
+
+    Copies keep their source's modification time, but ZIP archives and FTP
+    servers store it with a coarser resolution; times closer than the
+    coarser of the two locations' resolutions are treated as equal.
+    """
+    tolerance = max(location.mtime_resolution, other.mtime_resolution)
+    return mtime - other_mtime > tolerance
+
+
+def sync_to_latest(
+    latest_files: Dict[str, Tuple[Location, float]],
+    snapshots: List[Snapshot],
+) -> List[bool]:
+    """Ensure each location has the latest version of every file.
+
+    The copies run on the worker pool, limited per location, while progress
+    and throughput are logged. Each source file is fetched once for every
+    location that needs it, and each ZIP archive is rewritten once per
+    batch; files holding more than :data:`batch.MAX_PENDING_BYTES` are
+    split into several batches, applied one after another.
+
+    Returns:
+        For every location, whether any file was written to it.
+    """
+    sources: Dict[str, SourceFile] = {}
+    plan: List[Tuple[SourceFile, Location, Optional[FileStat]]] = []
+
+    for path, files_in_path in zip(paths, snapshots):
         for rel_path, (latest_path, latest_mtime) in latest_files.items():
             if rel_path not in files_in_path:
                 log(
-                    f"File [{rel_path}] not found in [{path['path']}], "
-                    f"writing latest from [{latest_path['path']}]"
+                    f"File [{rel_path}] not found in [{path.path}], "
+                    f"writing latest from [{latest_path.path}]"
                 )
-                write(rel_path, path, get_bytes(rel_path, latest_path))
             else:
-                _, mtime = files_in_path[rel_path]
-                if mtime < latest_mtime:
-                    log(
-                        "File [{rel_path}] from [{src}] [{src_time}] is behind latest, "
-                        "writing from [{latest}] [{latest_time}]".format(
-                            rel_path=rel_path,
-                            src=path["path"],
-                            src_time=time.ctime(mtime),
-                            latest=latest_path["path"],
-                            latest_time=time.ctime(latest_mtime),
-                        )
+                mtime = files_in_path[rel_path].mtime
+                if not is_newer(latest_mtime, latest_path, mtime, path):
+                    continue
+                log(
+                    "File [{rel_path}] from [{src}] [{src_time}] is behind latest, "
+                    "writing from [{latest}] [{latest_time}]".format(
+                        rel_path=rel_path,
+                        src=path.path,
+                        src_time=time.ctime(mtime),
+                        latest=latest_path.path,
+                        latest_time=time.ctime(latest_mtime),
                     )
-                    write(rel_path, path, get_bytes(rel_path, latest_path))
+                )
+
+            source = sources.get(rel_path)
+            if source is None:
+                latest_stat = snapshots[paths.index(latest_path)].get(rel_path)
+                source = SourceFile(rel_path, latest_path, latest_stat)
+                sources[rel_path] = source
+            plan.append((source, path, files_in_path.get(rel_path)))
+
+    written: Set[str] = set()
+    progress = TransferProgress(
+        "Initial sync",
+        len(plan),
+        sum(max(0, source.stat.size) for source, _, _ in plan if source.stat),
+    )
+    # Every copy of a source goes into the same part; each part is applied
+    # as its own batch, which bounds the payloads the batches hold.
+    copies: Dict[str, List[Tuple[SourceFile, Location, Optional[FileStat]]]] = {}
+    for entry in plan:
+        copies.setdefault(entry[0].rel_path, []).append(entry)
+    for part in split_batches(
+        list(copies.values()), lambda group: source_size(group[0][0])
+    ):
+        sync_part([entry for group in part for entry in group], written, progress)
+        for group in part:
+            group[0][0].release()
+    progress.finish()
+
+    return [path.key in written for path in paths]
+
+
+
+def sync_part(
+    plan: List[Tuple[SourceFile, Location, Optional[FileStat]]],
+    written: Set[str],
+    progress: TransferProgress,
+) -> None:
+    """Run the copies of one part of the initial sync, then apply its batches.
+
+    Args:
+        plan: The copies, as (source, destination, destination metadata).
+        written: Extended with the keys of the locations written to.
+        progress: Advanced as copies finish.
+    """
+    batches: Dict[int, Batch] = {
+        id(loc): loc.new_batch() for loc in paths if loc.batched_writes
+    }
+    batch_digests: Dict[int, Dict[str, Optional[str]]] = {
+        index: {} for index in batches
+    }
+    # A source is released after its last copy, unless a batch still holds
+    # its payload.
+    uses = Counter(source.rel_path for source, _, _ in plan)
+    batched: Set[str] = set()
+    uses_lock = threading.Lock()
+
+    def sync_file(
+        source: SourceFile, path: Location, stat: Optional[FileStat]
+    ) -> None:
+        rel_path = source.rel_path
+        size = source_size(source)
+        failed = True
+        try:
+            if has_identical_copy(rel_path, path, stat, source):
+                log(f"File [{rel_path}] already identical at [{path.path}]")
+            elif path.batched_writes and not uses_delta(path, source):
+                batches[id(path)].write(rel_path, source.payload, source.mtime)
+                batch_digests[id(path)][rel_path] = source.digest
+                batched.add(rel_path)
+                written.add(path.key)
+            else:
+                write_file(path, source)
+                stats = settle_changes(path, {rel_path: source.digest})
+                remember_signature(path, source, stats)
+                written.add(path.key)
+            failed = False
+        finally:
+            with uses_lock:
+                uses[rel_path] -= 1
+                last = uses[rel_path] == 0 and rel_path not in batched
+            if last:
+                source.release()
+            progress.advance(size, failed)
+
+    run_tasks(
+        [
+            (source.rel_path, path, functools.partial(sync_file, source, path, stat))
+            for source, path, stat in plan
+        ]
+    )
+
+    def apply_batch(loc: Location) -> None:
+        apply_timed(loc, batches[id(loc)])
+        settle_changes(loc, batch_digests[id(loc)], batch=True)
+
+    run_tasks(
+        [
+            ("(batch)", loc, functools.partial(apply_batch, loc))
+            for loc in paths
+            if id(loc) in batches and batch_digests[id(loc)]
+        ]
+    )
+
+
+def source_size(source: SourceFile) -> int:
+    """Return the expected payload size of a source (0 if unknown)."""
+    return max(0, source.stat.size) if source.stat is not None else 0
 
 
 def watch_file(
-    path: Dict[str, Any],
+    path: Location,
     event_queue: "queue.Queue[Dict[str, Any]]",
-    last_events: Dict[str, Dict[str, Any]],
     watcher_id: int,
+    initial: Optional[Snapshot] = None,
 ) -> None:
-    """Watch a single location for file changes and enqueue events."""
-    global start_barrier, end_barrier
+    """Watch a single location for file changes and enqueue events.
+
+    Folders are watched through inotify when available; every other location
+    (and folders whose inotify watches cannot be set up) is polled on its own
+    adaptive schedule, independently of the other watchers. ZIP archives
+    whose signature did not change since the last poll are not opened.
+
+    ``initial`` is the snapshot taken by the initial sync; polled locations
+    start from it instead of scanning again.
+    """
+    notifier = path.create_notifier()
 
-    prev = ls(path)
-    log_info(f"Starting daemon watcher at {path['path']}")
+    if notifier is not None or initial is None:
+        prev = scan_location(path)
+    else:
+        prev = initial
+    log_info(f"Starting daemon watcher at {path.path}")
+
+    schedule = PollSchedule(poll_settings[path.type_name])
+    last_signature: Optional[str] = None
 
     while True:
-        curr = ls(path)
-
-        prev_keys = set(prev.keys())
-        curr_keys = set(curr.keys())
-
-        # Updated files
-        for rel_path in prev_keys & curr_keys:
-            _, prev_mtime = prev[rel_path]
-            _, curr_mtime = curr[rel_path]
-
-            last_type = last_events.get(rel_path, {}).get("type")
-            if curr_mtime > prev_mtime and last_type != "updated":
-                event_queue.put(
-                    {
-                        "type": "updated",
-                        "location": path,
-                        "rel_path": rel_path,
-                        "mtime": curr_mtime,
-                    }
-                )
-                log(
-                    f"T{watcher_id}-{time.time()} UPDATED File [{rel_path}] "
-                    f"at [{path['path']}]"
+        if notifier is not None:
+            signature = path.signature()
+            try:
+                curr = notifier.wait(prev, INOTIFY_WAIT_SECONDS)
+            except OSError as exc:
+                log_err(
+                    f"inotify failed at {path.path} ({exc}), falling back to polling"
                 )
-
-        # Deleted files
-        for rel_path in prev_keys - curr_keys:
-            last_type = last_events.get(rel_path, {}).get("type")
-            if last_type == "deleted":
+                notifier.close()
+                notifier = None
                 continue
+        else:
+            time.sleep(schedule.interval)
+            signature = path.signature()
+            if signature is not None and signature == last_signature:
+                curr = prev
+            else:
+                try:
+                    curr = scan_location(path)
+                except Exception as exc:
+                    # Keep polling; the next poll scans again.
+                    log_err(f"Could not scan {path.path}: {exc}")
+                    curr, signature = prev, None
+                if curr == prev:
+                    curr = prev
+            schedule.record(curr is not prev)
+        last_signature = signature
+
+        if curr is not prev:
+            publish_changes(path, prev, curr, signature, event_queue, watcher_id)
+        prev = curr
 
-            event_queue.put(
-                {
-                    "type": "deleted",
-                    "location": path,
-                    "rel_path": rel_path,
-                    "mtime": time.time(),
-                }
-            )
-            log(
-                f"T{watcher_id}-{time.time()} DELETED File [{rel_path}] "
-                f"from [{path['path']}]"
-            )
 
-        # Created files
-        for rel_path in curr_keys - prev_keys:
-            last_type = last_events.get(rel_path, {}).get("type")
-            if last_type == "created":
-                continue
+def publish_changes(
+    path: Location,
+    prev: Snapshot,
+    curr: Snapshot,
+    signature: Optional[str],
+    event_queue: Any,
+    watcher_id: int,
+) -> None:
+    """Enqueue the changes between two snapshots and persist the new one.
+
+    Args:
+        path: The watched location.
+        prev: The previous snapshot.
+        curr: The current snapshot.
+        signature: The location signature ``curr`` was taken at.
+        event_queue: Anything with a thread-safe ``put`` method.
+        watcher_id: The watcher number used in log lines.
+    """
+    enqueue_changes(path, prev, curr, event_queue, watcher_id)
+    record_snapshot(path, prev, curr, signature)
 
-            _, new_mtime = curr[rel_path]
+
+def enqueue_changes(
+    path: Location,
+    prev: Snapshot,
+    curr: Snapshot,
+    event_queue: "queue.Queue[Dict[str, Any]]",
+    watcher_id: int,
+) -> None:
+    """Compare two snapshots of a location and enqueue the differences.
+
+    Changes the engine made to this location itself are not enqueued.
+    """
+    prev_keys = set(prev.keys())
+    curr_keys = set(curr.keys())
+
+    # Updated files
+    for rel_path in prev_keys & curr_keys:
+        prev_mtime = prev[rel_path].mtime
+        curr_mtime = curr[rel_path].mtime
+
+        if curr_mtime > prev_mtime and not is_own_change(path, rel_path, curr):
             event_queue.put(
                 {
-                    "type": "created",
+                    "type": "updated",
                     "location": path,
                     "rel_path": rel_path,
-                    "mtime": new_mtime,
+                    "mtime": curr_mtime,
+                    "size": curr[rel_path].size,
                 }
             )
             log(
-                f"T{watcher_id}-{time.time()} CREATED File [{rel_path}] "
-                f"at [{path['path']}]"
+                f"T{watcher_id}-{time.time()} UPDATED File [{rel_path}] "
+                f"at [{path.path}]"
             )
 
-        prev = curr
+    # Deleted files
+    for rel_path in prev_keys - curr_keys:
+        if is_own_change(path, rel_path, curr):
+            continue
 
-        if start_barrier is not None:
-            start_barrier.wait()
-        if end_barrier is not None:
-            end_barrier.wait()
+        event_queue.put(
+            {
+                "type": "deleted",
+                "location": path,
+                "rel_path": rel_path,
+                "mtime": time.time(),
+            }
+        )
+        log(
+            f"T{watcher_id}-{time.time()} DELETED File [{rel_path}] "
+            f"from [{path.path}]"
+        )
+
+    # Created files
+    for rel_path in curr_keys - prev_keys:
+        if is_own_change(path, rel_path, curr):
+            continue
+
+        new_mtime = curr[rel_path].mtime
+        event_queue.put(
+            {
+                "type": "created",
+                "location": path,
+                "rel_path": rel_path,
+                "mtime": new_mtime,
+                "size": curr[rel_path].size,
+            }
+        )
+        log(
+            f"T{watcher_id}-{time.time()} CREATED File [{rel_path}] "
+            f"at [{path.path}]"
+        )
+
+
+def is_own_change(path: Location, rel_path: str, curr: Snapshot) -> bool:
+    """Return True if a change seen by a watcher is an echo of an engine write.
+
+    Args:
+        path: The watched location.
+        rel_path: The changed file.
+        curr: The watcher's current snapshot of the location.
+    """
+
+    def digest_of() -> Optional[str]:
+        if not args.hash or not path.local:
+            return None
+        try:
+            with path.fetch(rel_path) as payload, payload.open() as file_obj:
+                return fingerprint.digest_stream(file_obj)
+        except (OSError, KeyError):
+            return None
+
+    return journal.is_echo(path.key, rel_path, curr.get(rel_path), digest_of)
 
 
 def handle_batch(events: List[Dict[str, Any]]) -> None:
-    """Handle a batch of file events, resolving conflicts by latest mtime."""
+    """Handle a batch of file events, resolving conflicts by latest mtime.
+
+    The copies to every destination run concurrently on the worker pool,
+    limited per location. The changes to each location are queued into one
+    batch and applied in a single pass, all or nothing; changes holding
+    more than :data:`batch.MAX_PENDING_BYTES` are split into several
+    batches, applied one after another.
+    """
+    metrics.BATCH_EVENTS.observe(len(events))
     by_rel: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
     for ev in events:
+        metrics.EVENTS.inc(type=ev["type"])
         by_rel[ev["rel_path"]].append(ev)
 
+    for part in split_batches(
+        list(by_rel.items()),
+        lambda item: max(item[1], key=lambda e: e["mtime"]).get("size", 0),
+    ):
+        handle_events(dict(part))
+
+
+def handle_events(by_rel: Dict[str, List[Dict[str, Any]]]) -> None:
+    """Apply the events of some files as one batch per location.
+
+    Args:
+        by_rel: The events of every file, by relative path.
+    """
+    # All changes to one location are applied together after the copies;
+    # changes maps the changed files to the digest written (if any).
+    batches: Dict[int, Batch] = {
+        id(loc): loc.new_batch() for loc in paths if loc.batched_writes
+    }
+    changes: Dict[int, Dict[str, Optional[str]]] = {index: {} for index in batches}
+    sources: List[SourceFile] = []
+    tasks: List[Tuple[str, Location, Callable[[], Any]]] = []
+
     for rel_path, evs in by_rel.items():
         evs.sort(key=lambda e: e["mtime"])
         winner = evs[-1]
         types = {e["type"] for e in evs}
 
-        last_events[rel_path] = winner
-
         if types == {"deleted"}:
             log_important(f"MAIN-{time.time()} DELETING {rel_path}")
             for loc in paths:
-                delete(rel_path, loc)
+                task = functools.partial(
+                    delete_from,
+                    rel_path,
+                    loc,
+                    batches.get(id(loc)),
+                    changes.get(id(loc)),
+                )
+                tasks.append((rel_path, loc, task))
         else:
-            data = get_bytes(rel_path, winner["location"])
+            source = SourceFile(rel_path, winner["location"], event_stat(winner))
             log_important(f"MAIN-{time.time()} WRITING {rel_path}")
             for loc in paths:
-                if loc is not winner["location"]:
-                    write(rel_path, loc, data)
-
-
-def ls(path: Dict[str, Any]) -> Dict[str, Tuple[Dict[str, Any], float]]:
-    """List all files for a given path, returning relative path and mtime."""
-    folder_list: Dict[str, Tuple[Dict[str, Any], float]] = {}
-
-    if path["type"] == "folder":
-        for root, _, files in os.walk(path["path"]):
-            for file in files:
-                full_path = os.path.join(root, file)
-                modified = os.path.getmtime(full_path)
-                rel_path = os.path.relpath(full_path, path["path"])
-                folder_list[rel_path] = (path, modified)
-
-    if path["type"] == "zip":
-        zip_path = path["path"]
-
-        with zipfile.ZipFile(zip_path, "r") as zf:
-            for info in zf.infolist():
-                if info.is_dir():
+                if loc is winner["location"]:
                     continue
+                task = functools.partial(
+                    copy_to,
+                    source,
+                    loc,
+                    batches.get(id(loc)),
+                    changes.get(id(loc)),
+                )
+                tasks.append((rel_path, loc, task))
+            sources.append(source)
 
-                rel_path = info.filename
-                parts = rel_path.split("/", 1)
-                if len(parts) == 2:
-                    rel_path = parts[1]
-
-                modified_ts = time.mktime(info.date_time + (0, 0, -1))
-                folder_list[rel_path] = (path, modified_ts)
+    run_tasks(tasks)
 
-    if path["type"] == "ftp":
-        ftp = FTP()
-        ftp.connect(path["host"])
-        ftp.login(path["username"], path["password"])
+    def apply_batch(loc: Location) -> None:
+        try:
+            apply_timed(loc, batches[id(loc)])
+        except BaseException:
+            for rel_path in changes[id(loc)]:
+                journal.abandon(loc.key, rel_path)
+            raise
+        settle_changes(loc, changes[id(loc)], batch=True)
+
+    run_tasks(
+        [
+            ("(batch)", loc, functools.partial(apply_batch, loc))
+            for loc in paths
+            if id(loc) in batches and changes[id(loc)]
+        ]
+    )
 
-        base_remote = path["path"]
+    for source in sources:
+        source.release()
 
-        def walk_ftp(current_remote_path: str) -> None:
-            lines: List[str] = []
-            ftp.retrlines("LIST " + current_remote_path, lines.append)
 
-            for line in lines:
-                parts = line.split(maxsplit=8)
-                name = parts[-1]
-                item_path = current_remote_path.rstrip("/") + "/" + name
+def copy_to(
+    source: SourceFile,
+    path: Location,
+    batch: Optional[Batch],
+    changes: Optional[Dict[str, Optional[str]]],
+) -> None:
+    """Bring one destination up to date with ``source``.
 
-                is_dir = line.startswith("d")
+    Locations with batched writes only queue the payload in ``batch``; it is
+    written (and the change settled) when the batch is applied. Copies sent
+    as deltas are written directly.
+    """
+    rel_path = source.rel_path
+    if has_identical_copy(rel_path, path, known_stat(path, rel_path), source):
+        log(f"File [{rel_path}] already identical at [{path.path}]")
+        return
 
-                if is_dir:
-                    walk_ftp(item_path)
-                else:
-                    try:
-                        resp = ftp.sendcmd("MDTM " + item_path)
-                        ts = resp.split()[1]
-                        mtime = parse_mdtm_to_unix(ts)
-                    except Exception:
-                        continue
+    key = path.key
+    journal.begin(key, rel_path)
+    try:
+        if (
+            batch is not None
+            and changes is not None
+            and not uses_delta(path, source)
+        ):
+            batch.write(rel_path, source.payload, source.mtime)
+            changes[rel_path] = source.digest
+            return
+        write_file(path, source)
+    except BaseException:
+        journal.abandon(key, rel_path)
+        raise
+
+    stats = settle_changes(path, {rel_path: source.digest})
+    remember_signature(path, source, stats)
+
+
+def uses_delta(path: Location, source: SourceFile) -> bool:
+    """Return True if copies of ``source`` to ``path`` go through deltas."""
+    return (
+        args.delta
+        and path.delta_writes
+        and source.payload.size >= delta.MIN_DELTA_SIZE
+    )
 
-                    rel_path = item_path[len(base_remote) :].lstrip("/")
-                    folder_list[rel_path] = (path, mtime)
 
-        walk_ftp(base_remote)
-        ftp.quit()
+def write_file(path: Location, source: SourceFile) -> None:
+    """Write ``source`` to ``path``, sending only the changed blocks if possible.
 
-    return folder_list
+    With ``--delta``, large files are compared with the destination's block
+    signature: the one cached when the engine last wrote that version, or,
+    for local destinations, one computed from the current copy. Folders get
+    a patched clone of their copy and FTP files grown by appends get only
+    the new bytes; anything else is written in full.
+    """
+    rel_path = source.rel_path
+    size = source.payload.size
+    started = time.monotonic()
+    base: Optional[delta.Signature] = None
+    if uses_delta(path, source):
+        stat = path.stat(rel_path)
+        if stat is not None:
+            base = signatures.get(path.key, rel_path, stat)
+            if base is None and path.local:
+                with path.fetch(rel_path) as current:
+                    base = delta.signature_of(current)
+
+    if base is not None:
+        change = delta.compute(base, source.payload)
+        if path.write_delta(rel_path, source.payload, change, source.mtime):
+            log(
+                f"File [{rel_path}] patched at [{path.path}], sent "
+                f"{change.literal_bytes} of {change.size} bytes"
+            )
+            record_write(path, "write", change.literal_bytes, started)
+            return
 
+    path.write(rel_path, source.payload, source.mtime)
+    record_write(path, "write", size, started)
 
-def write(rel_path: str, path: Dict[str, Any], bytes_data: bytes) -> bool:
-    """Write bytes to the specified relative path in the given location."""
-    if path["type"] == "folder":
-        base = path["path"]
-        dest = os.path.join(base, rel_path)
 
-        os.makedirs(os.path.dirname(dest), exist_ok=True)
+def apply_timed(path: Location, batch: Batch) -> None:
+    """Apply the batch of ``path``, recording its duration and size."""
+    started = time.monotonic()
+    batch.apply()
+    record_write(path, "batch", batch.applied_bytes, started)
 
-        with open(dest, "wb") as file_obj:
-            file_obj.write(bytes_data)
 
-        return True
+def record_write(path: Location, op: str, size: int, started: float) -> None:
+    """Record ``size`` bytes written to ``path`` by an ``op`` begun at ``started``."""
+    backend = path.type_name
+    metrics.TRANSFER_SECONDS.observe(
+        time.monotonic() - started, backend=backend, op=op
+    )
+    metrics.TRANSFERRED_BYTES.inc(max(0, size), backend=backend, direction="out")
 
-    if path["type"] == "zip":
-        zip_path = path["path"]
-        zip_dir = os.path.dirname(zip_path)
 
-        tmp_fd, tmp_name = tempfile.mkstemp(suffix=".zip", dir=zip_dir)
-        os.close(tmp_fd)
+def remember_signature(
+    path: Location, source: SourceFile, stats: Dict[str, Optional[FileStat]]
+) -> None:
+    """Cache the block signature of a copy the engine just wrote.
 
-        try:
-            if os.path.exists(zip_path):
-                with zipfile.ZipFile(zip_path, "r") as zin, zipfile.ZipFile(
-                    tmp_name, "w", zipfile.ZIP_DEFLATED
-                ) as zout:
-                    for item in zin.infolist():
-                        if item.filename == rel_path:
-                            continue
-                        data = zin.read(item.filename)
-                        zout.writestr(item, data)
-
-                    zout.writestr(rel_path, bytes_data)
-            else:
-                with zipfile.ZipFile(
-                    tmp_name, "w", zipfile.ZIP_DEFLATED
-                ) as zout:
-                    zout.writestr(rel_path, bytes_data)
+    Nothing is cached if the source changed while it was copied, since the
+    copy may then hold bytes the signature does not describe.
 
-            os.replace(tmp_name, zip_path)
-        finally:
-            if os.path.exists(tmp_name) and not os.path.samefile(tmp_name, zip_path):
-                try:
-                    os.remove(tmp_name)
-                except OSError:
-                    log_err(f"OS Error when removing tmp zip file {tmp_name}")
+    Args:
+        path: The destination.
+        source: The file written.
+        stats: The metadata of the written files looked up while settling.
+    """
+    if not uses_delta(path, source):
+        return
+    rel_path = source.rel_path
+    stat = stats[rel_path] if rel_path in stats else path.stat(rel_path)
+    signature = source.signature
+    if stat is None or stat.size not in (-1, signature.size):
+        return
+    if source.unchanged():
+        signatures.put(path.key, rel_path, stat, signature)
 
-        return True
 
-    if path["type"] == "ftp":
-        ftp = FTP()
-        ftp.connect(path["host"])
-        ftp.login(path["username"], path["password"])
+def delete_from(
+    rel_path: str,
+    path: Location,
+    batch: Optional[Batch],
+    changes: Optional[Dict[str, Optional[str]]],
+) -> None:
+    """Delete a file from one location (queued in ``batch`` if it has one)."""
+    key = path.key
+    journal.begin(key, rel_path)
+    try:
+        if batch is not None and changes is not None:
+            batch.delete(rel_path)
+            changes[rel_path] = None
+            return
+        path.delete(rel_path)
+    except BaseException:
+        journal.abandon(key, rel_path)
+        raise
 
-        base_remote = path["path"].rstrip("/")
+    journal.complete(key, rel_path, None)
 
-        rel = rel_path.replace("\\", "/")
-        full_remote = base_remote + "/" + rel
 
-        parts = rel.split("/")
-        filename = parts[-1]
-        folders = parts[:-1]
+def get_executor() -> LocationExecutor:
+    """Return the shared worker pool, creating it on first use."""
+    global executor
+    if executor is None:
+        executor = LocationExecutor(args.workers, args.per_location_workers)
+    return executor
 
-        current = base_remote
-        for folder in folders:
-            try:
-                ftp.mkd(current + "/" + folder)
-            except Exception:
-                log_err(f"Problem when making dir in FTP {base_remote}")
-            current = current + "/" + folder
 
-        ftp.cwd(os.path.dirname(full_remote))
+def run_tasks(tasks: List[Tuple[str, Location, Callable[[], Any]]]) -> None:
+    """Run per-location tasks on the worker pool and wait for all of them.
 
-        bio = BytesIO(bytes_data)
-        ftp.storbinary("STOR " + filename, bio)
+    A failing task is logged and does not stop the others.
 
-        ftp.quit()
-        return True
+    Args:
+        tasks: Tuples of (relative path, location, task) where the relative
+            path is only used for error messages.
+    """
+    pool = get_executor()
+    futures = [pool.submit(loc.key, task) for _, loc, task in tasks]
+    for (rel_path, loc, _), future in zip(tasks, futures):
+        exc = future.exception()
+        if exc is not None:
+            log_err(f"Failed to sync [{rel_path}] at [{loc.path}]: {exc}")
 
-    raise ValueError(f"Unknown location type: {path['type']}")
 
+def fetch_file(path: Location, rel_path: str) -> Payload:
+    """Fetch a file's contents, recording the duration and size of the read."""
+    backend = path.type_name
+    with metrics.TRANSFER_SECONDS.time(backend=backend, op="fetch"):
+        payload = path.fetch(rel_path)
+    metrics.TRANSFERRED_BYTES.inc(payload.size, backend=backend, direction="in")
+    return payload
 
-def get_bytes(rel_path: str, path: Dict[str, Any]) -> bytes:
-    """Read and return file contents as bytes from the given location."""
-    if path["type"] == "folder":
-        full_path = os.path.join(path["path"], rel_path)
-        with open(full_path, "rb") as file_obj:
-            return file_obj.read()
 
-    if path["type"] == "zip":
-        zip_path = path["path"]
-        with zipfile.ZipFile(zip_path, "r") as zf:
-            with zf.open(rel_path, "r") as file_obj:
-                return file_obj.read()
+class SourceFile:
+    """The winning copy of a file, fetched and fingerprinted at most once.
 
-    if path["type"] == "ftp":
-        ftp = FTP()
-        ftp.connect(path["host"])
-        ftp.login(path["username"], path["password"])
+    Payloads go through the shared payload cache, so a version read for one
+    destination is not read again for the next one.
+    """
 
-        base_remote = path["path"].rstrip("/")
-        rel = rel_path.replace("\\", "/")
-        remote_full = base_remote + "/" + rel
+    def __init__(
+        self, rel_path: str, location: Location, stat: Optional[FileStat]
+    ) -> None:
+        """Describe ``rel_path`` in ``location`` with its known metadata."""
+        self.rel_path = rel_path
+        self.location = location
+        self.stat = stat
+        self._payload: Optional[Payload] = None
+        self._digest: Optional[str] = None
+        self._signature: Optional[delta.Signature] = None
+        self._fetched_stat: Optional[FileStat] = None
+        # Destinations are copied concurrently; fetch and hash only once.
+        self._lock = threading.RLock()
+
+    @property
+    def payload(self) -> Payload:
+        """The file contents, fetched on first access."""
+        with self._lock:
+            if self._payload is None:
+                if args.delta and self.location.local:
+                    self._fetched_stat = self.location.stat(self.rel_path)
+                fetch = functools.partial(fetch_file, self.location, self.rel_path)
+                if self.stat is None:
+                    self._payload = fetch()
+                else:
+                    self._payload = payload_cache.fetch(
+                        (self.location.key, self.rel_path, self.stat), fetch
+                    )
+            return self._payload
 
-        dirpart = os.path.dirname(remote_full)
-        if dirpart:
-            ftp.cwd(dirpart)
+    @property
+    def mtime(self) -> Optional[float]:
+        """The modification time copies are given, if known."""
+        return self.stat.mtime if self.stat is not None else None
 
-        buffer = BytesIO()
-        filename = os.path.basename(remote_full)
+    def unchanged(self) -> bool:
+        """Return True if the file cannot have changed since it was fetched.
 
-        ftp.retrbinary("RETR " + filename, buffer.write)
+        Local payloads may be read from the live file, so its metadata is
+        compared with the one seen before the fetch; remote payloads are
+        downloaded copies and never change.
+        """
+        if not self.location.local:
+            return True
+        return (
+            self._fetched_stat is not None
+            and self.location.stat(self.rel_path) == self._fetched_stat
+        )
 
-        ftp.quit()
-        return buffer.getvalue()
+    def release(self) -> None:
+        """Free the temporary storage of the fetched payload."""
+        with self._lock:
+            if self._payload is not None:
+                self._payload.release()
+
+    @property
+    def signature(self) -> delta.Signature:
+        """The block signature of the contents, computed on first access."""
+        with self._lock:
+            if self._signature is None:
+                self._signature = delta.signature_of(self.payload)
+            return self._signature
+
+    @property
+    def digest(self) -> Optional[str]:
+        """The content fingerprint, or None when fingerprinting is disabled."""
+        if not args.hash:
+            return None
+        with self._lock:
+            if self._digest is None and self.stat is not None:
+                self._digest = stored_digest(self.location, self.rel_path, self.stat)
+            if self._digest is None:
+                with self.payload.open() as file_obj:
+                    self._digest = fingerprint.digest_stream(file_obj)
+                if self.stat is not None and manifest is not None:
+                    manifest.set_digest(
+                        self.location.key,
+                        self.rel_path,
+                        self.stat,
+                        self._digest,
+                    )
+            return self._digest
 
-    raise ValueError(f"Unknown location type: {path['type']}")
 
+def event_stat(event: Dict[str, Any]) -> FileStat:
+    """Return the file metadata carried by a watcher event."""
+    return FileStat(event["mtime"], event.get("size", -1))
 
-def delete(rel_path: str, path: Dict[str, Any]) -> bool:
-    """Delete the file at the given relative path in the specified location."""
-    if path["type"] == "folder":
-        full_path = os.path.join(path["path"], rel_path)
-        if os.path.exists(full_path):
-            os.remove(full_path)
-        return True
 
-    if path["type"] == "zip":
-        zip_path = path["path"]
-        zip_dir = os.path.dirname(zip_path)
+def known_stat(path: Location, rel_path: str) -> Optional[FileStat]:
+    """Return the last recorded metadata of a file, without touching the location."""
+    if manifest is None or not args.hash:
+        return None
+    return manifest.entry(path.key, rel_path)
 
-        if not os.path.exists(zip_path):
-            return True
 
-        tmp_fd, tmp_name = tempfile.mkstemp(suffix=".zip", dir=zip_dir)
-        os.close(tmp_fd)
+def stored_digest(
+    path: Location, rel_path: str, stat: FileStat
+) -> Optional[str]:
+    """Return the recorded fingerprint of a file if it matches ``stat``."""
+    if manifest is None:
+        return None
+    return manifest.digest(path.key, rel_path, stat)
 
-        try:
-            with zipfile.ZipFile(zip_path, "r") as zin, zipfile.ZipFile(
-                tmp_name, "w", zipfile.ZIP_DEFLATED
-            ) as zout:
-                for item in zin.infolist():
-                    if item.filename != rel_path:
-                        data = zin.read(item.filename)
-                        zout.writestr(item, data)
-
-            os.replace(tmp_name, zip_path)
-
-        except Exception:
-            if os.path.exists(tmp_name):
-                try:
-                    os.remove(tmp_name)
-                except Exception:
-                    log_err(
-                        f"Problem deleting tmp zip file {tmp_name} at {zip_path}"
-                    )
-            raise
 
-        return True
+def has_identical_copy(
+    rel_path: str,
+    path: Location,
+    stat: Optional[FileStat],
+    source: SourceFile,
+) -> bool:
+    """Return True if ``path`` already holds exactly the bytes of ``source``.
 
-    if path["type"] == "ftp":
-        ftp = FTP()
-        ftp.connect(path["host"], 21)
-        ftp.login(path["username"], path["password"])
+    Sizes are compared first. Digests of folder and ZIP copies are computed
+    (and recorded) on demand; FTP copies are only known by the digest
+    recorded when they were written, so they are never downloaded for this.
+    """
+    if not args.hash or stat is None:
+        return False
 
-        base_remote = path["path"].rstrip("/")
-        rel = rel_path.replace("\\", "/")
-        remote_full = base_remote + "/" + rel
+    if source.stat is not None and -1 not in (source.stat.size, stat.size):
+        if source.stat.size != stat.size:
+            return False
 
+    digest = stored_digest(path, rel_path, stat)
+    if digest is None and path.local:
         try:
-            ftp.delete(remote_full)
-        except Exception:
-            log_err(f"File {rel} does not exist on ftp {base_remote}")
-
-        ftp.quit()
-        return True
-
-    return False
-
-
-def parse_mdtm_to_unix(ts: str) -> float:
-    """Parse an FTP MDTM timestamp string into a Unix timestamp."""
-    if "." in ts:
-        dt = datetime.datetime.strptime(ts, "%Y%m%d%H%M%S.%f")
-    else:
-        dt = datetime.datetime.strptime(ts, "%Y%m%d%H%M%S")
-    dt = dt.replace(tzinfo=datetime.timezone.utc)
-    return dt.timestamp()
+            with path.fetch(rel_path) as payload, payload.open() as file_obj:
+                digest = fingerprint.digest_stream(file_obj)
+        except (OSError, KeyError):
+            return False
+        if manifest is not None:
+            manifest.set_digest(path.key, rel_path, stat, digest)
+
+    return digest is not None and digest == source.digest
+
+
+def settle_changes(
+    path: Location, digests: Dict[str, Optional[str]], batch: bool = False
+) -> Dict[str, Optional[FileStat]]:
+    """Record the outcome of changes the engine just made to a location.
+
+    The resulting metadata goes to the write journal, so the location's
+    watcher recognizes the changes as its own, and with ``--hash`` the
+    fingerprints written are stored in the manifest.
+
+    Args:
+        path: The changed location.
+        digests: The written files (and, for batches, deleted files) mapped
+            to the digest written, or None.
+        batch: Whether the changes were applied as a batch, in which case a
+            file found missing was deleted by it.
+
+    Returns:
+        The metadata looked up after the changes, for the files that needed it.
+    """
+    key = path.key
+    stats: Dict[str, Optional[FileStat]] = {}
+    for rel_path, digest in digests.items():
+        wanted = journal.pending(key, rel_path)
+        if not wanted and (digest is None or manifest is None or not args.hash):
+            continue
+
+        stat = path.stat(rel_path)
+        stats[rel_path] = stat
+
+        # A file missing after a batch was deleted by it; any other missing
+        # file could just not be looked up.
+        journal.complete(key, rel_path, stat, digest, known=stat is not None or batch)
+        if stat is not None and digest is not None and manifest is not None:
+            manifest.set_digest(key, rel_path, stat, digest)
+    return stats
 
 
 if __name__ == "__main__":
@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+"""Persistent per-location manifest of known files, stored in SQLite."""
+
+import os
+import sqlite3
+import threading
+from typing import Iterable, List, Optional, Tuple
+
+from snapshot import FileStat, Snapshot
+
+DEFAULT_STATE_DIR = os.path.join(os.path.expanduser("~"), ".filesync")
+MANIFEST_NAME = "manifest.sqlite3"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS locations (
+    location TEXT PRIMARY KEY,
+    signature TEXT
+);
+CREATE TABLE IF NOT EXISTS entries (
+    location TEXT NOT NULL,
+    rel_path TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    digest TEXT,
+    PRIMARY KEY (location, rel_path)
+);
+"""
+
+
+class Manifest:
+    """Stores the last known snapshot of every location between runs."""
+
+    def __init__(self, db_path: str) -> None:
+        """Open (or create) the manifest database at ``db_path``."""
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        """Close the database."""
+        with self._lock:
+            self._conn.close()
+
+    def signature(self, location: str) -> Optional[str]:
+        """Return the signature stored with a location's snapshot."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT signature FROM locations WHERE location = ?", (location,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def load(self, location: str) -> Snapshot:
+        """Return the stored snapshot of a location (empty if unknown)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT rel_path, mtime, size FROM entries WHERE location = ?",
+                (location,),
+            ).fetchall()
+        return {rel_path: FileStat(mtime, size) for rel_path, mtime, size in rows}
+
+    def update(
+        self,
+        location: str,
+        changed: Snapshot,
+        removed: Iterable[str],
+        signature: Optional[str] = None,
+    ) -> None:
+        """Apply a delta to the stored snapshot of a location.
+
+        Args:
+            location: The location key.
+            changed: Entries that were created or modified.
+            removed: Relative paths that no longer exist.
+            signature: The new location signature.
+        """
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM entries WHERE location = ? AND rel_path = ?",
+                ((location, rel_path) for rel_path in removed),
+            )
+            self._conn.executemany(
+                "INSERT INTO entries (location, rel_path, mtime, size) "
+                "VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (location, rel_path) DO UPDATE SET "
+                "digest = CASE WHEN mtime = excluded.mtime AND size = excluded.size "
+                "THEN digest END, "
+                "mtime = excluded.mtime, size = excluded.size",
+                (
+                    (location, rel_path, stat.mtime, stat.size)
+                    for rel_path, stat in changed.items()
+                ),
+            )
+            self._set_signature(location, signature)
+
+    def entry(self, location: str, rel_path: str) -> Optional[FileStat]:
+        """Return the last known metadata of one file, if any."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT mtime, size FROM entries WHERE location = ? AND rel_path = ?",
+                (location, rel_path),
+            ).fetchone()
+        return FileStat(row[0], row[1]) if row else None
+
+    def digest(self, location: str, rel_path: str, stat: FileStat) -> Optional[str]:
+        """Return the stored fingerprint of a file if it is still current.
+
+        Args:
+            location: The location key.
+            rel_path: The file's relative path.
+            stat: The file's current metadata.
+
+        Returns:
+            The digest recorded for exactly this mtime and size, or None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT digest FROM entries WHERE location = ? AND rel_path = ? "
+                "AND mtime = ? AND size = ?",
+                (location, rel_path, stat.mtime, stat.size),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_digest(
+        self, location: str, rel_path: str, stat: FileStat, digest: str
+    ) -> None:
+        """Record the fingerprint of a file with the metadata it belongs to."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries "
+                "(location, rel_path, mtime, size, digest) VALUES (?, ?, ?, ?, ?)",
+                (location, rel_path, stat.mtime, stat.size, digest),
+            )
+
+    def _set_signature(self, location: str, signature: Optional[str]) -> None:
+        """Record the signature of a location; the caller holds the lock."""
+        self._conn.execute(
+            "INSERT OR REPLACE INTO locations (location, signature) VALUES (?, ?)",
+            (location, signature),
+        )
+
+
+def diff(prev: Snapshot, curr: Snapshot) -> Tuple[Snapshot, List[str]]:
+    """Return what changed between two snapshots of the same location.
+
+    Args:
+        prev: The older snapshot.
+        curr: The newer snapshot.
+
+    Returns:
+        A tuple of (changed entries, removed relative paths).
+    """
+    changed = {
+        rel_path: stat for rel_path, stat in curr.items() if prev.get(rel_path) != stat
+    }
+    removed = [rel_path for rel_path in prev if rel_path not in curr]
+    return changed, removed
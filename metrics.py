@@ -0,0 +1,388 @@
+from __future__ import annotations
+
+"""Counters and histograms of the engine's hot paths.
+
+Metrics are plain module-level objects updated from any thread. They can be
+served over HTTP in the Prometheus text format (:func:`serve`) and dumped
+to a JSON file at a fixed interval (:func:`start_json_dump`).
+"""
+
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from logger import log_err, log_info
+
+DEFAULT_JSON_INTERVAL = 30.0
+
+# Seconds, from a cached stat to a full rewrite of a large archive.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 50, 100, 500, 1000, 5000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric:
+    """A named metric with one series per combination of label values.
+
+    Attributes:
+        name: The metric name.
+        help: A one-line description.
+        labels: The label names every update must give.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        """Create a metric and register it."""
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        register(self)
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        """Return the series key of ``labels``, which must name every label."""
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}")
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _label_text(self, values: LabelValues, extra: str = "") -> str:
+        """Format label values for the text exposition format."""
+        pairs = [
+            f'{label}="{_escape(value)}"' for label, value in zip(self.labels, values)
+        ]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        """Return the metric's lines in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        """Return the sample lines of every series."""
+        raise NotImplementedError
+
+    def to_json(self) -> List[Dict[str, Any]]:
+        """Return every series as JSON-serializable dicts."""
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A value that only goes up, such as a number of bytes or events."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        """Create a counter and register it."""
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        """Add ``amount`` to the series of ``labels``."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            f"{self.name}{self._label_text(key)} {_number(value)}"
+            for key, value in values
+        ]
+
+    def to_json(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            {"labels": dict(zip(self.labels, key)), "value": value}
+            for key, value in values
+        ]
+
+
+class Gauge(Counter):
+    """A value that goes up and down, such as the length of a queue."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        """Set the series of ``labels`` to ``value``."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class _Series:
+    """The bucket counts, sum and count of one histogram series."""
+
+    def __init__(self, buckets: int) -> None:
+        """Create an empty series with ``buckets`` finite buckets."""
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(Metric):
+    """Observed values, such as durations, counted into fixed buckets.
+
+    Attributes:
+        buckets: The upper bounds of the finite buckets, in ascending order.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        """Create a histogram and register it."""
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelValues, _Series] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        """Record ``value`` in the series of ``labels``."""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(len(self.buckets))
+            series.counts[index] += 1
+            series.sum += value
+            series.count += 1
+
+    @contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        """Observe the duration of a ``with`` block, even if it raises."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def _copy(self) -> List[Tuple[LabelValues, List[int], float, int]]:
+        """Return a consistent copy of every series."""
+        with self._lock:
+            return [
+                (key, list(series.counts), series.sum, series.count)
+                for key, series in sorted(self._series.items())
+            ]
+
+    def _samples(self) -> List[str]:
+        lines: List[str] = []
+        bounds = [_number(bound) for bound in self.buckets] + ["+Inf"]
+        for key, counts, total, count in self._copy():
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                labels = self._label_text(key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_text(key)} {_number(total)}")
+            lines.append(f"{self.name}_count{self._label_text(key)} {count}")
+        return lines
+
+    def to_json(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "labels": dict(zip(self.labels, key)),
+                "buckets": dict(
+                    zip([str(bound) for bound in self.buckets] + ["+Inf"], counts)
+                ),
+                "sum": total,
+                "count": count,
+            }
+            for key, counts, total, count in self._copy()
+        ]
+
+
+def _escape(value: str) -> str:
+    """Escape a label value for the text exposition format."""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    """Format a sample value, without a fraction when it is whole."""
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+_registry: Dict[str, Metric] = {}
+_registry_lock = threading.Lock()
+
+
+def register(metric: Metric) -> None:
+    """Add a metric to the registry.
+
+    Raises:
+        ValueError: If a metric of the same name is already registered.
+    """
+    with _registry_lock:
+        if metric.name in _registry:
+            raise ValueError(f"Duplicate metric: {metric.name}")
+        _registry[metric.name] = metric
+
+
+def render_prometheus() -> str:
+    """Return every registered metric in the Prometheus text format."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines: List[str] = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def snapshot() -> Dict[str, Any]:
+    """Return every registered metric as a JSON-serializable dict."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return {
+        "time": time.time(),
+        "metrics": {
+            metric.name: {
+                "type": metric.kind,
+                "help": metric.help,
+                "series": metric.to_json(),
+            }
+            for metric in metrics
+        },
+    }
+
+
+SCAN_SECONDS = Histogram(
+    "filesync_scan_seconds",
+    "Time taken to scan a location.",
+    ("location", "backend"),
+)
+BATCH_EVENTS = Histogram(
+    "filesync_batch_events",
+    "File events handled per batch.",
+    buckets=COUNT_BUCKETS,
+)
+EVENTS = Counter(
+    "filesync_events_total",
+    "File events handled, by type.",
+    ("type",),
+)
+QUEUE_DEPTH = Gauge(
+    "filesync_queue_depth",
+    "File events queued, plus files held back until they settle.",
+)
+TRANSFERRED_BYTES = Counter(
+    "filesync_transferred_bytes_total",
+    "Bytes read from sources or written to destinations.",
+    ("backend", "direction"),
+)
+TRANSFER_SECONDS = Histogram(
+    "filesync_transfer_seconds",
+    "Time taken to fetch, write or apply a batch of files.",
+    ("backend", "op"),
+)
+FTP_COMMANDS = Counter(
+    "filesync_ftp_commands_total",
+    "FTP commands sent, each one a round trip to the server.",
+    ("host",),
+)
+PAYLOAD_CACHE = Counter(
+    "filesync_payload_cache_total",
+    "Payload cache lookups, by result (hit or miss).",
+    ("result",),
+)
+ZIP_WRITE_SECONDS = Histogram(
+    "filesync_zip_write_seconds",
+    "Time taken to update or compact a ZIP archive.",
+    ("op",),
+)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """Serves ``/metrics``; every other path is not found."""
+
+    def do_GET(self) -> None:
+        """Answer a scrape."""
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        """Keep scrapes out of the console."""
+
+
+def serve(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve ``/metrics`` on a daemon thread.
+
+    Args:
+        port: The port to listen on; 0 picks a free one.
+        host: The address to bind, the loopback interface by default.
+
+    Returns:
+        The running server.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log_info(f"Serving metrics at http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+def write_json(path: str) -> None:
+    """Write :func:`snapshot` to ``path`` atomically."""
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp_name = tempfile.mkstemp(suffix=".tmp", dir=folder)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as file_obj:
+            json.dump(snapshot(), file_obj, indent=1)
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.remove(tmp_name)
+        except OSError:
+            pass
+        raise
+
+
+def start_json_dump(
+    path: str, interval: float = DEFAULT_JSON_INTERVAL
+) -> Optional[threading.Thread]:
+    """Dump the metrics to ``path`` every ``interval`` seconds on a daemon thread.
+
+    Returns:
+        The dumping thread, or None if ``interval`` is not positive.
+    """
+    if interval <= 0:
+        return None
+
+    def loop() -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                write_json(path)
+            except OSError as exc:
+                log_err(f"Could not write metrics to {path}: {exc}")
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
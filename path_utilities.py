@@ -8,6 +8,23 @@ from typing import Union
 
 from result import Result
 
+# Suffix of the files a batch stages before renaming them into place.
+STAGING_SUFFIX = ".filesync-part"
+
+
+def staging_name(name: str) -> str:
+    """Return the hidden name a file is staged under before it is committed.
+
+    Args:
+        name: The file name, without directories.
+    """
+    return f".{name}{STAGING_SUFFIX}"
+
+
+def is_staging_name(name: str) -> bool:
+    """Return True if ``name`` (or a path ending in it) is a staged file."""
+    return name.endswith(STAGING_SUFFIX)
+
 
 def is_valid_path(path: Union[str, Path]) -> Result:
     """Validate that the given path is an existing directory.
@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+"""A bounded cache of fetched payloads, so each source is read only once."""
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Tuple
+
+import metrics
+import transfer
+from logger import log_err
+from snapshot import FileStat
+from transfer import Payload
+
+DEFAULT_MEMORY_LIMIT = 64 * 1024 * 1024
+DEFAULT_DISK_LIMIT = 1024 * 1024 * 1024
+
+CacheKey = Tuple[str, str, FileStat]
+
+
+class _Entry:
+    """A cached payload and the number of callers using it."""
+
+    __slots__ = ("payload", "refs")
+
+    def __init__(self, payload: Payload) -> None:
+        """Wrap a payload owned by the cache."""
+        self.payload = payload
+        self.refs = 0
+
+
+class PayloadCache:
+    """Payloads fetched from ZIP archives and FTP servers, in LRU order.
+
+    Entries are keyed by (location key, relative path, file metadata), so a
+    changed file is never served from the cache. Callers get a view of the
+    cached payload, and releasing the view only unpins the entry.
+
+    Small payloads are kept in memory; when they exceed ``memory_limit``
+    the least recently used ones spill to temporary files. Once temporary
+    files exceed ``disk_limit`` the least recently used unpinned entries
+    are dropped. Payloads reading a live local file are not cached, since
+    reading them again costs nothing.
+
+    Attributes:
+        memory_limit: Bytes of payloads kept in memory.
+        disk_limit: Bytes of payloads kept in temporary files.
+        hits: Fetches served from the cache.
+        misses: Fetches that had to read the source.
+
+    Hits and misses are also counted in :data:`metrics.PAYLOAD_CACHE`.
+    """
+
+    def __init__(
+        self,
+        memory_limit: int = DEFAULT_MEMORY_LIMIT,
+        disk_limit: int = DEFAULT_DISK_LIMIT,
+    ) -> None:
+        """Create an empty cache."""
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[CacheKey, _Entry]" = OrderedDict()
+
+    def fetch(self, key: CacheKey, fetch: Callable[[], Payload]) -> Payload:
+        """Return the payload cached under ``key``, fetching it on a miss.
+
+        Args:
+            key: The location key, relative path and metadata of the file.
+            fetch: Reads the file when it is not cached.
+
+        Returns:
+            A payload the caller must ``release()`` when done.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                metrics.PAYLOAD_CACHE.inc(result="hit")
+                return self._pin(key, entry)
+            self.misses += 1
+        metrics.PAYLOAD_CACHE.inc(result="miss")
+
+        payload = fetch()
+        if not payload.is_copy or payload.size > self.disk_limit:
+            return payload
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry(payload)
+            else:
+                # Fetched concurrently by another caller; keep theirs.
+                payload.release()
+            view = self._pin(key, entry)
+            self._trim()
+            return view
+
+    def _pin(self, key: CacheKey, entry: _Entry) -> Payload:
+        """Return a view of a cached payload that unpins it when released."""
+        entry.refs += 1
+        self._entries.move_to_end(key)
+        payload = entry.payload
+
+        def unpin() -> None:
+            with self._lock:
+                entry.refs -= 1
+                self._trim()
+
+        return Payload(payload.open, payload.size, payload.local_path, unpin)
+
+    def _trim(self) -> None:
+        """Spill and evict entries until both limits are met (lock held)."""
+        in_memory = sum(
+            entry.payload.size
+            for entry in self._entries.values()
+            if entry.payload.local_path is None
+        )
+        for entry in list(self._entries.values()):
+            if in_memory <= self.memory_limit:
+                break
+            payload = entry.payload
+            if payload.local_path is not None:
+                continue
+            try:
+                with payload.open() as src:
+                    entry.payload = transfer.spool_stream(src, memory_limit=0)
+            except OSError as exc:
+                log_err(f"Could not spill cached payload to disk: {exc}")
+                break
+            in_memory -= payload.size
+
+        on_disk = sum(
+            entry.payload.size
+            for entry in self._entries.values()
+            if entry.payload.local_path is not None
+        )
+        for key, entry in list(self._entries.items()):
+            if on_disk <= self.disk_limit:
+                break
+            if entry.refs or entry.payload.local_path is None:
+                continue
+            del self._entries[key]
+            entry.payload.release()
+            on_disk -= entry.payload.size
+
+    def clear(self) -> None:
+        """Drop every unpinned entry and its temporary storage."""
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if not entry.refs:
+                    del self._entries[key]
+                    entry.payload.release()
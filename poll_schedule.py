@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+"""Adaptive polling intervals: fast while a location changes, slow when idle."""
+
+import re
+from typing import Dict, NamedTuple
+
+from result import Result
+
+
+class PollSettings(NamedTuple):
+    """Polling bounds for one location type.
+
+    Attributes:
+        poll_min: Interval in seconds right after a change was seen.
+        poll_max: Longest interval an idle location backs off to.
+        poll_backoff: Factor applied to the interval after each idle poll.
+    """
+
+    poll_min: float
+    poll_max: float
+    poll_backoff: float = 2.0
+
+
+DEFAULT_POLL_SETTINGS: Dict[str, PollSettings] = {
+    "folder": PollSettings(1.0, 10.0, 1.5),
+    "zip": PollSettings(1.0, 30.0, 2.0),
+    "ftp": PollSettings(5.0, 120.0, 2.0),
+}
+
+_SETTING_LINE = re.compile(r"^(\w+)\.(poll_\w+)\s*=\s*(\S+)$")
+
+
+def is_setting_line(line: str) -> bool:
+    """Return True if a paths-file line looks like ``ftp.poll_max=300``."""
+    return _SETTING_LINE.match(line.strip()) is not None
+
+
+def parse_setting(line: str, settings: Dict[str, PollSettings]) -> Result:
+    """Apply one ``<type>.<setting>=<seconds>`` line to ``settings``.
+
+    Args:
+        line: The line, e.g. ``ftp.poll_min=5`` or ``zip.poll_backoff=1.5``.
+        settings: The settings per location type, updated in place.
+
+    Returns:
+        Result.Ok(PollSettings) with the new settings of that type, otherwise
+        Result.Err(str).
+    """
+    match = _SETTING_LINE.match(line.strip())
+    if match is None:
+        return Result.Err(f"Invalid setting. [{line}]")
+
+    location_type, name, text = match.groups()
+    if location_type not in settings:
+        return Result.Err(f"Unknown location type in setting. [{line}]")
+    if name not in PollSettings._fields:
+        return Result.Err(f"Unknown setting. [{line}]")
+
+    try:
+        value = float(text)
+    except ValueError:
+        return Result.Err(f"Setting value is not a number. [{line}]")
+
+    updated = settings[location_type]._replace(**{name: value})
+    if updated.poll_min <= 0 or updated.poll_backoff < 1:
+        return Result.Err(f"Setting out of range. [{line}]")
+    if updated.poll_max < updated.poll_min:
+        updated = updated._replace(poll_max=updated.poll_min)
+
+    settings[location_type] = updated
+    return Result.Ok(updated)
+
+
+class PollSchedule:
+    """The polling interval of one location.
+
+    The interval drops to ``poll_min`` whenever a poll finds changes and is
+    multiplied by ``poll_backoff`` (up to ``poll_max``) after every poll
+    that finds none.
+
+    Attributes:
+        settings: The bounds in use.
+        interval: Seconds to wait before the next poll.
+    """
+
+    def __init__(self, settings: PollSettings) -> None:
+        """Create a schedule starting at the shortest interval."""
+        self.settings = settings
+        self.interval = settings.poll_min
+
+    def record(self, changed: bool) -> float:
+        """Adjust the interval after a poll.
+
+        Args:
+            changed: Whether the poll found any change.
+
+        Returns:
+            The interval until the next poll.
+        """
+        if changed:
+            self.interval = self.settings.poll_min
+        else:
+            self.interval = min(
+                self.interval * self.settings.poll_backoff, self.settings.poll_max
+            )
+        return self.interval
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+"""Progress and throughput reporting for long-running transfer phases."""
+
+import threading
+import time
+
+from logger import log_info
+
+DEFAULT_INTERVAL = 2.0
+
+_UNITS = ("B", "KiB", "MiB", "GiB", "TiB")
+
+
+def format_bytes(count: float) -> str:
+    """Return a byte count in human-readable binary units, e.g. ``1.5 MiB``."""
+    for unit in _UNITS[:-1]:
+        if abs(count) < 1024:
+            return f"{count:.0f} {unit}" if unit == "B" else f"{count:.1f} {unit}"
+        count /= 1024
+    return f"{count:.1f} {_UNITS[-1]}"
+
+
+class TransferProgress:
+    """Counts finished transfers and logs progress at most every ``interval``.
+
+    Safe to update from several worker threads.
+
+    Attributes:
+        label: The phase name used in log lines.
+        total_files: The number of transfers planned.
+        total_bytes: Their combined size in bytes.
+        files: The transfers finished so far, including failed ones.
+        failed: The transfers that failed.
+        bytes: The bytes of the successful transfers.
+    """
+
+    def __init__(
+        self,
+        label: str,
+        total_files: int,
+        total_bytes: int,
+        interval: float = DEFAULT_INTERVAL,
+    ) -> None:
+        """Start measuring a phase."""
+        self.label = label
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.files = 0
+        self.failed = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._next_report = self._started + interval
+
+    def advance(self, size: int, failed: bool = False) -> None:
+        """Record a finished transfer of ``size`` bytes, or a failed one."""
+        with self._lock:
+            self.files += 1
+            if failed:
+                self.failed += 1
+            else:
+                self.bytes += max(0, size)
+            now = time.monotonic()
+            if now < self._next_report:
+                return
+            self._next_report = now + self.interval
+            line = self._line(now)
+        log_info(line)
+
+    def finish(self) -> None:
+        """Log the totals of the phase."""
+        with self._lock:
+            line = self._line(time.monotonic())
+        log_info(f"{line}, done")
+
+    def _line(self, now: float) -> str:
+        """Describe the progress so far (lock held)."""
+        elapsed = max(now - self._started, 1e-6)
+        failed = f" ({self.failed} failed)" if self.failed else ""
+        return (
+            f"{self.label}: {self.files}/{self.total_files} files{failed}, "
+            f"{format_bytes(self.bytes)} of {format_bytes(self.total_bytes)} "
+            f"in {elapsed:.1f}s ({format_bytes(self.bytes / elapsed)}/s)"
+        )
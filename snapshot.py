@@ -0,0 +1,20 @@
+from __future__ import annotations
+
+"""Structures describing the files present in a location at a point in time."""
+
+from typing import Dict, NamedTuple
+
+
+class FileStat(NamedTuple):
+    """Metadata of a single file in a location.
+
+    Attributes:
+        mtime: Modification time as a Unix timestamp.
+        size: Size in bytes, or -1 when the backend does not report it.
+    """
+
+    mtime: float
+    size: int = -1
+
+
+Snapshot = Dict[str, FileStat]
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+"""Shared fixtures: the project's flat modules and a local FTP server."""
+
+import os
+import sys
+import threading
+from ftplib import FTP
+from typing import Callable, Iterable, Iterator, List
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+USER = "user"
+PASSWORD = "secret"
+
+
+class CountingFTP(FTP):
+    """An FTP client that counts the commands it sends."""
+
+    commands = 0
+
+    def putcmd(self, line: str) -> None:
+        """Send a command line, counting it."""
+        self.commands += 1
+        super().putcmd(line)
+
+
+@pytest.fixture
+def ftp_server() -> Iterator[Callable[..., int]]:
+    """Start pyftpdlib servers on demand and stop them after the test.
+
+    The fixture is a function ``serve(root, disabled=())`` serving ``root``
+    to ``USER``/``PASSWORD`` with the commands in ``disabled`` rejected
+    as unknown (500); it returns the port.
+    """
+    pytest.importorskip("pyftpdlib")
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.ioloop import IOLoop
+    from pyftpdlib.servers import FTPServer
+
+    servers: List[FTPServer] = []
+    threads: List[threading.Thread] = []
+
+    def serve(root: str, disabled: Iterable[str] = ()) -> int:
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(USER, PASSWORD, root, perm="elradfmwMT")
+        rejected = set(disabled)
+        handler = type(
+            "Handler",
+            (FTPHandler,),
+            {
+                "authorizer": authorizer,
+                "proto_cmds": {
+                    cmd: info
+                    for cmd, info in FTPHandler.proto_cmds.items()
+                    if cmd not in rejected
+                },
+            },
+        )
+        # Each server runs its own loop on its own thread.
+        server = FTPServer(("127.0.0.1", 0), handler, ioloop=IOLoop())
+        thread = threading.Thread(
+            target=server.serve_forever,
+            kwargs={"timeout": 0.05, "handle_exit": False},
+            daemon=True,
+        )
+        thread.start()
+        servers.append(server)
+        threads.append(thread)
+        return server.address[1]
+
+    yield serve
+
+    for server in servers:
+        server.close_all()
+    for thread in threads:
+        thread.join(timeout=5)
+
+
+def connect(port: int) -> CountingFTP:
+    """Log in to a server started by the ``ftp_server`` fixture."""
+    ftp = CountingFTP()
+    ftp.connect("127.0.0.1", port, timeout=10)
+    ftp.login(USER, PASSWORD)
+    ftp.commands = 0
+    return ftp
@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+from typing import Dict, List, Set
+
+from batch import Batch, split
+from transfer import Payload
+
+
+class Recording(Batch):
+    """A batch remembering what each apply committed."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.commits: List[Set[str]] = []
+
+    def _commit(self, writes: Dict[str, Payload], deletes: Set[str]) -> None:
+        self.commits.append(set(writes) | deletes)
+
+
+def test_split_keeps_order_and_limit():
+    assert split([3, 4, 2, 5, 1], lambda size: size, limit=6) == [
+        [3],
+        [4, 2],
+        [5, 1],
+    ]
+
+
+def test_split_gives_large_items_a_part_of_their_own():
+    assert split([1, 10, 1, -1], lambda size: size, limit=5) == [[1], [10], [1, -1]]
+    assert split([], lambda size: size) == []
+
+
+def test_large_writes_wait_for_apply():
+    batch = Recording()
+    batch.write("big.bin", Payload.from_bytes(b"x" * 1000))
+    batch.write("more.bin", Payload.from_bytes(b"y" * 1000))
+    batch.delete("old.bin")
+
+    assert batch.commits == []
+    batch.apply()
+    assert batch.commits == [{"big.bin", "more.bin", "old.bin"}]
+    assert batch.applied_bytes == 2000
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+from typing import Any, Dict
+
+from coalesce import Coalescer
+from locations import FolderLocation
+
+A = FolderLocation("/a")
+B = FolderLocation("/b")
+
+
+def event(kind: str, rel_path: str, location=A) -> Dict[str, Any]:
+    return {"type": kind, "location": location, "rel_path": rel_path}
+
+
+def test_burst_collapses_into_the_final_event():
+    coalescer = Coalescer(window=0.5, max_latency=5.0)
+    coalescer.add(event("created", "f.txt"), now=0.0)
+    coalescer.add(event("updated", "f.txt"), now=0.1)
+    coalescer.add(event("deleted", "f.txt"), now=0.2)
+
+    assert len(coalescer) == 1
+    assert coalescer.pop_due(now=0.6) == []
+    assert coalescer.pop_due(now=0.7) == [event("deleted", "f.txt")]
+    assert len(coalescer) == 0
+
+
+def test_latest_event_of_each_location_is_kept():
+    coalescer = Coalescer(window=0.5)
+    coalescer.add(event("updated", "f.txt", A), now=0.0)
+    coalescer.add(event("updated", "f.txt", B), now=0.1)
+    coalescer.add(event("deleted", "f.txt", A), now=0.2)
+
+    assert coalescer.pop_due(now=1.0) == [
+        event("deleted", "f.txt", A),
+        event("updated", "f.txt", B),
+    ]
+
+
+def test_files_are_released_independently():
+    coalescer = Coalescer(window=0.5)
+    coalescer.add(event("created", "early.txt"), now=0.0)
+    coalescer.add(event("created", "late.txt"), now=0.4)
+
+    assert coalescer.next_due() == 0.5
+    assert coalescer.pop_due(now=0.5) == [event("created", "early.txt")]
+    assert coalescer.next_due() == 0.9
+
+
+def test_busy_file_is_released_after_max_latency():
+    coalescer = Coalescer(window=0.5, max_latency=2.0)
+    for step in range(10):
+        coalescer.add(event("updated", "busy.log"), now=step * 0.3)
+
+    assert coalescer.next_due() == 2.0
+    assert coalescer.pop_due(now=2.0) == [event("updated", "busy.log")]
+
+
+def test_limits_are_clamped():
+    coalescer = Coalescer(window=-1.0, max_latency=0.0)
+
+    assert (coalescer.window, coalescer.max_latency) == (0.0, 0.0)
+    assert coalescer.next_due() is None
+    coalescer.add(event("created", "f.txt"), now=3.0)
+    assert coalescer.pop_due(now=3.0) == [event("created", "f.txt")]
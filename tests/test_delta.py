@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import random
+
+import delta
+from snapshot import FileStat
+from transfer import Payload
+
+BLOCK = 64
+OLD = random.Random(1).randbytes(BLOCK * 40 + 17)
+
+
+def diff(old: bytes, new: bytes) -> delta.Delta:
+    base = delta.signature_of(Payload.from_bytes(old), block_size=BLOCK)
+    return delta.compute(base, Payload.from_bytes(new))
+
+
+def rebuild(old: bytes, new: bytes, change: delta.Delta) -> bytes:
+    """Apply a delta the way a receiver would: copy old runs, take literals."""
+    out = b""
+    for seg in change.segments:
+        if seg.base >= 0:
+            out += old[seg.base : seg.base + seg.length]
+        else:
+            out += new[seg.offset : seg.offset + seg.length]
+    return out
+
+
+def test_segments_cover_the_new_version_in_order():
+    new = OLD[:1000] + b"changed" + OLD[1007:]
+    change = diff(OLD, new)
+
+    offset = 0
+    for seg in change.segments:
+        assert seg.offset == offset
+        offset += seg.length
+    assert offset == change.size == len(new)
+    assert rebuild(OLD, new, change) == new
+
+
+def test_unchanged_file_sends_nothing():
+    change = diff(OLD, OLD)
+
+    assert change.literal_bytes == 0
+    assert change.in_place and change.is_append
+    assert change.segments == [delta.Segment(0, len(OLD), 0)]
+
+
+def test_append_is_recognised():
+    new = OLD + b"more data"
+    change = diff(OLD, new)
+
+    assert change.is_append
+    assert change.literal_bytes == len(b"more data")
+    assert rebuild(OLD, new, change) == new
+
+
+def test_in_place_edit_sends_one_block():
+    new = OLD[: BLOCK * 10 + 5] + b"X" + OLD[BLOCK * 10 + 6 :]
+    change = diff(OLD, new)
+
+    assert change.in_place and not change.is_append
+    assert change.literal_bytes == BLOCK
+    assert rebuild(OLD, new, change) == new
+
+
+def test_insertion_is_found_by_rolling():
+    new = OLD[: BLOCK * 5] + b"inserted" + OLD[BLOCK * 5 :]
+    change = diff(OLD, new)
+
+    assert not change.in_place
+    assert change.literal_bytes <= BLOCK + len(b"inserted")
+    assert rebuild(OLD, new, change) == new
+
+
+def test_deletion_is_found_by_rolling():
+    new = OLD[: BLOCK * 5 + 3] + OLD[BLOCK * 5 + 13 :]
+    change = diff(OLD, new)
+
+    assert change.literal_bytes < 2 * BLOCK
+    assert rebuild(OLD, new, change) == new
+
+
+def test_long_insertion_resyncs_afterwards():
+    inserted = random.Random(2).randbytes(BLOCK * delta.RESYNC_BLOCKS + 7)
+    new = OLD[: BLOCK * 3] + inserted + OLD[BLOCK * 3 :]
+    change = diff(OLD, new)
+
+    assert change.literal_bytes < len(inserted) + 2 * BLOCK
+    assert rebuild(OLD, new, change) == new
+
+
+def test_local_payloads_are_memory_mapped(tmp_path):
+    path = tmp_path / "old.bin"
+    path.write_bytes(OLD)
+
+    from_file = delta.signature_of(Payload.from_file(path), block_size=BLOCK)
+    from_bytes = delta.signature_of(Payload.from_bytes(OLD), block_size=BLOCK)
+
+    assert from_file.weak == from_bytes.weak
+    assert from_file.strong == from_bytes.strong
+    assert from_file.tail == len(OLD) % BLOCK
+
+
+def test_signature_cache_checks_metadata_and_evicts_oldest():
+    cache = delta.SignatureCache(max_entries=2)
+    signature = delta.signature_of(Payload.from_bytes(OLD), block_size=BLOCK)
+    stat = FileStat(1.0, len(OLD))
+
+    cache.put("folder:a", "one", stat, signature)
+    assert cache.get("folder:a", "one", stat) is signature
+    assert cache.get("folder:a", "one", FileStat(2.0, len(OLD))) is None
+
+    cache.put("folder:a", "two", stat, signature)
+    cache.get("folder:a", "one", stat)
+    cache.put("folder:a", "three", stat, signature)
+
+    assert cache.get("folder:a", "one", stat) is signature
+    assert cache.get("folder:a", "two", stat) is None
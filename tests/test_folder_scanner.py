@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import os
+import time
+
+import pytest
+
+from folder_scanner import FolderScanner
+from snapshot import FileStat
+
+PAST = time.time() - 3600
+
+
+def write(root, rel_path: str, data: bytes = b"") -> str:
+    full = os.path.join(str(root), *rel_path.split("/"))
+    os.makedirs(os.path.dirname(full), exist_ok=True)
+    with open(full, "wb") as file_obj:
+        file_obj.write(data)
+    return full
+
+
+def age_dirs(root) -> None:
+    """Move every directory's mtime out of the racy window, so it is cached."""
+    for folder, _, _ in os.walk(str(root)):
+        os.utime(folder, (PAST, PAST))
+
+
+def test_scan_lists_nested_files_with_sizes(tmp_path):
+    write(tmp_path, "top.txt", b"abc")
+    full = write(tmp_path, "a/b/c.bin", b"\x00" * 10)
+    write(tmp_path, "a/.c.bin.filesync-part", b"staged")
+
+    snapshot = FolderScanner(tmp_path).scan()
+
+    assert set(snapshot) == {"top.txt", os.path.join("a", "b", "c.bin")}
+    assert snapshot[os.path.join("a", "b", "c.bin")] == FileStat(
+        os.stat(full).st_mtime, 10
+    )
+
+
+def test_cached_directory_still_sees_in_place_writes(tmp_path):
+    full = write(tmp_path, "a/file.txt", b"one")
+    age_dirs(tmp_path)
+    scanner = FolderScanner(tmp_path)
+    scanner.scan()
+
+    with open(full, "ab") as file_obj:
+        file_obj.write(b" two")
+    os.utime(full, (PAST + 60, PAST + 60))
+    age_dirs(tmp_path)
+
+    assert scanner.scan()[os.path.join("a", "file.txt")] == FileStat(PAST + 60, 7)
+
+
+def test_added_and_removed_files_are_found(tmp_path):
+    write(tmp_path, "a/old.txt")
+    age_dirs(tmp_path)
+    scanner = FolderScanner(tmp_path)
+    scanner.scan()
+
+    os.remove(os.path.join(str(tmp_path), "a", "old.txt"))
+    write(tmp_path, "a/new.txt")
+    write(tmp_path, "a/sub/deep.txt")
+
+    assert set(scanner.scan()) == {
+        os.path.join("a", "new.txt"),
+        os.path.join("a", "sub", "deep.txt"),
+    }
+
+
+def test_removed_cached_file_is_dropped(tmp_path):
+    write(tmp_path, "a/gone.txt")
+    age_dirs(tmp_path)
+    scanner = FolderScanner(tmp_path)
+    scanner.scan()
+
+    os.remove(os.path.join(str(tmp_path), "a", "gone.txt"))
+    # Pretend the directory mtime did not move, as on coarse filesystems.
+    age_dirs(tmp_path)
+
+    assert scanner.scan() == {}
+
+
+@pytest.mark.skipif(not hasattr(os, "symlink"), reason="needs symlinks")
+def test_symlinked_directories_are_not_followed(tmp_path):
+    outside = tmp_path / "outside"
+    write(outside, "secret.txt")
+    root = tmp_path / "root"
+    write(root, "inside.txt")
+    os.symlink(str(outside), str(root / "link"), target_is_directory=True)
+
+    assert set(FolderScanner(root).scan()) == {"inside.txt"}
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+import folder_store
+from folder_store import FolderBatch
+from transfer import Payload
+
+
+def tree(root) -> dict:
+    """Every file under ``root``, hidden ones included, with its contents."""
+    files = {}
+    for folder, _, names in os.walk(str(root)):
+        for name in names:
+            full = os.path.join(folder, name)
+            with open(full, "rb") as file_obj:
+                files[os.path.relpath(full, str(root))] = file_obj.read()
+    return files
+
+
+@pytest.fixture
+def root(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "kept.txt").write_bytes(b"old kept")
+    (tmp_path / "sub" / "changed.txt").write_bytes(b"old changed")
+    (tmp_path / "gone.txt").write_bytes(b"old gone")
+    return tmp_path
+
+
+def test_batch_replaces_and_deletes(root):
+    batch = FolderBatch(str(root))
+    batch.write(os.path.join("sub", "changed.txt"), Payload.from_bytes(b"new"))
+    batch.write("added.txt", Payload.from_bytes(b"added"))
+    batch.delete("gone.txt")
+
+    batch.apply()
+
+    assert tree(root) == {
+        "kept.txt": b"old kept",
+        os.path.join("sub", "changed.txt"): b"new",
+        "added.txt": b"added",
+    }
+    assert batch.applied_bytes == 8
+
+
+def test_failed_rename_restores_the_folder(root, monkeypatch):
+    before = tree(root)
+    batch = FolderBatch(str(root))
+    batch.write(os.path.join("sub", "changed.txt"), Payload.from_bytes(b"new"))
+    batch.write("added.txt", Payload.from_bytes(b"added"))
+    batch.write("kept.txt", Payload.from_bytes(b"new kept"))
+    batch.delete("gone.txt")
+
+    renames = []
+    commit = folder_store.commit
+
+    def failing_commit(staged: str, dest: str) -> None:
+        renames.append(dest)
+        if len(renames) == 3:
+            raise OSError("disk full")
+        commit(staged, dest)
+
+    monkeypatch.setattr(folder_store, "commit", failing_commit)
+    with pytest.raises(OSError):
+        batch.apply()
+
+    assert len(renames) == 3
+    assert tree(root) == before
+
+
+def test_failed_delete_restores_the_folder(root, monkeypatch):
+    before = tree(root)
+    batch = FolderBatch(str(root))
+    batch.write("kept.txt", Payload.from_bytes(b"new kept"))
+    batch.delete("gone.txt")
+    batch.delete(os.path.join("sub", "changed.txt"))
+
+    replace = os.replace
+
+    def failing_replace(src, dst) -> None:
+        if os.path.basename(str(src)) == "changed.txt":
+            raise PermissionError("read-only")
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+    with pytest.raises(PermissionError):
+        batch.apply()
+    monkeypatch.undo()
+
+    assert tree(root) == before
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import os
+
+from conftest import connect
+
+from ftp_listing import STRATEGY_LIST, STRATEGY_MLSD, FtpTreeLister
+from path_utilities import is_staging_name
+
+MTIME = 1_700_000_000
+
+
+def make_tree(root: str) -> dict:
+    """Create a small nested tree and return its files mapped to sizes."""
+    files = {
+        "top.txt": b"top",
+        "sub/a.txt": b"alpha",
+        "sub/deeper/b.bin": b"\x00" * 1000,
+        "other/c.txt": b"",
+        "sub/.a.txt.filesync-part": b"staged",
+    }
+    for rel_path, data in files.items():
+        full = os.path.join(root, *rel_path.split("/"))
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, "wb") as file_obj:
+            file_obj.write(data)
+        os.utime(full, (MTIME, MTIME))
+    return {
+        rel_path: len(data)
+        for rel_path, data in files.items()
+        if not is_staging_name(rel_path.rsplit("/", 1)[-1])
+    }
+
+
+def listing(lister: FtpTreeLister, port: int) -> dict:
+    ftp = connect(port)
+    try:
+        return lister.list_tree(ftp)
+    finally:
+        ftp.close()
+
+
+def test_mlsd_lists_names_sizes_and_mtimes(tmp_path, ftp_server):
+    expected = make_tree(str(tmp_path))
+    port = ftp_server(str(tmp_path))
+
+    lister = FtpTreeLister("/")
+    snapshot = listing(lister, port)
+
+    assert lister.strategy == STRATEGY_MLSD
+    assert {rel: stat.size for rel, stat in snapshot.items()} == expected
+    assert {stat.mtime for stat in snapshot.values()} == {MTIME}
+
+
+def test_list_is_used_without_mlst(tmp_path, ftp_server):
+    expected = make_tree(str(tmp_path))
+    port = ftp_server(str(tmp_path), disabled=("MLST", "MLSD"))
+
+    lister = FtpTreeLister("/")
+    snapshot = listing(lister, port)
+
+    assert lister.strategy == STRATEGY_LIST
+    assert {rel: stat.size for rel, stat in snapshot.items()} == expected
+    # MDTM gives the exact time LIST only shows to the minute.
+    assert {stat.mtime for stat in snapshot.values()} == {MTIME}
+
+
+def test_rejected_mlsd_falls_back_to_list(tmp_path, ftp_server):
+    expected = make_tree(str(tmp_path))
+    # FEAT still advertises MLST, but MLSD itself is answered with 500.
+    port = ftp_server(str(tmp_path), disabled=("MLSD",))
+
+    lister = FtpTreeLister("/")
+    snapshot = listing(lister, port)
+
+    assert lister.strategy == STRATEGY_LIST
+    assert {rel: stat.size for rel, stat in snapshot.items()} == expected
+
+
+def test_round_trips_per_strategy(tmp_path, ftp_server):
+    files = make_tree(str(tmp_path))
+    directories = 4  # /, sub, sub/deeper and other
+    mlsd_port = ftp_server(str(tmp_path))
+    list_port = ftp_server(str(tmp_path), disabled=("MLST", "MLSD"))
+
+    def commands(lister: FtpTreeLister, port: int) -> int:
+        ftp = connect(port)
+        try:
+            lister.list_tree(ftp)
+            return ftp.commands
+        finally:
+            ftp.close()
+
+    mlsd = FtpTreeLister("/")
+    commands(mlsd, mlsd_port)  # FEAT
+    per_listing = commands(mlsd, mlsd_port)
+
+    fallback = FtpTreeLister("/")
+    commands(fallback, list_port)
+    cached = commands(fallback, list_port)
+    fallback._list_cache.clear()
+    uncached = commands(fallback, list_port)
+
+    # One listing per directory, whatever the number of files...
+    assert per_listing % directories == 0
+    assert cached == per_listing
+    # ...while LIST needs one MDTM per file it has not seen before.
+    assert uncached == cached + len(files)
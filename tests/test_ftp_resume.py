@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import hashlib
+import os
+from io import BytesIO
+
+import ftp_pool
+import ftp_resume
+from conftest import PASSWORD, USER
+from locations import FtpLocation
+from path_utilities import staging_name
+from payload_cache import PayloadCache
+from transfer import Payload
+
+MIB = 1024 * 1024
+NEW = bytes(range(256)) * (10 * MIB // 256)
+OLD = b"\xee" * (9 * MIB)
+
+
+class LocalPool(ftp_pool.FtpPool):
+    """A pool connecting to the test server's port."""
+
+    def __init__(self, port: int) -> None:
+        super().__init__("127.0.0.1", USER, PASSWORD, timeout=10)
+        self.port = port
+
+    def _connect(self) -> ftp_pool.CountingFTP:
+        ftp = ftp_pool.CountingFTP(timeout=self.timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login(self.username, self.password)
+        return ftp
+
+
+class Dropping(BytesIO):
+    """A reader that loses the connection after ``limit`` bytes."""
+
+    def __init__(self, data: bytes, limit: int) -> None:
+        super().__init__(data)
+        self.limit = limit
+
+    def read(self, size: int = -1) -> bytes:
+        if self.tell() >= self.limit:
+            raise ConnectionResetError("connection dropped")
+        return super().read(size)
+
+
+def read(payload: Payload) -> bytes:
+    with payload.open() as file_obj:
+        return file_obj.read()
+
+
+def location_on(ftp_server, tmp_path, monkeypatch) -> FtpLocation:
+    root = tmp_path / "remote"
+    root.mkdir()
+    pool = LocalPool(ftp_server(str(root)))
+    monkeypatch.setattr(ftp_pool, "get_pool", lambda *args: pool)
+    monkeypatch.setattr(ftp_resume, "RETRY_DELAY", 0.0)
+    ftp_resume.configure(state_dir=str(tmp_path / "state"))
+    return FtpLocation("127.0.0.1", USER, PASSWORD, "/")
+
+
+def new_transfer(location: FtpLocation) -> ftp_resume.PartialTransfer:
+    version = {"size": len(NEW), "sha256": hashlib.sha256(NEW).hexdigest()}
+    return ftp_resume.PartialTransfer("upload", location.key, "big.bin", version)
+
+
+def test_stale_state_does_not_resume_over_older_file(
+    ftp_server, tmp_path, monkeypatch
+):
+    location = location_on(ftp_server, tmp_path, monkeypatch)
+    remote = tmp_path / "remote"
+    (remote / "big.bin").write_bytes(OLD)
+    (remote / staging_name("big.bin")).write_bytes(OLD)
+    # Left by an earlier run that stopped before the server took the upload.
+    new_transfer(location).start()
+
+    location.write("big.bin", Payload.from_bytes(NEW))
+
+    assert (remote / "big.bin").read_bytes() == NEW
+    assert not (remote / staging_name("big.bin")).exists()
+    assert not new_transfer(location).resumable()
+
+
+def test_dropped_upload_resumes_from_stored_bytes(
+    ftp_server, tmp_path, monkeypatch
+):
+    location = location_on(ftp_server, tmp_path, monkeypatch)
+    remote = tmp_path / "remote"
+    (remote / "big.bin").write_bytes(OLD)
+    opened = []
+    resumed = []
+
+    def opener() -> BytesIO:
+        opened.append(1)
+        # The first reader computes the checksum, the second one uploads.
+        if len(opened) == 2:
+            return Dropping(NEW, 4 * MIB)
+        return BytesIO(NEW)
+
+    def log_info(message: str) -> None:
+        resumed.append(message)
+
+    monkeypatch.setattr(ftp_resume, "log_info", log_info)
+    location.write("big.bin", Payload(opener, len(NEW)))
+
+    assert (remote / "big.bin").read_bytes() == NEW
+    assert len(resumed) == 1 and "Resuming upload" in resumed[0]
+
+
+def test_cached_downloads_of_two_versions_keep_their_bytes(
+    ftp_server, tmp_path, monkeypatch
+):
+    location = location_on(ftp_server, tmp_path, monkeypatch)
+    remote = tmp_path / "remote" / "big.bin"
+    cache = PayloadCache(memory_limit=0, disk_limit=len(OLD) + len(NEW))
+
+    def fetch_version(data: bytes, mtime: float):
+        remote.write_bytes(data)
+        os.utime(remote, (mtime, mtime))
+        stat = location.stat("big.bin")
+        return stat, cache.fetch((location.key, "big.bin", stat), fetch_one)
+
+    def fetch_one() -> Payload:
+        return location.fetch("big.bin")
+
+    old_stat, old = fetch_version(OLD, 1_600_000_000)
+    _, new = fetch_version(NEW, 1_700_000_000)
+
+    assert read(old) == OLD and old.size == len(OLD)
+    assert read(new) == NEW and new.size == len(NEW)
+    assert old.local_path != new.local_path
+
+    # Evicting the older version leaves the newer one readable.
+    old.release()
+    cache.disk_limit = len(NEW)
+    cache._trim()
+    assert (location.key, "big.bin", old_stat) not in cache._entries
+    assert read(new) == NEW
+    new.release()
+    cache.clear()
+    assert not os.listdir(tmp_path / "state" / "partial")
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+from io import BytesIO
+
+import metrics
+import transfer
+from payload_cache import PayloadCache
+from snapshot import FileStat
+from transfer import Payload
+
+STAT = FileStat(1.0, 5)
+
+
+def read(payload: Payload) -> bytes:
+    with payload.open() as file_obj:
+        return file_obj.read()
+
+
+class Source:
+    """A fetch callback counting how often the source is read."""
+
+    def __init__(self, data: bytes, spool: bool = False) -> None:
+        self.data = data
+        self.spool = spool
+        self.reads = 0
+
+    def __call__(self) -> Payload:
+        self.reads += 1
+        if self.spool:
+            return transfer.spool_stream(BytesIO(self.data), memory_limit=0)
+        return Payload.from_bytes(self.data)
+
+
+def test_second_fetch_is_a_hit():
+    cache = PayloadCache()
+    source = Source(b"hello")
+
+    first = cache.fetch(("zip:a", "f", STAT), source)
+    second = cache.fetch(("zip:a", "f", STAT), source)
+
+    assert source.reads == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert read(first) == read(second) == b"hello"
+    assert 'filesync_payload_cache_total{result="hit"}' in metrics.render_prometheus()
+
+
+def test_changed_metadata_is_a_miss():
+    cache = PayloadCache()
+    source = Source(b"hello")
+
+    cache.fetch(("zip:a", "f", STAT), source).release()
+    cache.fetch(("zip:a", "f", FileStat(2.0, 5)), source).release()
+
+    assert source.reads == 2
+
+
+def test_live_local_files_are_not_cached(tmp_path):
+    path = tmp_path / "f.txt"
+    path.write_bytes(b"local")
+    cache = PayloadCache()
+    reads = []
+
+    def fetch() -> Payload:
+        reads.append(1)
+        return Payload.from_file(path)
+
+    cache.fetch(("folder:x", "f.txt", STAT), fetch)
+    cache.fetch(("folder:x", "f.txt", STAT), fetch)
+
+    assert len(reads) == 2
+    assert not cache._entries
+
+
+def test_memory_overflow_spills_to_disk():
+    cache = PayloadCache(memory_limit=10)
+
+    cache.fetch(("zip:a", "one", STAT), Source(b"12345678")).release()
+    cache.fetch(("zip:a", "two", STAT), Source(b"abcdefgh")).release()
+
+    entries = cache._entries
+    assert entries[("zip:a", "one", STAT)].payload.local_path is not None
+    assert entries[("zip:a", "two", STAT)].payload.local_path is None
+    assert read(cache.fetch(("zip:a", "one", STAT), Source(b""))) == b"12345678"
+    cache.clear()
+
+
+def test_disk_overflow_evicts_unpinned_entries_only():
+    cache = PayloadCache(memory_limit=0, disk_limit=10)
+    pinned = cache.fetch(("ftp:a", "pinned", STAT), Source(b"12345678", spool=True))
+    cache.fetch(("ftp:a", "old", STAT), Source(b"abcdefgh", spool=True)).release()
+    cache.fetch(("ftp:a", "new", STAT), Source(b"ABCDEFGH", spool=True)).release()
+
+    assert ("ftp:a", "pinned", STAT) in cache._entries
+    assert ("ftp:a", "old", STAT) not in cache._entries
+    assert read(pinned) == b"12345678"
+
+    pinned.release()
+    cache.clear()
+    assert not cache._entries
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import pytest
+
+from poll_schedule import (
+    DEFAULT_POLL_SETTINGS,
+    PollSchedule,
+    PollSettings,
+    is_setting_line,
+    parse_setting,
+)
+
+
+def test_interval_backs_off_and_resets_on_change():
+    schedule = PollSchedule(PollSettings(1.0, 10.0, 2.0))
+
+    assert schedule.interval == 1.0
+    assert [schedule.record(False) for _ in range(5)] == [2.0, 4.0, 8.0, 10.0, 10.0]
+    assert schedule.record(True) == 1.0
+
+
+def test_setting_lines_are_recognised():
+    assert is_setting_line(" ftp.poll_max=300 ")
+    assert is_setting_line("zip.poll_backoff = 1.5")
+    assert not is_setting_line("folder:/tmp/a")
+    assert not is_setting_line("ftp:user:pass@host/path")
+
+
+def test_setting_updates_only_its_type():
+    settings = dict(DEFAULT_POLL_SETTINGS)
+
+    result = parse_setting("ftp.poll_min=2", settings)
+
+    assert result.ok
+    assert result.value == DEFAULT_POLL_SETTINGS["ftp"]._replace(poll_min=2.0)
+    assert settings["ftp"] is result.value
+    assert settings["zip"] == DEFAULT_POLL_SETTINGS["zip"]
+
+
+def test_poll_max_is_raised_to_poll_min():
+    settings = {"zip": PollSettings(1.0, 30.0)}
+
+    assert parse_setting("zip.poll_min=60", settings).value == PollSettings(
+        60.0, 60.0
+    )
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        "nfs.poll_min=1",
+        "ftp.poll_often=1",
+        "ftp.poll_min=soon",
+        "ftp.poll_min=0",
+        "ftp.poll_backoff=0.5",
+        "ftp.poll_min",
+    ],
+)
+def test_invalid_settings_are_rejected(line):
+    settings = dict(DEFAULT_POLL_SETTINGS)
+
+    result = parse_setting(line, settings)
+
+    assert not result.ok and line in result.error
+    assert settings == DEFAULT_POLL_SETTINGS
@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+import progress
+from progress import TransferProgress, format_bytes
+
+
+def test_format_bytes():
+    assert format_bytes(512) == "512 B"
+    assert format_bytes(1536) == "1.5 KiB"
+    assert format_bytes(3 * 2**30) == "3.0 GiB"
+
+
+def test_failed_transfers_are_counted_and_reported(monkeypatch):
+    lines = []
+    monkeypatch.setattr(progress, "log_info", lines.append)
+    tracker = TransferProgress("Initial sync", 3, 300, interval=3600)
+
+    tracker.advance(100)
+    tracker.advance(100, failed=True)
+    tracker.advance(100)
+    tracker.finish()
+
+    assert (tracker.files, tracker.failed, tracker.bytes) == (3, 1, 200)
+    assert lines[-1].startswith("Initial sync: 3/3 files (1 failed), 200 B of 300 B")
+    assert lines[-1].endswith(", done")
@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+"""End-to-end: a restart after a completed sync transfers nothing."""
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import zipfile
+
+from conftest import ROOT
+
+FILES = {
+    "top.txt": b"top",
+    "sub/one.txt": b"one",
+    "sub/deeper/two.txt": b"two" * 1000,
+}
+# Odd seconds with fractions: neither the ZIP's two-second DOS time nor a
+# whole-second FTP time can represent them exactly.
+MTIME = 1_700_000_001.7
+TIMEOUT = 30.0
+
+
+def run_once(tmp_path, locations, name: str) -> dict:
+    """Run the program until every watcher started, then stop it.
+
+    Returns:
+        The last metrics dump, written after the initial sync.
+    """
+    metrics_path = str(tmp_path / f"{name}.json")
+    log_path = tmp_path / f"{name}.log"
+    env = dict(os.environ, TZ="America/New_York", PYTHONUNBUFFERED="1")
+    with open(log_path, "w") as log:
+        proc = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(ROOT, "main.py"),
+                "--state-dir",
+                str(tmp_path / "state"),
+                "--metrics-json",
+                metrics_path,
+                "--metrics-interval",
+                "0.2",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            env=env,
+            cwd=str(tmp_path),
+        )
+        proc.stdin.write(("\n".join(locations) + "\nend\n").encode())
+        proc.stdin.close()
+        try:
+            deadline = time.monotonic() + TIMEOUT
+            while log_path.read_text().count("Starting daemon watcher") < len(
+                locations
+            ):
+                assert proc.poll() is None, log_path.read_text()
+                assert time.monotonic() < deadline, log_path.read_text()
+                time.sleep(0.1)
+            synced = time.time()
+            while (
+                not os.path.exists(metrics_path)
+                or os.path.getmtime(metrics_path) < synced + 0.3
+            ):
+                assert time.monotonic() < deadline, log_path.read_text()
+                time.sleep(0.1)
+        finally:
+            proc.send_signal(signal.SIGINT)
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+    assert "Traceback" not in log_path.read_text(), log_path.read_text()
+    with open(metrics_path) as file_obj:
+        return json.load(file_obj)["metrics"]
+
+
+def transferred(dump: dict, direction: str) -> float:
+    series = dump["filesync_transferred_bytes_total"]["series"]
+    return sum(s["value"] for s in series if s["labels"]["direction"] == direction)
+
+
+def test_restart_after_sync_transfers_nothing(tmp_path):
+    source = tmp_path / "a"
+    for rel_path, data in FILES.items():
+        full = source.joinpath(*rel_path.split("/"))
+        full.parent.mkdir(parents=True, exist_ok=True)
+        full.write_bytes(data)
+        os.utime(full, (MTIME, MTIME))
+    (tmp_path / "b").mkdir()
+    archive = tmp_path / "c.zip"
+    zipfile.ZipFile(archive, "w").close()
+    locations = [
+        f"folder:{source}",
+        f"folder:{tmp_path / 'b'}",
+        f"zip:{archive}",
+    ]
+
+    first = run_once(tmp_path, locations, "first")
+
+    assert transferred(first, "out") > 0
+    with zipfile.ZipFile(archive) as zf:
+        assert {name: zf.read(name) for name in zf.namelist()} == FILES
+    for rel_path, data in FILES.items():
+        copy = tmp_path.joinpath("b", *rel_path.split("/"))
+        assert copy.read_bytes() == data
+        assert abs(copy.stat().st_mtime - MTIME) < 1e-3
+
+    second = run_once(tmp_path, locations, "second")
+
+    assert transferred(second, "in") == 0
+    assert transferred(second, "out") == 0
+    assert second["filesync_transfer_seconds"]["series"] == []
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+from snapshot import FileStat
+from write_journal import WriteJournal
+
+LOC = "folder:/a"
+WRITTEN = FileStat(10.0, 5)
+
+
+def test_changes_during_a_write_are_echoes():
+    journal = WriteJournal()
+    journal.begin(LOC, "f.txt")
+
+    assert journal.pending(LOC, "f.txt")
+    assert journal.is_echo(LOC, "f.txt", FileStat(9.0, 2))
+    assert journal.is_echo(LOC, "f.txt", WRITTEN)
+    assert not journal.is_echo("folder:/b", "f.txt", WRITTEN)
+
+
+def test_completed_write_answers_one_observation():
+    journal = WriteJournal()
+    journal.begin(LOC, "f.txt")
+    journal.complete(LOC, "f.txt", WRITTEN)
+
+    assert not journal.pending(LOC, "f.txt")
+    assert journal.is_echo(LOC, "f.txt", WRITTEN)
+    assert not journal.is_echo(LOC, "f.txt", WRITTEN)
+
+
+def test_later_user_edit_is_not_an_echo():
+    journal = WriteJournal()
+    journal.begin(LOC, "f.txt")
+    journal.complete(LOC, "f.txt", WRITTEN)
+
+    assert not journal.is_echo(LOC, "f.txt", FileStat(11.0, 7))
+
+
+def test_digest_settles_a_metadata_mismatch_of_the_same_size():
+    journal = WriteJournal()
+    calls = []
+
+    def digest_of(value: str):
+        def compute() -> str:
+            calls.append(value)
+            return value
+
+        return compute
+
+    journal.begin(LOC, "f.txt")
+    journal.complete(LOC, "f.txt", WRITTEN, digest="abc")
+    assert journal.is_echo(LOC, "f.txt", FileStat(10.5, 5), digest_of("abc"))
+
+    journal.begin(LOC, "f.txt")
+    journal.complete(LOC, "f.txt", WRITTEN, digest="abc")
+    assert not journal.is_echo(LOC, "f.txt", FileStat(10.5, 5), digest_of("xyz"))
+
+    journal.begin(LOC, "f.txt")
+    journal.complete(LOC, "f.txt", WRITTEN, digest="abc")
+    assert not journal.is_echo(LOC, "f.txt", FileStat(10.5, 6), digest_of("abc"))
+
+    assert calls == ["abc", "xyz"]
+
+
+def test_deletes_and_unknown_outcomes():
+    journal = WriteJournal()
+    journal.begin(LOC, "gone.txt")
+    journal.complete(LOC, "gone.txt", None)
+    journal.begin(LOC, "odd.txt")
+    journal.complete(LOC, "odd.txt", None, known=False)
+
+    assert journal.is_echo(LOC, "gone.txt", None)
+    assert journal.is_echo(LOC, "odd.txt", FileStat(1.0, 1))
+
+
+def test_abandoned_and_expired_writes_are_forgotten():
+    journal = WriteJournal(ttl=0.0)
+    journal.begin(LOC, "failed.txt")
+    journal.abandon(LOC, "failed.txt")
+    journal.begin(LOC, "old.txt")
+    journal.complete(LOC, "old.txt", WRITTEN)
+
+    assert not journal.is_echo(LOC, "failed.txt", WRITTEN)
+    assert not journal.is_echo(LOC, "old.txt", WRITTEN)
@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import zipfile
+
+import zip_index
+from locations import ZipLocation
+from transfer import Payload
+
+MTIME = 1_700_000_000.0
+
+
+def read(payload: Payload) -> bytes:
+    with payload.open() as file_obj:
+        return file_obj.read()
+
+
+def test_nested_members_are_scanned_as_written(tmp_path):
+    location = ZipLocation(str(tmp_path / "a.zip"))
+    location.write("top.txt", Payload.from_bytes(b"top"), MTIME)
+    location.write("sub/deeper/two.txt", Payload.from_bytes(b"two"), MTIME)
+
+    snapshot = location.scan()
+
+    assert set(snapshot) == {"top.txt", "sub/deeper/two.txt"}
+    assert snapshot["sub/deeper/two.txt"].mtime == MTIME
+    assert location.stat("sub/deeper/two.txt") == snapshot["sub/deeper/two.txt"]
+    assert read(location.fetch("sub/deeper/two.txt")) == b"two"
+
+
+def test_index_is_refreshed_when_the_archive_changes(tmp_path):
+    path = str(tmp_path / "a.zip")
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("dir/", b"")
+        zf.writestr("dir/one.txt", b"1")
+    index = zip_index.get_index(path)
+
+    first = index.snapshot()
+    signature = index.signature
+    assert set(first) == {"dir/one.txt"}
+    assert index.snapshot() == first and index.signature == signature
+
+    with zipfile.ZipFile(path, "a") as zf:
+        zf.writestr("dir/two.txt", b"22")
+
+    assert set(index.snapshot()) == {"dir/one.txt", "dir/two.txt"}
+    assert index.signature != signature
+    index.close()
@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import os
+import struct
+import zipfile
+
+import pytest
+
+import zip_store
+from transfer import Payload
+
+MTIME = 1_700_000_000
+
+
+def write_info_zip_style(path: str, members: int) -> None:
+    """Write an archive whose local extra fields are longer than the central ones.
+
+    Info-ZIP stores access time and owner ids in the local headers only, so
+    the central directory's extra field cannot be used to measure members.
+    """
+    local_extra = struct.pack("<HHBII", 0x5455, 9, 3, MTIME, MTIME)
+    local_extra += struct.pack("<HHBBIBI", 0x7875, 11, 1, 4, 1000, 4, 1000)
+    central_extra = struct.pack("<HHBI", 0x5455, 5, 3, MTIME)
+    central_extra += struct.pack("<HH", 0x7875, 0)
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        infos = []
+        for index in range(members):
+            info = zipfile.ZipInfo(f"f{index}.txt", date_time=(2023, 11, 14, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.extra = local_extra
+            zf.writestr(info, f"file {index}\n")
+            infos.append(info)
+        for info in infos:
+            info.extra = central_extra
+
+
+def read_all(path: str) -> dict:
+    with zipfile.ZipFile(path) as zf:
+        return {name: zf.read(name) for name in zf.namelist()}
+
+
+def test_fresh_archive_has_no_garbage(tmp_path):
+    path = str(tmp_path / "a.zip")
+    write_info_zip_style(path, 200)
+
+    with zipfile.ZipFile(path) as zf:
+        assert zf.infolist()[0].extra != b""
+        assert zip_store.garbage_bytes(zf) == 0
+
+
+def test_appending_leaves_archive_clean(tmp_path):
+    path = str(tmp_path / "a.zip")
+    write_info_zip_style(path, 200)
+
+    zip_store.apply_changes(path, {"new.txt": Payload.from_bytes(b"new")})
+
+    key = os.path.abspath(path)
+    assert key not in zip_store._dirty
+    assert zip_store._garbage[key][0] == 0
+    assert read_all(path)["new.txt"] == b"new"
+
+
+def test_replaced_and_deleted_members_are_counted(tmp_path):
+    path = str(tmp_path / "a.zip")
+    write_info_zip_style(path, 20)
+    with zipfile.ZipFile(path) as zf:
+        with open(path, "rb") as src:
+            spans = {
+                info.filename: zip_store._member_span(src, info)
+                for info in zf.infolist()
+            }
+
+    zip_store.apply_changes(
+        path, {"f1.txt": Payload.from_bytes(b"replaced")}, deletes={"f2.txt"}
+    )
+
+    key = os.path.abspath(path)
+    assert zip_store._garbage[key][0] == spans["f1.txt"] + spans["f2.txt"]
+    assert key in zip_store._dirty
+    with zipfile.ZipFile(path) as zf:
+        assert zip_store.garbage_bytes(zf) == spans["f1.txt"] + spans["f2.txt"]
+
+    contents = read_all(path)
+    assert contents["f1.txt"] == b"replaced"
+    assert "f2.txt" not in contents
+
+
+def test_compaction_removes_garbage(tmp_path):
+    path = str(tmp_path / "a.zip")
+    write_info_zip_style(path, 20)
+    zip_store.apply_changes(path, {}, deletes={"f3.txt"})
+    before = read_all(path)
+
+    zip_store.compact(path)
+
+    key = os.path.abspath(path)
+    assert key not in zip_store._dirty
+    assert zip_store._garbage[key][0] == 0
+    with zipfile.ZipFile(path) as zf:
+        assert zip_store.garbage_bytes(zf) == 0
+        assert zf.testzip() is None
+    assert read_all(path) == before
+
+
+def test_garbage_is_recounted_after_outside_changes(tmp_path):
+    path = str(tmp_path / "a.zip")
+    write_info_zip_style(path, 20)
+    zip_store.apply_changes(path, {}, deletes={"f4.txt"})
+
+    # Another program rewrites the archive without the garbage.
+    contents = read_all(path)
+    with zipfile.ZipFile(path, "w") as zf:
+        for name, data in contents.items():
+            zf.writestr(name, data)
+
+    zip_store.apply_changes(path, {"new.txt": Payload.from_bytes(b"new")})
+
+    assert zip_store._garbage[os.path.abspath(path)][0] == 0
+
+
+class _Unseekable:
+    """A write-only stream, which makes zipfile add data descriptors."""
+
+    def __init__(self, file_obj) -> None:
+        self._file_obj = file_obj
+
+    def write(self, data: bytes) -> int:
+        return self._file_obj.write(data)
+
+    def flush(self) -> None:
+        self._file_obj.flush()
+
+
+def test_raw_copy_keeps_compressed_bytes(tmp_path):
+    src_path = str(tmp_path / "src.zip")
+    with open(src_path, "wb") as raw:
+        with zipfile.ZipFile(_Unseekable(raw), "w") as zf:
+            zf.writestr("described.txt", b"data descriptor " * 100)
+            zf.writestr(
+                "stored.bin", os.urandom(300), compress_type=zipfile.ZIP_STORED
+            )
+            zf.writestr(
+                "deflated.txt", b"deflate " * 1000, compress_type=zipfile.ZIP_DEFLATED
+            )
+    with zipfile.ZipFile(src_path) as zf:
+        assert any(info.flag_bits & 0x08 for info in zf.infolist())
+        expected = {
+            info.filename: (info.compress_size, info.CRC) for info in zf.infolist()
+        }
+    contents = read_all(src_path)
+
+    dest_path = str(tmp_path / "dest.zip")
+    with open(src_path, "rb") as src, zipfile.ZipFile(src_path) as zin:
+        with zipfile.ZipFile(dest_path, "w") as zout:
+            for info in zin.infolist():
+                zip_store.copy_member_raw(src, zout, info)
+
+    with zipfile.ZipFile(dest_path) as zf:
+        assert zf.testzip() is None
+        assert {
+            info.filename: (info.compress_size, info.CRC) for info in zf.infolist()
+        } == expected
+        assert zip_store.garbage_bytes(zf) == 0
+    assert read_all(dest_path) == contents
+
+
+def failing_payload(size: int) -> Payload:
+    """A payload whose reader fails halfway, like a dropped source."""
+
+    class Reader:
+        def __init__(self) -> None:
+            self.left = size // 2
+
+        def read(self, limit: int = -1) -> bytes:
+            if self.left <= 0:
+                raise OSError("source went away")
+            chunk = b"x" * min(self.left, limit if limit > 0 else self.left)
+            self.left -= len(chunk)
+            return chunk
+
+        def close(self) -> None:
+            pass
+
+        def __enter__(self) -> "Reader":
+            return self
+
+        def __exit__(self, *exc) -> None:
+            pass
+
+    return Payload(Reader, size)
+
+
+def test_failed_member_rolls_the_whole_batch_back(tmp_path):
+    path = str(tmp_path / "a.zip")
+    write_info_zip_style(path, 3)
+    with open(path, "rb") as file_obj:
+        before = file_obj.read()
+
+    batch = zip_store.ZipBatch(path)
+    batch.write("f0.txt", Payload.from_bytes(b"replaced"))
+    batch.write("added.txt", Payload.from_bytes(b"added"))
+    batch.write("broken.txt", failing_payload(100_000))
+    batch.write("late.txt", Payload.from_bytes(b"late"))
+    batch.delete("f1.txt")
+    with pytest.raises(OSError):
+        batch.apply()
+
+    with open(path, "rb") as file_obj:
+        assert file_obj.read() == before
+    assert os.listdir(str(tmp_path)) == ["a.zip"]
+    assert not batch.writes and not batch.deletes
@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+"""Bounded-memory payloads and streaming copy helpers."""
+
+import errno
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from typing import BinaryIO, Callable, List, Optional, Union
+
+CHUNK_SIZE = 1024 * 1024
+MEMORY_LIMIT = 1024 * 1024
+
+# Errors meaning "this kernel copy primitive does not apply here".
+_NO_KERNEL_COPY = (
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+)
+
+
+class Payload:
+    """The contents of one file that can be opened for reading many times.
+
+    Payloads are backed either by the original local file, by a small
+    in-memory buffer, or by a temporary file, so their memory use is bounded
+    regardless of the file size.
+
+    Attributes:
+        size: The payload size in bytes.
+        local_path: A local file holding the bytes, if there is one.
+    """
+
+    def __init__(
+        self,
+        opener: Callable[[], BinaryIO],
+        size: int,
+        local_path: Optional[str] = None,
+        cleanup: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """Create a payload from an ``opener`` returning fresh readers."""
+        self._opener = opener
+        self.size = size
+        self.local_path = local_path
+        self._cleanup = cleanup
+
+    @classmethod
+    def from_file(cls, path: Union[str, "os.PathLike[str]"]) -> "Payload":
+        """Wrap an existing local file without copying it."""
+        local_path = os.fspath(path)
+        return cls(
+            lambda: open(local_path, "rb"),
+            os.path.getsize(local_path),
+            local_path=local_path,
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Payload":
+        """Wrap an in-memory buffer."""
+        return cls(lambda: BytesIO(data), len(data))
+
+    @property
+    def is_copy(self) -> bool:
+        """Whether the payload holds its own copy of the bytes.
+
+        Copies live in memory or in a temporary file; other payloads read
+        the original file, which may change under them.
+        """
+        return self.local_path is None or self._cleanup is not None
+
+    def open(self) -> BinaryIO:
+        """Return a new reader positioned at the start of the payload."""
+        return self._opener()
+
+    def release(self) -> None:
+        """Free the temporary storage behind the payload, if any."""
+        if self._cleanup is not None:
+            self._cleanup()
+            self._cleanup = None
+
+    def __enter__(self) -> "Payload":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.release()
+
+
+class Spool:
+    """Collects streamed chunks in memory, spilling to a temp file when large.
+
+    Instances are meant to be used as the callback of chunked readers (e.g.
+    ``FTP.retrbinary``) and then turned into a :class:`Payload`.
+    """
+
+    def __init__(self, memory_limit: int = MEMORY_LIMIT) -> None:
+        """Create an empty spool."""
+        self.memory_limit = memory_limit
+        self._chunks: List[bytes] = []
+        self._buffered = 0
+        self._file: Optional[BinaryIO] = None
+        self._name: Optional[str] = None
+        self.size = 0
+
+    def write(self, chunk: bytes) -> None:
+        """Append a chunk."""
+        self.size += len(chunk)
+        if self._file is None:
+            self._chunks.append(chunk)
+            self._buffered += len(chunk)
+            if self._buffered <= self.memory_limit:
+                return
+            fd, self._name = tempfile.mkstemp(prefix="filesync-", suffix=".part")
+            self._file = os.fdopen(fd, "wb")
+            for buffered in self._chunks:
+                self._file.write(buffered)
+            self._chunks = []
+            return
+        self._file.write(chunk)
+
+    def discard(self) -> None:
+        """Drop everything written so far."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._name is not None:
+            _remove_quietly(self._name)
+            self._name = None
+        self._chunks = []
+
+    def to_payload(self) -> Payload:
+        """Finish the spool and return its contents as a payload."""
+        if self._file is None:
+            return Payload.from_bytes(b"".join(self._chunks))
+
+        self._file.close()
+        name = self._name
+        assert name is not None
+        return Payload(
+            lambda: open(name, "rb"),
+            self.size,
+            local_path=name,
+            cleanup=lambda: _remove_quietly(name),
+        )
+
+
+def spool_stream(src: BinaryIO, memory_limit: int = MEMORY_LIMIT) -> Payload:
+    """Read a stream into a bounded-memory payload."""
+    spool = Spool(memory_limit)
+    try:
+        while True:
+            chunk = src.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            spool.write(chunk)
+    except BaseException:
+        spool.discard()
+        raise
+    return spool.to_payload()
+
+
+def copy_payload_to_file(payload: Payload, dest: BinaryIO) -> None:
+    """Write a payload into an open binary file.
+
+    Local payloads are copied in the kernel with ``copy_file_range`` or
+    ``sendfile`` when possible; everything else is streamed in chunks.
+    """
+    if payload.local_path is not None:
+        with open(payload.local_path, "rb") as src:
+            if _kernel_copy(src, dest, payload.size):
+                return
+            src.seek(0)
+            shutil.copyfileobj(src, dest, CHUNK_SIZE)
+        return
+
+    with payload.open() as src:
+        shutil.copyfileobj(src, dest, CHUNK_SIZE)
+
+
+def _kernel_copy(src: BinaryIO, dest: BinaryIO, size: int) -> bool:
+    """Copy ``size`` bytes between two real files without user-space buffers.
+
+    Returns:
+        True if the kernel did the copy, False if the caller must fall back.
+    """
+    dest.flush()
+    in_fd, out_fd = src.fileno(), dest.fileno()
+    out_start = os.lseek(out_fd, 0, os.SEEK_CUR)
+
+    for primitive in ("copy_file_range", "sendfile"):
+        func = getattr(os, primitive, None)
+        if func is None:
+            continue
+
+        copied = 0
+        try:
+            while copied < size:
+                if primitive == "copy_file_range":
+                    sent = func(in_fd, out_fd, size - copied)
+                else:
+                    sent = func(out_fd, in_fd, copied, size - copied)
+                if sent == 0:
+                    break
+                copied += sent
+        except OSError as exc:
+            if exc.errno not in _NO_KERNEL_COPY or copied:
+                raise
+            continue
+
+        if copied == size:
+            if primitive == "sendfile":
+                # sendfile with an explicit offset leaves the input fd alone
+                # but advances the output fd.
+                os.lseek(in_fd, size, os.SEEK_SET)
+            return True
+
+        # Short copy (e.g. file shrank): restart with the portable path.
+        os.lseek(out_fd, out_start, os.SEEK_SET)
+        os.ftruncate(out_fd, out_start)
+        os.lseek(in_fd, 0, os.SEEK_SET)
+        return False
+
+    return False
+
+
+def _remove_quietly(path: str) -> None:
+    """Remove a temporary file, ignoring a missing one."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+"""Journal of the writes the engine makes, so watchers can ignore their echoes."""
+
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from snapshot import FileStat
+
+JOURNAL_TTL_SECONDS = 120.0
+
+
+class JournalEntry:
+    """One engine change to a file in one location.
+
+    Attributes:
+        in_flight: True until the change is complete.
+        expected: The file's metadata right after the change, or None once a
+            delete completed.
+        known: Whether ``expected`` was determined; if not, the first change
+            seen after completion is taken as the echo.
+        digest: The content fingerprint written, if known.
+        deadline: Monotonic time after which the entry is discarded.
+    """
+
+    __slots__ = ("in_flight", "expected", "known", "digest", "deadline")
+
+    def __init__(self) -> None:
+        """Create an in-flight entry."""
+        self.in_flight = True
+        self.expected: Optional[FileStat] = None
+        self.known = False
+        self.digest: Optional[str] = None
+        self.deadline = time.monotonic() + JOURNAL_TTL_SECONDS
+
+
+class WriteJournal:
+    """Remembers in-flight and recently completed engine writes.
+
+    Entries are keyed by (location key, relative path). A watcher asks
+    :meth:`is_echo` about every change it sees; changes observed while the
+    write is in flight, or that match the recorded outcome, are the
+    engine's own and must not be propagated again.
+    """
+
+    def __init__(self, ttl: float = JOURNAL_TTL_SECONDS) -> None:
+        """Create an empty journal whose completed entries live ``ttl`` seconds."""
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str], JournalEntry] = {}
+        self._next_expiry = time.monotonic() + ttl
+
+    def begin(self, location: str, rel_path: str) -> None:
+        """Record that the engine is about to change a file."""
+        with self._lock:
+            self._entries[(location, rel_path)] = JournalEntry()
+
+    def complete(
+        self,
+        location: str,
+        rel_path: str,
+        stat: Optional[FileStat],
+        digest: Optional[str] = None,
+        known: bool = True,
+    ) -> None:
+        """Record the outcome of a change started with :meth:`begin`.
+
+        Args:
+            location: The location key.
+            rel_path: The file's relative path.
+            stat: The file's metadata after the change (None if deleted).
+            digest: The content fingerprint written, if known.
+            known: False if ``stat`` could not be determined.
+        """
+        with self._lock:
+            entry = self._entries.get((location, rel_path))
+            if entry is None:
+                return
+            entry.in_flight = False
+            entry.expected = stat
+            entry.known = known
+            entry.digest = digest
+            entry.deadline = time.monotonic() + self.ttl
+
+    def pending(self, location: str, rel_path: str) -> bool:
+        """Return True if a change to the file is still in flight."""
+        with self._lock:
+            entry = self._entries.get((location, rel_path))
+            return entry is not None and entry.in_flight
+
+    def abandon(self, location: str, rel_path: str) -> None:
+        """Forget a change that failed."""
+        with self._lock:
+            self._entries.pop((location, rel_path), None)
+
+    def is_echo(
+        self,
+        location: str,
+        rel_path: str,
+        observed: Optional[FileStat],
+        digest_of: Optional[Callable[[], Optional[str]]] = None,
+    ) -> bool:
+        """Return True if a change seen by a watcher was made by the engine.
+
+        Args:
+            location: The location key.
+            rel_path: The file's relative path.
+            observed: The metadata the watcher sees now (None if deleted).
+            digest_of: Computes the fingerprint of the observed file. It is
+                only called when the metadata differs from the recorded one
+                but the size matches.
+
+        Returns:
+            True if the change should be ignored.
+        """
+        with self._lock:
+            self._expire()
+            key = (location, rel_path)
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            if entry.in_flight:
+                return True
+            # A completed entry answers exactly one observation.
+            del self._entries[key]
+
+        if not entry.known:
+            return True
+        if observed is None or entry.expected is None:
+            return observed is None and entry.expected is None
+        if observed == entry.expected:
+            return True
+        if (
+            entry.digest is not None
+            and digest_of is not None
+            and observed.size == entry.expected.size
+        ):
+            return digest_of() == entry.digest
+        return False
+
+    def _expire(self) -> None:
+        """Drop completed entries past their deadline; the caller holds the lock."""
+        now = time.monotonic()
+        if now < self._next_expiry:
+            return
+        self._next_expiry = now + self.ttl / 4
+        stale = [
+            key
+            for key, entry in self._entries.items()
+            if not entry.in_flight and entry.deadline <= now
+        ]
+        for key in stale:
+            del self._entries[key]
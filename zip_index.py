@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+"""In-memory ZIP central-directory indexes, re-read only when the archive changes."""
+
+import os
+import threading
+import zipfile
+from typing import Dict, Optional
+
+import transfer
+import zip_store
+from snapshot import FileStat, Snapshot
+from transfer import Payload
+from zip_store import PathLike
+
+
+def stat_signature(zip_path: PathLike) -> Optional[str]:
+    """Return the size, mtime and inode of an archive file, or None if missing."""
+    try:
+        st = os.stat(zip_path)
+    except OSError:
+        return None
+    return f"{st.st_size}:{st.st_mtime_ns}:{st.st_ino}"
+
+
+class ZipIndex:
+    """The members of one archive, parsed once per version of the archive.
+
+    The archive stays open between calls and its central directory is only
+    parsed again when the file's stat signature changes, so looking at an
+    unchanged archive costs a single ``stat``. Every method takes the
+    archive's lock.
+
+    Attributes:
+        zip_path: The archive.
+        signature: The stat signature of the version indexed, if any.
+    """
+
+    def __init__(self, zip_path: PathLike) -> None:
+        """Create an empty index for ``zip_path``."""
+        self.zip_path = zip_path
+        self.signature: Optional[str] = None
+        self._zf: Optional[zipfile.ZipFile] = None
+        self._snapshot: Snapshot = {}
+
+    def _refresh(self) -> zipfile.ZipFile:
+        """Return the open archive, re-reading it if it changed (lock held)."""
+        signature = stat_signature(self.zip_path)
+        if self._zf is not None and signature is not None:
+            if signature == self.signature:
+                return self._zf
+
+        self._close()
+        zf = zipfile.ZipFile(self.zip_path, "r")
+        snapshot: Snapshot = {}
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            # Members are named by their path relative to the archive root,
+            # exactly as ZipLocation writes them.
+            snapshot[info.filename] = FileStat(
+                zip_store.member_mtime(info), info.file_size
+            )
+
+        self._zf = zf
+        self._snapshot = snapshot
+        self.signature = signature
+        return zf
+
+    def _close(self) -> None:
+        """Close the open archive (lock held)."""
+        if self._zf is not None:
+            self._zf.close()
+            self._zf = None
+        self.signature = None
+
+    def snapshot(self) -> Snapshot:
+        """Return a snapshot of every member."""
+        with zip_store.archive_lock(self.zip_path):
+            self._refresh()
+            return dict(self._snapshot)
+
+    def stat(self, rel_path: str) -> Optional[FileStat]:
+        """Return the metadata of one member, or None if missing."""
+        with zip_store.archive_lock(self.zip_path):
+            self._refresh()
+            return self._snapshot.get(rel_path)
+
+    def fetch(self, name: str) -> Payload:
+        """Stream a member into a spool through the open archive."""
+        with zip_store.archive_lock(self.zip_path):
+            zf = self._refresh()
+            with zf.open(name, "r") as file_obj:
+                return transfer.spool_stream(file_obj)
+
+    def close(self) -> None:
+        """Close the archive; the next call opens it again."""
+        with zip_store.archive_lock(self.zip_path):
+            self._close()
+
+
+_indexes: Dict[str, ZipIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(zip_path: PathLike) -> ZipIndex:
+    """Return the shared index of an archive, creating it on first use."""
+    key = os.path.abspath(zip_path)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = ZipIndex(zip_path)
+            _indexes[key] = index
+    return index
+
+
+def close_all() -> None:
+    """Close every open archive."""
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+    for index in indexes:
+        index.close()
@@ -0,0 +1,348 @@
+from __future__ import annotations
+
+"""Incremental updates of ZIP archives with lazy compaction.
+
+New members are appended in place and replaced or deleted members are
+dropped from the central directory only (their bytes become garbage). The
+archive is rewritten once enough garbage has accumulated, or once it has
+been idle for a while.
+"""
+
+import copy
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+from typing import BinaryIO, Dict, Iterable, Optional, Set, Tuple, Union
+
+import metrics
+from batch import Batch
+from logger import log_err, log_info
+from transfer import CHUNK_SIZE, Payload
+
+PathLike = Union[str, "os.PathLike[str]"]
+
+COMPACT_GARBAGE_RATIO = 0.5
+COMPACT_MIN_GARBAGE = 1024 * 1024
+COMPACT_IDLE_SECONDS = 30.0
+ZIP64_LIMIT = (1 << 31) - 1
+
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+_ZIP64_EXTRA_ID = 0x0001
+_TIMESTAMP_EXTRA_ID = 0x5455
+_TIMESTAMP_MTIME = 0x01
+_DOS_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+_locks: Dict[str, threading.Lock] = {}
+_locks_guard = threading.Lock()
+
+# Archives holding garbage, mapped to the time they were last modified.
+_dirty: Dict[str, float] = {}
+# Archives mapped to their garbage bytes and to the file size they had when
+# it was counted; a different size means the archive changed elsewhere.
+_garbage: Dict[str, Tuple[int, int]] = {}
+
+
+def archive_lock(zip_path: PathLike) -> threading.Lock:
+    """Return the lock serializing modifications (and reads) of one archive."""
+    key = os.path.abspath(zip_path)
+    with _locks_guard:
+        lock = _locks.get(key)
+        if lock is None:
+            lock = threading.Lock()
+            _locks[key] = lock
+        return lock
+
+
+def garbage_bytes(zf: zipfile.ZipFile) -> int:
+    """Return the bytes before the central directory not used by live members.
+
+    Every member is measured from its own local header (whose extra field
+    may differ from the central directory's), so this reads one header per
+    member; :func:`apply_changes` only calls it once per archive.
+    """
+    live = sum(_member_span(zf.fp, info) for info in zf.infolist())
+    return max(0, zf.start_dir - live)
+
+
+def new_member_info(name: str, mtime: Optional[float] = None) -> zipfile.ZipInfo:
+    """Return the header of a new member, modified at ``mtime`` (default now).
+
+    The time is stored twice: as the DOS ``date_time`` in local time (two
+    second resolution, as ``writestr`` would), and as a UTC extended
+    timestamp field, which :func:`member_mtime` prefers.
+    """
+    if mtime is None:
+        mtime = time.time()
+    date_time = max(time.localtime(mtime)[:6], _DOS_EPOCH)
+    info = zipfile.ZipInfo(name, date_time=date_time)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o600 << 16
+    if 0 <= mtime < 2**32:
+        info.extra = struct.pack(
+            "<HHBI", _TIMESTAMP_EXTRA_ID, 5, _TIMESTAMP_MTIME, int(mtime)
+        )
+    return info
+
+
+def member_mtime(info: zipfile.ZipInfo) -> float:
+    """Return a member's modification time as a Unix timestamp.
+
+    The UTC extended timestamp field is used when present; otherwise the
+    DOS ``date_time`` is read as local time.
+    """
+    extra = info.extra
+    pos = 0
+    while pos + 4 <= len(extra):
+        field_id, size = struct.unpack_from("<HH", extra, pos)
+        pos += 4
+        if field_id == _TIMESTAMP_EXTRA_ID and size >= 5:
+            if extra[pos] & _TIMESTAMP_MTIME:
+                return float(struct.unpack_from("<I", extra, pos + 1)[0])
+        pos += size
+    return time.mktime(info.date_time + (0, 0, -1))
+
+
+def write_member(
+    zf: zipfile.ZipFile, name: str, payload: Payload, mtime: Optional[float] = None
+) -> None:
+    """Stream a payload into a new member of an open archive."""
+    info = new_member_info(name, mtime)
+    with payload.open() as src, zf.open(
+        info, "w", force_zip64=payload.size > ZIP64_LIMIT
+    ) as dest:
+        shutil.copyfileobj(src, dest, CHUNK_SIZE)
+
+
+def apply_changes(
+    zip_path: PathLike,
+    writes: Dict[str, Payload],
+    deletes: Iterable[str] = (),
+    mtimes: Optional[Dict[str, float]] = None,
+) -> None:
+    """Apply several writes and deletes to an archive in one pass.
+
+    The changes are all or nothing: if any write fails, the archive's old
+    central directory is put back, so the archive lists exactly the members
+    it had before (appended bytes are cut off again).
+
+    Args:
+        zip_path: The archive to modify; created if it does not exist.
+        writes: Member names mapped to their new contents.
+        deletes: Member names to remove.
+        mtimes: Member names mapped to their modification time; members
+            missing here are stamped with the current time.
+    """
+    removed: Set[str] = set(writes) | set(deletes)
+    if not removed:
+        return
+
+    key = os.path.abspath(zip_path)
+    with archive_lock(zip_path), metrics.ZIP_WRITE_SECONDS.time(op="apply"):
+        existed = os.path.exists(zip_path)
+        counted = _garbage.get(key)
+        if counted is not None and existed and os.path.getsize(zip_path) != counted[1]:
+            counted = None
+        zf = zipfile.ZipFile(zip_path, "a", zipfile.ZIP_DEFLATED)
+        # Appending overwrites the central directory; keep it for a rollback.
+        start_dir = zf.start_dir
+        zf.fp.seek(start_dir)
+        directory = zf.fp.read()
+
+        try:
+            with zf:
+                garbage = counted[0] if counted is not None else garbage_bytes(zf)
+                stale = [info for info in zf.infolist() if info.filename in removed]
+                if stale:
+                    # Only the members dropped here become new garbage.
+                    garbage += sum(_member_span(zf.fp, info) for info in stale)
+                    zf.filelist = [
+                        info for info in zf.filelist if info.filename not in removed
+                    ]
+                    for info in stale:
+                        zf.NameToInfo.pop(info.filename, None)
+                    # Force close() to rewrite the central directory even when
+                    # nothing new is written (delete-only batches).
+                    zf._didModify = True
+
+                zf.fp.seek(start_dir)
+                for name, payload in writes.items():
+                    write_member(zf, name, payload, (mtimes or {}).get(name))
+
+                size = zf.start_dir
+        except BaseException:
+            _rollback(zip_path, existed, start_dir, directory)
+            raise
+
+        _garbage[key] = (garbage, os.path.getsize(zip_path))
+        if garbage:
+            _dirty[key] = time.monotonic()
+        else:
+            _dirty.pop(key, None)
+
+        if garbage >= COMPACT_MIN_GARBAGE and garbage >= size * COMPACT_GARBAGE_RATIO:
+            _compact_locked(zip_path)
+
+
+def _rollback(
+    zip_path: PathLike, existed: bool, start_dir: int, directory: bytes
+) -> None:
+    """Restore an archive's central directory after a failed update."""
+    try:
+        if not existed:
+            os.remove(zip_path)
+            return
+        with open(zip_path, "r+b") as file_obj:
+            file_obj.seek(start_dir)
+            file_obj.write(directory)
+            file_obj.truncate()
+    except OSError as exc:
+        log_err(f"Could not roll back zip archive {zip_path}: {exc}")
+
+
+def compact(zip_path: PathLike) -> None:
+    """Rewrite an archive keeping only its live members."""
+    with archive_lock(zip_path):
+        _compact_locked(zip_path)
+
+
+def compact_idle(idle_seconds: float = COMPACT_IDLE_SECONDS) -> None:
+    """Compact every archive holding garbage that has not changed recently.
+
+    Args:
+        idle_seconds: Minimum time since the last modification.
+    """
+    now = time.monotonic()
+    for key, modified in list(_dirty.items()):
+        if now - modified >= idle_seconds:
+            try:
+                compact(key)
+            except (OSError, zipfile.BadZipFile) as exc:
+                log_err(f"Could not compact zip {key}: {exc}")
+                _dirty.pop(key, None)
+
+
+def _compact_locked(zip_path: PathLike) -> None:
+    """Rewrite an archive; the caller must hold its lock."""
+    key = os.path.abspath(zip_path)
+    _dirty.pop(key, None)
+
+    if not os.path.exists(zip_path):
+        return
+
+    zip_dir = os.path.dirname(key)
+    tmp_fd, tmp_name = tempfile.mkstemp(suffix=".zip", dir=zip_dir)
+    os.close(tmp_fd)
+
+    started = time.monotonic()
+    try:
+        with open(zip_path, "rb") as src, zipfile.ZipFile(
+            zip_path, "r"
+        ) as zin, zipfile.ZipFile(tmp_name, "w", zipfile.ZIP_DEFLATED) as zout:
+            for item in zin.infolist():
+                copy_member_raw(src, zout, item)
+
+        os.replace(tmp_name, zip_path)
+        _garbage[key] = (0, os.path.getsize(zip_path))
+        metrics.ZIP_WRITE_SECONDS.observe(time.monotonic() - started, op="compact")
+        log_info(f"Compacted zip archive {zip_path}")
+    finally:
+        if os.path.exists(tmp_name):
+            try:
+                os.remove(tmp_name)
+            except OSError:
+                log_err(f"OS Error when removing tmp zip file {tmp_name}")
+
+
+def _has_zip64_extra(extra: bytes) -> bool:
+    """Return True if a local header extra field carries a ZIP64 record."""
+    pos = 0
+    while pos + 4 <= len(extra):
+        header_id, size = struct.unpack("<HH", extra[pos : pos + 4])
+        if header_id == _ZIP64_EXTRA_ID:
+            return True
+        pos += 4 + size
+    return False
+
+
+def _member_span(src: BinaryIO, info: zipfile.ZipInfo) -> int:
+    """Return the on-disk length of a member: local header, data, descriptor.
+
+    Args:
+        src: The archive opened in binary mode.
+        info: The member as read from the central directory.
+
+    Returns:
+        The number of bytes starting at ``info.header_offset``.
+    """
+    src.seek(info.header_offset)
+    header = src.read(30)
+    if len(header) != 30 or header[:4] != _LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile(f"Bad local header for member {info.filename}")
+
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    span = 30 + name_len + extra_len + info.compress_size
+
+    if info.flag_bits & 0x08:
+        src.seek(name_len, os.SEEK_CUR)
+        extra = src.read(extra_len)
+        src.seek(info.header_offset + span)
+        descriptor = 8 if not _has_zip64_extra(extra) else 16
+        descriptor += 4  # CRC-32
+        if src.read(4) == _DESCRIPTOR_SIGNATURE:
+            descriptor += 4
+        span += descriptor
+
+    return span
+
+
+def copy_member_raw(
+    src: BinaryIO, zout: zipfile.ZipFile, info: zipfile.ZipInfo
+) -> None:
+    """Copy a member's compressed bytes verbatim into another archive.
+
+    The local header, compressed data and data descriptor are streamed as-is,
+    so the member is neither inflated nor re-deflated; only its central
+    directory record is re-emitted with the new offset.
+
+    Args:
+        src: The source archive opened in binary mode.
+        zout: The destination archive, opened for writing.
+        info: The source member to copy.
+    """
+    remaining = _member_span(src, info)
+    src.seek(info.header_offset)
+
+    fp = zout.fp
+    fp.seek(zout.start_dir)
+    offset = fp.tell()
+    while remaining:
+        chunk = src.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated data for member {info.filename}")
+        fp.write(chunk)
+        remaining -= len(chunk)
+
+    clone = copy.copy(info)
+    clone.header_offset = offset
+    zout.filelist.append(clone)
+    zout.NameToInfo[clone.filename] = clone
+    zout.start_dir = fp.tell()
+    zout._didModify = True
+
+
+class ZipBatch(Batch):
+    """Collects changes for one archive and applies them in one rewrite."""
+
+    def __init__(self, zip_path: PathLike) -> None:
+        """Create an empty batch for ``zip_path``."""
+        super().__init__()
+        self.zip_path = zip_path
+
+    def _commit(self, writes: Dict[str, Payload], deletes: Set[str]) -> None:
+        """Apply the changes with :func:`apply_changes`."""
+        apply_changes(self.zip_path, writes, deletes, self.mtimes)